@@ -0,0 +1,174 @@
+"""
+Recursive discovery of the files of a sample on EOS (or on a local filesystem)
+
+Directories are listed concurrently by a bounded pool of threads, and the
+listings are kept in a json cache: a directory is listed again only if its
+modification time changed, so a new campaign only lists the directories
+where files were added.
+"""
+import os
+import json
+import time
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+eosbase = "root://cmseos.fnal.gov/"
+
+
+class EOSBackend:
+    """List EOS directories through xrdfs, which also gives the modification times"""
+
+    def __init__(self, eosbase=eosbase):
+        self.host = eosbase.replace("root://", "").strip("/")
+
+    def mtime(self, path):
+        out = subprocess.check_output(["xrdfs", self.host, "stat", path]).decode("utf-8")
+        for line in out.split("\n"):
+            if line.startswith("MTime:"):
+                return line.split(":", 1)[1].strip()
+        return None
+
+    def listdir(self, path):
+        """Return (name, is_dir, mtime) of the entries of a directory"""
+        out = subprocess.check_output(["xrdfs", self.host, "ls", "-l", path]).decode("utf-8")
+        entries = []
+        for line in out.split("\n"):
+            fields = line.split()
+            if len(fields) < 5:
+                continue
+            # flags, date, time, size, path
+            entries.append((os.path.basename(fields[4].rstrip("/")), fields[0].startswith("d"),
+                            "%s %s" % (fields[1], fields[2])))
+        return entries
+
+
+class LocalBackend:
+    """List directories of a local (or fuse mounted) filesystem, paths being relative to root"""
+
+    def __init__(self, root=""):
+        self.root = root
+
+    def mtime(self, path):
+        return os.stat(self.root + path).st_mtime
+
+    def listdir(self, path):
+        entries = []
+        for entry in os.scandir(self.root + path):
+            entries.append((entry.name, entry.is_dir(), entry.stat().st_mtime))
+        return entries
+
+
+class ListingCache:
+    """Directory listings keyed by path, valid as long as the directory mtime is unchanged"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.listings = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.listings = json.load(f)
+
+    def get(self, dirpath, mtime):
+        with self.lock:
+            cached = self.listings.get(dirpath)
+        if cached and mtime is not None and cached["mtime"] == mtime:
+            return [tuple(e) for e in cached["entries"]]
+        return None
+
+    def put(self, dirpath, mtime, entries):
+        with self.lock:
+            self.listings[dirpath] = {"mtime": mtime, "entries": entries}
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            tmppath = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmppath, "w") as f:
+                json.dump(self.listings, f)
+            os.rename(tmppath, self.path)
+
+
+def _list(backend, cache, dirpath, mtime):
+    """Listing of a directory, from the cache if its mtime did not change"""
+    if mtime is None:
+        mtime = backend.mtime(dirpath)
+    entries = cache.get(dirpath, mtime) if cache else None
+    if entries is not None:
+        # the mtimes of the subdirectories in the cached listing may be outdated
+        return [(name, is_dir, None if is_dir else m) for name, is_dir, m in entries]
+    entries = backend.listdir(dirpath)
+    if cache:
+        cache.put(dirpath, mtime, entries)
+    return entries
+
+
+def rec_search(backend, startdirs, suffix=".root", skip=("log",), nthreads=16, cache=None):
+    """
+    Files ending with suffix below each of startdirs, in the order of a
+    depth-first walk through the directories sorted by name.
+
+    Returns a dict startdir -> list of files (startdir + "/" + relative path).
+    """
+    listings = {}
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        pending = {pool.submit(_list, backend, cache, d, None): d for d in startdirs}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirpath = pending.pop(future)
+                listings[dirpath] = sorted(future.result())
+                for name, is_dir, mtime in listings[dirpath]:
+                    if is_dir and name not in skip:
+                        subdir = dirpath + "/" + name
+                        pending[pool.submit(_list, backend, cache, subdir, mtime)] = subdir
+    if cache:
+        cache.save()
+
+    def collect(dirpath):
+        files = []
+        for name, is_dir, _ in listings[dirpath]:
+            if is_dir:
+                if name not in skip:
+                    files += collect(dirpath + "/" + name)
+            elif name.endswith(suffix):
+                files.append(dirpath + "/" + name)
+        return files
+
+    return {d: collect(d) for d in startdirs}
+
+
+def get_backend(args):
+    if args.backend == "local":
+        return LocalBackend(args.local_root)
+    return EOSBackend(args.eosbase)
+
+
+def add_arguments(parser):
+    parser.add_argument("--backend", choices=["eos", "local"], default="eos",
+                        help="List the directories on EOS with xrdfs, or on the local filesystem. Default: %(default)s")
+    parser.add_argument("--eosbase", default=eosbase,
+                        help="EOS redirector. Default: %(default)s")
+    parser.add_argument("--local-root", default="",
+                        help="Prefix of the EOS paths on the local filesystem for --backend local, e.g. /eos/uscms")
+    parser.add_argument("-j", "--nthreads", type=int, default=16,
+                        help="Number of directories listed in parallel. Default: %(default)s")
+    parser.add_argument("--cache", default="eos_listings.json",
+                        help="Cache of the directory listings ('' to disable). Default: %(default)s")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser("List the files below EOS directories")
+    parser.add_argument("dirs", nargs="+", help="Directories to search")
+    parser.add_argument("--suffix", default=".root", help="Suffix of the files. Default: %(default)s")
+    add_arguments(parser)
+    args = parser.parse_args()
+    start = time.time()
+    found = rec_search(get_backend(args), args.dirs, args.suffix, nthreads=args.nthreads,
+                       cache=ListingCache(args.cache) if args.cache else None)
+    for d in args.dirs:
+        print("\n".join(found[d]))
+    print("Found %d files in %.1f s" % (sum(len(f) for f in found.values()), time.time() - start))
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os
+import json
+import zlib
+import logging
+import subprocess
+
+
+def lfn(filename):
+    """Logical file name (/store/...) of a file, whatever the redirector or EOS prefix used to open it"""
+    if '/store/' in filename:
+        return '/store/' + filename.split('/store/', 1)[1]
+    return filename
+
+
+def file_stat(path):
+    """Size and modification time of a local (or fuse mounted) file, None for remote files"""
+    if '://' in path or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return {'bytes': st.st_size, 'mtime': int(st.st_mtime)}
+
+
+def adler32(path):
+    """adler32 checksum of a file, as the 8 hex digits used by xrootd and EOS"""
+    if path.startswith('root://'):
+        # let the server compute it instead of reading the file
+        host, name = path[len('root://'):].split('/', 1)
+        out = subprocess.check_output(['xrdfs', host, 'query', 'checksum', '/' + name.lstrip('/')])
+        return out.decode().split()[1].zfill(8)
+    value = 1
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            value = zlib.adler32(block, value)
+    return '%08x' % (value & 0xffffffff)
+
+
+def scan_file(path, treename='Events', checksum=False):
+    """
+    Read the metadata of one input file from its header: number of entries,
+    size, first entry of each cluster of the tree, branches and compression
+    settings, plus the adler32 checksum if requested.
+    """
+    import ROOT
+    ROOT.PyConfig.IgnoreCommandLineOptions = True
+    f = ROOT.TFile.Open(path)
+    if not f or f.IsZombie():
+        raise IOError('Cannot open file %s' % path)
+    info = {'bytes': int(f.GetSize()), 'compression': int(f.GetCompressionSettings())}
+    tree = f.Get(treename)
+    if tree:
+        info['entries'] = int(tree.GetEntries())
+        info['branches'] = sorted(b.GetName() for b in tree.GetListOfBranches())
+        clusters = []
+        it = tree.GetClusterIterator(0)
+        start = it()
+        while start < info['entries']:
+            clusters.append(int(start))
+            start = it()
+        info['clusters'] = clusters
+    else:
+        info['entries'] = 0
+    f.Close()
+    if checksum:
+        info['adler32'] = adler32(path)
+    return info
+
+
+def _scan(job):
+    name, path, treename, checksum = job
+    try:
+        info = scan_file(path, treename, checksum)
+        stat = file_stat(name)
+        if stat:
+            info['mtime'] = stat['mtime']
+        return name, info
+    except Exception as e:
+        logging.warning('Failed to scan %s: %s' % (path, str(e)))
+        return name, None
+
+
+class FileCatalog(object):
+    '''
+    Metadata of the input files keyed by LFN, kept in a json file so that each
+    file is opened only once across submissions. For each file:
+        - 'entries', 'bytes', 'compression'
+        - 'clusters': first entry of each cluster of the tree
+        - 'branches': names of the top level branches
+        - 'adler32': checksum, only if scanned with checksum=True
+        - 'mtime': for local files, to notice files that were rewritten
+        - 'sums': sums of the weights of the Runs tree, see mergeplan.file_sums
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f)
+
+    def __contains__(self, filename):
+        return lfn(filename) in self.files
+
+    def get(self, filename):
+        return self.files.get(lfn(filename))
+
+    def update(self, filename, info, replace=False):
+        if replace:
+            self.files[lfn(filename)] = info
+        else:
+            self.files.setdefault(lfn(filename), {}).update(info)
+
+    def save(self):
+        if not self.path:
+            return
+        # write to a temporary file first, the catalogue may be shared by several submissions
+        tmppath = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmppath, 'w') as f:
+            json.dump(self.files, f, indent=1, sort_keys=True)
+        os.rename(tmppath, self.path)
+
+    def is_current(self, filename, checksum=False):
+        '''True if the file is in the catalogue with all the fields, and unchanged if local'''
+        info = self.get(filename)
+        if not info or ('clusters' not in info and info.get('entries')):
+            return False
+        if checksum and 'adler32' not in info:
+            return False
+        stat = file_stat(filename)
+        if stat and (stat['bytes'] != info.get('bytes') or stat['mtime'] != info.get('mtime')):
+            return False
+        return True
+
+    def scan(self, filenames, nprocs=8, rescan=False, checksum=False, treename='Events'):
+        '''Open the headers of the files missing from the catalogue with nprocs processes'''
+        from processor import xrd_prefix
+        missing = [f for f in filenames if rescan or not self.is_current(f, checksum)]
+        if not missing:
+            return
+        logging.info('Scanning %d files with %d processes' % (len(missing), nprocs))
+        jobs = [(f, xrd_prefix(f)[0][0], treename, checksum) for f in missing]
+        if nprocs > 1 and len(jobs) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(nprocs, len(jobs)))
+            try:
+                results = pool.imap_unordered(_scan, jobs)
+                for i, (name, info) in enumerate(results):
+                    if info is not None:
+                        # drop what was derived from the previous version of the file
+                        self.update(name, info, replace=True)
+                    if (i + 1) % 100 == 0:
+                        logging.info('Scanned %d/%d files' % (i + 1, len(jobs)))
+                        # keep what was scanned if interrupted
+                        self.save()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for name, info in map(_scan, jobs):
+                if info is not None:
+                    self.update(name, info, replace=True)
+        self.save()
+
+    def _field(self, filename, key):
+        info = self.get(filename)
+        return info.get(key) if info else None
+
+    def entries(self, filename):
+        return self._field(filename, 'entries')
+
+    def bytes(self, filename):
+        return self._field(filename, 'bytes')
+
+    def clusters(self, filename):
+        return self._field(filename, 'clusters')
+
+    def compression(self, filename):
+        return self._field(filename, 'compression')
+
+    def branches(self, filename):
+        return self._field(filename, 'branches')
+
+    def checksum(self, filename):
+        return self._field(filename, 'adler32')
+
+
+def split_ranges(n, nsplit, clusters=None):
+    '''
+    Split n entries into nsplit (first, count) ranges of about the same size,
+    starting on the cluster boundaries if given so that no cluster is read
+    by two jobs.
+    '''
+    bounds = [(k * n) // nsplit for k in range(nsplit)]
+    if clusters:
+        import bisect
+        snapped = []
+        for b in bounds:
+            i = bisect.bisect_left(clusters, b)
+            candidates = clusters[max(i - 1, 0):i + 1]
+            snapped.append(min(candidates, key=lambda c: abs(c - b)))
+        bounds = sorted(set([0] + snapped))
+    bounds.append(n)
+    return [(first, last - first) for first, last in zip(bounds[:-1], bounds[1:]) if last > first]
+
+
+def plan_jobs(files, catalog, events_per_job):
+    '''
+    Split files into jobs of about events_per_job events.
+
+    Files are packed whole, in order, as long as the job stays below the
+    target. Files larger than the target get jobs of their own, each
+    processing an entry range (firstEntry, maxEntries) of the file aligned
+    on the cluster boundaries. Files with an unknown number of entries get
+    a job each.
+
+    Returns a list of dicts with 'inputfiles' and, for entry ranges,
+    'firstEntry' and 'maxEntries'.
+    '''
+    jobs = []
+    pack, pack_events = [], 0
+    for f in files:
+        n = catalog.entries(f)
+        if (n is None or n > events_per_job or pack_events + n > events_per_job) and pack:
+            # keep the jobs in the order of the files
+            jobs.append({'inputfiles': pack})
+            pack, pack_events = [], 0
+        if n is None:
+            logging.warning('Number of entries of %s unknown, using one job for it' % f)
+            jobs.append({'inputfiles': [f]})
+            continue
+        if n > events_per_job:
+            nsplit = -(-n // events_per_job)
+            for first, count in split_ranges(n, nsplit, catalog.clusters(f)):
+                jobs.append({'inputfiles': [f], 'firstEntry': first, 'maxEntries': count})
+            continue
+        pack.append(f)
+        pack_events += n
+    if pack:
+        jobs.append({'inputfiles': pack})
+    return jobs
+
+
+def plan_merge(files, catalog, max_bytes):
+    '''
+    Group files, in order, into merges of at most max_bytes each (a file
+    larger than that is a group on its own). Files with different compression
+    settings go to different groups, so haddnano.py can copy the baskets
+    without recompressing them.
+    '''
+    groups = []
+    group, group_bytes, group_compression = [], 0, None
+    for f in files:
+        size = catalog.bytes(f) or 0
+        compression = catalog.compression(f)
+        if group and (group_bytes + size > max_bytes or compression != group_compression):
+            groups.append(group)
+            group, group_bytes = [], 0
+        group.append(f)
+        group_bytes += size
+        group_compression = compression
+    if group:
+        groups.append(group)
+    return groups
+
+
+def read_inputs(inputs):
+    '''Expand the command line inputs: root files, or text files listing one file per line'''
+    filenames = []
+    for name in inputs:
+        if name.endswith('.root'):
+            filenames.append(name)
+        else:
+            with open(name) as f:
+                filenames.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    return filenames
+
+
+def main(args):
+    catalog = FileCatalog(args.catalog)
+    filenames = read_inputs(args.inputs)
+    catalog.scan(filenames, nprocs=args.nprocs, rescan=args.rescan, checksum=args.checksum, treename=args.treename)
+    missing = [f for f in filenames if f not in catalog]
+    nbytes = sum(catalog.bytes(f) or 0 for f in filenames)
+    nentries = sum(catalog.entries(f) or 0 for f in filenames)
+    print('%d files, %d entries, %.1f GB in %s' % (len(filenames), nentries, nbytes / 1.e9, args.catalog))
+    if missing:
+        print('Failed to scan %d files:\n  %s' % (len(missing), '\n  '.join(missing)))
+
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser('Fill the catalogue of input file metadata')
+    parser.add_argument('inputs', nargs='+',
+        help='Root files, or file lists (e.g. list/*.list) with one file per line'
+    )
+    parser.add_argument('-c', '--catalog', default='filecatalog.json',
+        help='Catalogue to fill. Default: %(default)s'
+    )
+    parser.add_argument('-j', '--nprocs', type=int, default=8,
+        help='Number of files scanned in parallel. Default: %(default)s'
+    )
+    parser.add_argument('--checksum', action='store_true', default=False,
+        help='Also compute the adler32 checksum of the files (reads them fully if local)'
+    )
+    parser.add_argument('--rescan', action='store_true', default=False,
+        help='Scan again the files already in the catalogue'
+    )
+    parser.add_argument('--treename', default='Events',
+        help='Name of the tree. Default: %(default)s'
+    )
+    main(parser.parse_args())
@@ -1,8 +1,6 @@
-import os
-import subprocess
 import json
+from eos_discovery import rec_search, get_backend, add_arguments, ListingCache
 
-eosbase = "root://cmseos.fnal.gov/"
 eosdir = "/store/user/lpcdihiggsboost/cmantill/PFNano/"
 
 dirlist = [
@@ -72,35 +70,30 @@ dirlist = [
   ]],
 ]
 
-def eos_rec_search(startdir,suffix,skiplist,dirs):
-    dirlook = subprocess.check_output("eos %s ls %s"%(eosbase,startdir), shell=True).decode('utf-8').split("\n")[:-1]
-    donedirs = [[] for d in dirlook]
-    di = 0
-    for d in dirlook:
-        if d.endswith(suffix):
-            donedirs[di].append(startdir+"/"+d)
-        #elif any(skip in d for skip in skiplist):
-        #    print("Skipping %s"%d)
-        else:
-            print("Searching %s"%d)
-            donedirs[di] = donedirs[di] + eos_rec_search(startdir+"/"+d,suffix,skiplist,dirs+donedirs[di])
-        di = di + 1
-    donedir = [d for da in donedirs for d in da]
-    return dirs+donedir
+def main(args):
+    backend = get_backend(args)
+    cache = ListingCache(args.cache) if args.cache else None
+    for dirs in dirlist:
+        samples = [name for name, is_dir, _ in sorted(backend.listdir("%s%s" % (eosdir, dirs[0])))]
+        samples = [s for s in samples if s in dirs[2]]
+        for s in samples:
+            print("\tRunning on %s" % s)
+        # all the samples of the campaign are searched concurrently
+        curdirs = ["%s%s/%s" % (eosdir, dirs[0], s) for s in samples]
+        found = rec_search(backend, curdirs, ".root", skip=(), nthreads=args.nthreads, cache=cache)
+        jdict = {}
+        for s, curdir in zip(samples, curdirs):
+            if not found[curdir]:
+                print("Empty sample %s skipped" % s)
+            else:
+                jdict[s] = [args.eosbase + d for d in found[curdir]]
+        print(dirs[1], [s for s in jdict])
+        with open("fileset/%s.json" % (dirs[1]), 'w') as outfile:
+            json.dump(jdict, outfile, indent=4, sort_keys=True)
 
-for dirs in dirlist:
-    samples = subprocess.check_output("eos %s ls %s%s"%(eosbase,eosdir,dirs[0]), shell=True).decode('utf-8').split("\n")[:-1]
-    jdict = {}
-    for s in samples:
-        if s not in dirs[2]: continue
-        print("\tRunning on %s"%s)
-        curdir = "%s%s/%s"%(eosdir,dirs[0],s)
-        print('curdir ',curdir)
-        dirlog = eos_rec_search(curdir,".root",dirs[2],[])
-        if not dirlog:
-            print("Empty sample skipped")
-        else: 
-            jdict[s] = [eosbase+d for d in dirlog]
-    print(dirs[1],[s for s in jdict])
-    with open("fileset/%s.json"%(dirs[1]), 'w') as outfile:
-        json.dump(jdict, outfile, indent=4, sort_keys=True)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser("Write the fileset/*.json lists of the samples on EOS")
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os
+import json
+import logging
+
+STATE_FILE = 'status_index.json'
+SUMMARY_FILE = 'status_summary.json'
+# bytes before the offset kept to notice files rewritten since the last scan
+TAIL_SIZE = 64
+
+
+def new_entry():
+    return {'offset': 0, 'tail': '', 'finished': False, 'errormsg': None, 'jobs': {}}
+
+
+def parse_log_line(entry, line):
+    '''
+    Update the status of a condor job with one line of its log, read forward.
+    Same result as reading the log backwards up to the last submission or
+    return value.
+    '''
+    if 'Job submitted from host' in line:
+        # the job has been resubmitted
+        entry['finished'], entry['errormsg'] = False, None
+    elif 'return value' in line:
+        entry['finished'] = 'return value 0' in line
+        entry['errormsg'] = None if entry['finished'] else line
+    elif ('Job removed' in line or 'aborted' in line) and entry['errormsg'] is None:
+        entry['errormsg'] = line
+
+
+def parse_out_line(entry, line):
+    '''Status of the jobs of a condor job running several jobs, printed by processor.py'''
+    if line.startswith('Job ') and ' terminated: ' in line:
+        entry['jobs'][line.split()[1]] = line
+
+
+def scan_file(path, entry, size=None):
+    '''Parse the lines appended to path since the last scan, return the updated entry'''
+    if size is None:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+    if entry is None or size < entry['offset']:
+        entry = new_entry()
+    if size == entry['offset']:
+        return entry
+    with open(path, 'rb') as f:
+        start = max(entry['offset'] - TAIL_SIZE, 0)
+        f.seek(start)
+        data = f.read()
+    if data[:entry['offset'] - start].decode('utf-8', 'replace') != entry['tail']:
+        # rewritten (e.g. the output of a resubmitted job)
+        entry = new_entry()
+        start = 0
+        with open(path, 'rb') as f:
+            data = f.read()
+    data = data[entry['offset'] - start:]
+    # only complete lines, the rest is read at the next scan
+    end = data.rfind(b'\n') + 1
+    parse = parse_out_line if path.endswith('.out') else parse_log_line
+    for line in data[:end].decode('utf-8', 'replace').splitlines(True):
+        parse(entry, line)
+    entry['offset'] += end
+    with open(path, 'rb') as f:
+        f.seek(max(entry['offset'] - TAIL_SIZE, 0))
+        entry['tail'] = f.read(min(entry['offset'], TAIL_SIZE)).decode('utf-8', 'replace')
+    return entry
+
+
+class JobStatusTracker(object):
+    '''
+    Status of the condor jobs of a job directory from their logs.
+
+    The byte offset up to which each log was parsed and the status found
+    are kept in jobdir/status_index.json, so each update only reads the
+    lines appended since the previous one. The counts and lists of job ids
+    are written to jobdir/status_summary.json for a quick query.
+    '''
+
+    def __init__(self, jobdir):
+        self.jobdir = jobdir
+        self.path = os.path.join(jobdir, STATE_FILE)
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.files = json.load(f)
+
+    def save(self, summary):
+        for name, content in ((self.path, self.files), (os.path.join(self.jobdir, SUMMARY_FILE), summary)):
+            tmppath = '%s.%d.tmp' % (name, os.getpid())
+            with open(tmppath, 'w') as f:
+                # dumps uses the C encoder, much faster than dump for 10^5 entries
+                f.write(json.dumps(content))
+            os.rename(tmppath, name)
+
+    def scan(self, sizes, nthreads=8):
+        '''Parse the new lines of the files of jobdir that grew or changed (sizes: name -> size), nthreads at a time'''
+        from concurrent.futures import ThreadPoolExecutor
+
+        for name in list(self.files):
+            if name not in sizes:
+                del self.files[name]
+        changed = [name for name in sorted(sizes) if name not in self.files or self.files[name]['offset'] != sizes[name]]
+        if not changed:
+            return
+
+        def _scan(name):
+            return name, scan_file(os.path.join(self.jobdir, name), self.files.get(name), sizes[name])
+
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            for name, entry in pool.map(_scan, changed):
+                self.files[name] = entry
+        logging.debug('Read %d of %d files in %s' % (len(changed), len(sizes), self.jobdir))
+
+    def update(self, njobs, nthreads=8):
+        '''Scan the logs and return a dict status ('running', 'failed', 'completed') -> list of job ids'''
+        sizes, mtimes = {}, {}
+        for f in os.scandir(self.jobdir):
+            if f.name.endswith('.log') or (f.name.endswith('.out') and '+' in f.name):
+                st = f.stat()
+                sizes[f.name], mtimes[f.name] = st.st_size, st.st_mtime
+        self.scan(sizes, nthreads)
+
+        # condor jobs running several jobs (--jobs-per-slot) are named "id1+id2+..."
+        logs = {}
+        for name in mtimes:
+            if name.endswith('.log'):
+                for jobid in name[:-len('.log')].split('+'):
+                    if jobid.isdigit():
+                        logs.setdefault(int(jobid), []).append(name)
+
+        jobids = {'running': [], 'failed': [], 'completed': []}
+        for jobid in range(njobs):
+            if jobid not in logs:
+                logging.debug('Cannot find log file %d.log' % jobid)
+                jobids['failed'].append(str(jobid))
+                continue
+            # the last submission of this job
+            logname = max(logs[jobid], key=lambda name: mtimes[name])
+            entry = self.files[logname]
+            finished, errormsg = entry['finished'], entry['errormsg']
+            if '+' in logname:
+                # status of the job itself, printed by processor.py in the output of the condor job
+                outname = logname[:-len('.log')] + '.out'
+                if outname in self.files:
+                    line = self.files[outname]['jobs'].get(str(jobid))
+                    if line:
+                        finished = 'return value 0' in line
+                        errormsg = None if finished else line
+                    elif finished:
+                        finished, errormsg = False, 'No status of job %d in %s' % (jobid, outname)
+            if errormsg:
+                logging.debug(os.path.join(self.jobdir, logname) + '\n   ' + errormsg)
+                jobids['failed'].append(str(jobid))
+            elif finished:
+                jobids['completed'].append(str(jobid))
+            else:
+                jobids['running'].append(str(jobid))
+
+        self.save({'njobs': njobs, 'jobids': jobids})
+        return jobids
+
+
+def summary(jobdir):
+    '''Status of the jobs at the last update, without reading the logs'''
+    with open(os.path.join(jobdir, SUMMARY_FILE)) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser('Status of the condor jobs of a job directory')
+    parser.add_argument('-j', '--jobdir', default='jobs',
+        help='Directory for job files. Default: %(default)s'
+    )
+    parser.add_argument('--summary', action='store_true', default=False,
+        help='Print the status at the last update without reading the logs'
+    )
+    parser.add_argument('--nthreads', type=int, default=8,
+        help='Number of logs read in parallel. Default: %(default)s'
+    )
+    parser.add_argument('--metadata', default='metadata.json',
+        help='Metadata file in jobdir, for the number of jobs. Default: %(default)s'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
+    if args.summary:
+        info = summary(args.jobdir)
+    else:
+        with open(os.path.join(args.jobdir, args.metadata)) as f:
+            njobs = len(json.load(f)['jobs'])
+        info = {'njobs': njobs, 'jobids': JobStatusTracker(args.jobdir).update(njobs, args.nthreads)}
+    print('%d jobs: %s' % (info['njobs'], {k: len(v) for k, v in info['jobids'].items() if v}))
+    if info['jobids']['failed']:
+        print('failed: %s' % ','.join(info['jobids']['failed']))
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os
+import json
+import math
+import time
+import hashlib
+import logging
+import subprocess
+
+STATE_FILE = 'merge_state.json'
+# pieces merged into each part, to merge the friend trees of a systematics pass the same way
+GROUPS_FILE = 'merge_groups.json'
+
+
+def file_sums(fname):
+    '''
+    Sums needed for the weights of one file, from one read of its Runs tree
+    (and of the nEvents/sumLHE counters, if present):
+        - 'genEventSumw', 'genEventCount'
+        - 'LHEScaleSumw', 'LHEPdfSumw': vectors of sum(LHE*Sumw[i] * genEventSumw)
+        - 'nEvents': content of the nEvents histogram, None if absent
+        - 'sumLHE': vector of the LHEScaleSumw of the sumLHE tree (see countHistogramsProducer)
+    '''
+    import numpy as np
+    import ROOT
+    ROOT.PyConfig.IgnoreCommandLineOptions = True
+    from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
+
+    def _read(tfile, treename, branches):
+        tree = tfile.Get(treename)
+        branches = [b for b in branches if tree.GetBranch(b)]
+        reader = ChunkReader(tfile, branches, max(tree.GetEntries(), 1), treeName=treename)
+        chunk = reader.read(0)
+        reader.close()
+        return chunk
+
+    def _vector_sum(chunk, name, weights):
+        # sum over the entries of the values of each index, with as many indices as in the first entry
+        if name not in chunk or not chunk.n:
+            return []
+        lenVar = chunk.lenVars[name]
+        offsets = chunk.offsets[lenVar]
+        index = np.arange(offsets[-1]) - offsets[chunk.eventIndex(lenVar)]
+        values = chunk[name] * weights[chunk.eventIndex(lenVar)]
+        return [math.fsum(values[index == i]) for i in range(offsets[1])]
+
+    f = ROOT.TFile.Open(fname)
+    runs = _read(f, 'Runs', ['genEventSumw', 'genEventCount', 'LHEScaleSumw', 'LHEPdfSumw'])
+    sumw = runs['genEventSumw'] if 'genEventSumw' in runs else np.zeros(runs.n)
+    sums = {'genEventSumw': math.fsum(sumw),
+            'genEventCount': math.fsum(runs['genEventCount']) if 'genEventCount' in runs else 0.,
+            'LHEScaleSumw': _vector_sum(runs, 'LHEScaleSumw', sumw),
+            'LHEPdfSumw': _vector_sum(runs, 'LHEPdfSumw', sumw),
+            'nEvents': None, 'sumLHE': []}
+    h = f.Get('nEvents')
+    if h:
+        sums['nEvents'] = h.GetBinContent(1)
+    lhe = f.Get('sumLHE')
+    if lhe and lhe.GetBranch('LHEScaleSumw'):
+        # one entry per merged file, as the Runs tree
+        chunk = _read(f, 'sumLHE', ['LHEScaleSumw'])
+        sums['sumLHE'] = _vector_sum(chunk, 'LHEScaleSumw', np.ones(chunk.n))
+    elif lhe:
+        # sumweight_<i> branches written by earlier versions of countHistogramsProducer
+        names = [b.GetName() for b in lhe.GetListOfBranches() if b.GetName().startswith('sumweight_')]
+        names.sort(key=lambda name: int(name.split('_')[1]))
+        chunk = _read(f, 'sumLHE', names)
+        sums['sumLHE'] = [math.fsum(chunk[name]) for name in names]
+    f.Close()
+    return sums
+
+
+def reduce_sums(sums_list):
+    '''
+    Sums of a sample from the sums of its files, see file_sums. The sums are
+    exact (math.fsum), so they do not depend on how the files were grouped.
+    '''
+    sums_list = list(sums_list)
+    total = {}
+    for name in ('genEventSumw', 'genEventCount'):
+        total[name] = math.fsum(sums[name] for sums in sums_list)
+    for name in ('LHEScaleSumw', 'LHEPdfSumw', 'sumLHE'):
+        # the number of values is the one of the first file having them, as when reading the merged trees
+        n = len(next((sums[name] for sums in sums_list if sums[name]), []))
+        total[name] = [math.fsum(sums[name][i] for sums in sums_list if i < len(sums[name])) for i in range(n)]
+    nevents = [sums['nEvents'] for sums in sums_list if sums['nEvents'] is not None]
+    total['nEvents'] = math.fsum(nevents) if nevents else None
+    return total
+
+
+def sample_sums(filenames, cached=None):
+    '''Sums of each file (see file_sums), computing only those missing from cached (file -> sums)'''
+    cached = cached or {}
+    return dict((fname, cached.get(fname) or file_sums(fname)) for fname in filenames)
+
+
+def weight_branches(sums, xsec, lumi=1.):
+    '''(name, lenVar, values) of the weight branches of a sample, filled as constant branches when merging (see run_node)'''
+    sumwgts = sums['genEventSumw']
+    print('fill xsec ', xsec, ' lumi ', lumi, ' sumwgts ', sumwgts, ' sumevts ', sums['genEventCount'])
+    branches = [('xsecWeight', None, [xsec * lumi / sumwgts])]
+    if sums['nEvents'] is not None and sums['sumLHE'] and sums['LHEScaleSumw']:
+        branches.append(('LHEScaleWeightNormNew', 'nLHEScaleWeight',
+                         [sums['nEvents'] / s for s in sums['sumLHE'][:len(sums['LHEScaleSumw'])]]))
+    if sums['LHEScaleSumw']:
+        branches.append(('LHEScaleWeightNorm', 'nLHEScaleWeight', [sumwgts / s for s in sums['LHEScaleSumw']]))
+    if sums['LHEPdfSumw']:
+        branches.append(('LHEPdfWeightNorm', 'nLHEPdfWeight', [sumwgts / s for s in sums['LHEPdfSumw']]))
+    for name, _, values in branches:
+        logging.info('%s: %s' % (name, str(values)))
+    return branches
+
+
+def _hash(filenames):
+    return hashlib.md5('\n'.join(filenames).encode('utf-8')).hexdigest()[:8]
+
+
+def plan_sample(samp, pieces, catalog, parts_dir, max_bytes, fan_in=100, xsec=None, groups=None):
+    '''
+    Merge tree of a sample: the pieces are grouped by size (or as given by
+    groups) into the final parts ({samp}_tree.root, or {samp}_tree_<i>.root
+    if there are several), each merged from at most fan_in files, with intermediate merges in
+    parts_dir/.merge_tmp if needed. With weights, a 'sums' node reading the
+    Runs trees of all the pieces comes before the final merges, which add
+    the weight branches for the cross section xsec (None: no weights).
+
+    Returns a dict node id -> node, a node being a dict with 'type' ('sums'
+    or 'merge'), 'inputs', 'output', 'deps' (ids of the nodes to run
+    before) and for the final merges 'final', 'weights' and 'xsec'.
+    '''
+    from filecatalog import plan_merge
+    tmpdir = os.path.join(parts_dir, '.merge_tmp')
+    nodes = {}
+    sums_id = None
+    weights = xsec is not None
+    if weights:
+        sums_id = '%s/sums' % samp
+        nodes[sums_id] = {'type': 'sums', 'inputs': pieces, 'deps': [], 'samp': samp}
+    if groups is None:
+        groups = plan_merge(pieces, catalog, max_bytes)
+    for idx, group in enumerate(groups):
+        inputs, deps = group, []
+        level = 0
+        while len(inputs) > fan_in:
+            # intermediate merges, named by their inputs so that they are reused only for the same inputs
+            next_inputs, next_deps = [], []
+            for k in range(0, len(inputs), fan_in):
+                chunk = inputs[k:k + fan_in]
+                node_id = '%s/part%d/l%d_%d' % (samp, idx, level, k // fan_in)
+                output = os.path.join(tmpdir, '%s_%d_l%d_%d_%s.root' % (samp, idx, level, k // fan_in, _hash(chunk)))
+                nodes[node_id] = {'type': 'merge', 'inputs': chunk, 'output': output, 'samp': samp,
+                                  'deps': [d for d in deps if nodes[d]['output'] in chunk]}
+                next_inputs.append(output)
+                next_deps.append(node_id)
+            inputs, deps = next_inputs, next_deps
+            level += 1
+        name = '%s_tree.root' % samp if len(groups) == 1 else '%s_tree_%d.root' % (samp, idx)
+        nodes['%s/part%d' % (samp, idx)] = {'type': 'merge', 'inputs': inputs, 'output': os.path.join(parts_dir, name),
+                                           'deps': deps + ([sums_id] if sums_id else []), 'samp': samp,
+                                           'final': True, 'weights': weights, 'xsec': xsec}
+    return nodes
+
+
+def save_groups(parts_dir, samp, groups):
+    '''Keep the names of the pieces merged into each part of samp in parts_dir/merge_groups.json'''
+    path = os.path.join(parts_dir, GROUPS_FILE)
+    content = load_groups(parts_dir)
+    content[samp] = [[os.path.basename(f) for f in group] for group in groups]
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmppath, 'w') as f:
+        json.dump(content, f, indent=1, sort_keys=True)
+    os.rename(tmppath, path)
+
+
+def load_groups(parts_dir):
+    '''Names of the pieces merged into each part, by sample, see save_groups'''
+    path = os.path.join(parts_dir, GROUPS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def friend_groups(pieces, nominal_groups):
+    '''
+    Group the friend pieces as the nominal pieces of the same names, so that
+    each friend part is aligned with the nominal part of the same name.
+    Returns None if the pieces do not match the nominal ones.
+    '''
+    byname = dict((os.path.basename(f), f) for f in pieces)
+    groups = [[byname.get(os.path.basename(name)) for name in group] for group in nominal_groups]
+    if any(None in group for group in groups) or sum(len(group) for group in groups) != len(pieces):
+        return None
+    return groups
+
+
+def run_node(node):
+    '''Run one node of the merge tree (in a worker process), return the sums for the 'sums' nodes'''
+    if node['type'] == 'sums':
+        return sample_sums(node['inputs'], node.get('cached'))
+    outdir = os.path.dirname(node['output'])
+    if not os.path.exists(outdir):
+        try:
+            os.makedirs(outdir)
+        except OSError:
+            pass
+    # list of inputs in a file, the command line may be too long; write to a temporary output first
+    listfile = node['output'].replace('.root', '_inputs.txt')
+    tmpoutput = node['output'] + '.tmp'
+    with open(listfile, 'w') as f:
+        f.write('\n'.join(node['inputs']) + '\n')
+    cmd = ['haddnano.py']
+    for name, lenVar, values in node.get('branches', []):
+        cmd.append('--const-branch=%s%s=%s' % (name, '[%s]' % lenVar if lenVar else '', ','.join('%r' % v for v in values)))
+    cmd += [tmpoutput, listfile]
+    logging.debug('...' + ' '.join(cmd))
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    log = p.communicate()[0]
+    log_lower = log.lower().decode('utf-8')
+    if 'error' in log_lower or 'fail' in log_lower:
+        logging.error(log)
+    os.remove(listfile)
+    if p.returncode != 0:
+        if os.path.exists(tmpoutput):
+            os.remove(tmpoutput)
+        raise RuntimeError('Hadd failed on %s!' % node['output'])
+    os.rename(tmpoutput, node['output'])
+    return None
+
+
+def _run_node(node):
+    try:
+        return True, run_node(node)
+    except Exception as e:
+        return False, str(e)
+
+
+def _file_id(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path
+    return '%s:%d:%d' % (path, st.st_size, int(st.st_mtime))
+
+
+def node_key(nodes, node_id):
+    '''
+    Hash of what the result of a node depends on: the pieces below it (name,
+    size and modification time), and the cross section for the final merges.
+    The intermediate merges enter by their own keys, so the key of a final
+    merge stays the same once they are cleaned up.
+    '''
+    node = nodes[node_id]
+    outputs = dict((nodes[d]['output'], d) for d in node['deps'] if 'output' in nodes[d])
+    ids = [node_key(nodes, outputs[f]) if f in outputs else _file_id(f) for f in node['inputs']]
+    if node.get('final'):
+        ids.append('xsec=%r' % node.get('xsec'))
+    return _hash(ids)
+
+
+class MergeState(object):
+    '''Completed nodes of the merge trees (and the sums of the samples) kept in parts_dir/merge_state.json to resume'''
+
+    def __init__(self, parts_dir):
+        self.path = os.path.join(parts_dir, STATE_FILE)
+        self.nodes = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.nodes = json.load(f)
+
+    def is_done(self, nodes, node_id):
+        '''Done from the same pieces and weights: redone when pieces were added or rewritten, or the weights changed'''
+        done = self.nodes.get(node_id)
+        if not done or done.get('inputs') != node_key(nodes, node_id):
+            return False
+        # outputs are renamed once complete
+        return nodes[node_id]['type'] == 'sums' or os.path.exists(nodes[node_id]['output'])
+
+    def set_done(self, nodes, node_id, result=None):
+        self.nodes[node_id] = {'inputs': node_key(nodes, node_id), 'time': time.time()}
+        if result is not None:
+            self.nodes[node_id]['result'] = result
+        tmppath = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmppath, 'w') as f:
+            json.dump(self.nodes, f, indent=1, sort_keys=True)
+        os.rename(tmppath, self.path)
+
+    def result(self, node_id):
+        return self.nodes[node_id].get('result')
+
+
+def run_plan(nodes, state, nprocs=4, catalog=None):
+    '''
+    Run the nodes of the merge trees with nprocs worker processes, each as
+    soon as the nodes it depends on are done. The sums of each file are
+    cached in the catalogue if given. Returns the ids of the failed nodes.
+    '''
+    import multiprocessing
+    done = set(node_id for node_id in nodes if state.is_done(nodes, node_id))
+    # only the steps leading to missing final merges are needed
+    pending = set()
+    stack = [node_id for node_id, node in nodes.items() if node.get('final') and node_id not in done]
+    while stack:
+        node_id = stack.pop()
+        if node_id not in pending and node_id not in done:
+            pending.add(node_id)
+            stack.extend(nodes[node_id]['deps'])
+    if len(pending) < len(nodes):
+        logging.info('Resuming: %d of %d merge steps to run' % (len(pending), len(nodes)))
+    failed = set()
+    running = {}
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        while pending or running:
+            for node_id in sorted(pending):
+                node = nodes[node_id]
+                if any(d in failed for d in node['deps']):
+                    logging.error('Skipping %s, a merge step before it failed' % node_id)
+                    pending.discard(node_id)
+                    failed.add(node_id)
+                elif all(d in done for d in node['deps']):
+                    pending.discard(node_id)
+                    if node.get('weights'):
+                        try:
+                            node['branches'] = weight_branches(state.result('%s/sums' % node['samp']), node['xsec'])
+                        except ZeroDivisionError:
+                            logging.error('Cannot compute the weights of %s: zero sum of weights' % node['samp'])
+                            failed.add(node_id)
+                            continue
+                    if node['type'] == 'sums' and catalog:
+                        node['cached'] = dict((f, catalog.get(f)['sums']) for f in node['inputs']
+                                              if catalog.is_current(f) and 'sums' in catalog.get(f))
+                    logging.info('Running %s (%d inputs)' % (node_id, len(node['inputs'])))
+                    running[node_id] = pool.apply_async(_run_node, (node,))
+            time.sleep(0.2)
+            for node_id in [n for n in running if running[n].ready()]:
+                success, result = running.pop(node_id).get()
+                if success:
+                    if nodes[node_id]['type'] == 'sums':
+                        if catalog:
+                            for f, sums in result.items():
+                                catalog.update(f, {'sums': sums})
+                            catalog.save()
+                        result = reduce_sums([result[f] for f in nodes[node_id]['inputs']])
+                    done.add(node_id)
+                    state.set_done(nodes, node_id, result)
+                else:
+                    logging.error('%s failed: %s' % (node_id, result))
+                    failed.add(node_id)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+def cleanup(nodes, failed):
+    '''Remove the intermediate merges of the samples whose final merges are all done'''
+    samples = set(node['samp'] for node in nodes.values())
+    for samp in samples:
+        if any(nodes[n]['samp'] == samp for n in failed):
+            continue
+        for node in nodes.values():
+            if node['samp'] == samp and node['type'] == 'merge' and not node.get('final') and os.path.exists(node['output']):
+                os.remove(node['output'])
@@ -44,13 +44,89 @@ def outputName(md, jobid):
     return '{samp}_{idx}_tree.root'.format(samp=info['samp'], idx=info['idx'])
 
 
-def main(args):
+class IncrementalMerger(object):
+    '''
+    Merge the output files of the PostProcessor into outputname in a
+    background thread while the next files are processed.
 
-    # load job metadata
-    with open(args.metadata) as fp:
-        md = json.load(fp)
+    The files waiting in the queue are merged together in one haddnano.py
+    call, into the partial result, once they hold at least as many bytes as
+    it: the partial file is then rewritten a logarithmic number of times,
+    so the merging reads and writes about twice the output instead of once
+    per input file. The files still waiting are merged when closing.
+    '''
 
-    # load modules
+    def __init__(self, outputname):
+        import threading
+        try:
+            from queue import Queue, Empty
+        except ImportError:
+            from Queue import Queue, Empty
+        self.Empty = Empty
+        self.outputname = outputname
+        self.partial = outputname.replace('.root', '_partial.root')
+        self.nmerged = 0
+        self.pending = []
+        self.error = None
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, filename):
+        self.queue.put(filename)
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            # take all the files written in the meantime
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except self.Empty:
+                    break
+            closing = None in items
+            self.pending.extend(f for f in items if f is not None)
+            if self.error is None and self.pending:
+                pending_bytes = sum(os.path.getsize(f) for f in self.pending)
+                partial_bytes = os.path.getsize(self.partial) if self.nmerged else 0
+                if closing or pending_bytes >= partial_bytes:
+                    try:
+                        self._merge(self.pending)
+                    except Exception as e:
+                        self.error = e
+                    self.pending = []
+            if closing:
+                return
+
+    def _merge(self, filenames):
+        if not self.nmerged and len(filenames) == 1:
+            os.rename(filenames[0], self.partial)
+        else:
+            tmpname = self.partial.replace('.root', '_tmp.root')
+            inputs = ([self.partial] if self.nmerged else []) + filenames
+            p = subprocess.Popen(['haddnano.py', tmpname] + inputs)
+            p.communicate()
+            if p.returncode != 0:
+                raise RuntimeError('Hadd failed!')
+            os.rename(tmpname, self.partial)
+            for f in filenames:
+                os.remove(f)
+        self.nmerged += len(filenames)
+        print('Merged %d output files into %s' % (self.nmerged, self.partial))
+
+    def close(self):
+        '''Merge the files still waiting and move the result to outputname'''
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if not self.nmerged:
+            raise RuntimeError('Hadd failed: no output file!')
+        os.rename(self.partial, self.outputname)
+
+
+def load_modules(md):
     modules = []
     for mod, names in md['imports']:
         import_module(mod)
@@ -62,22 +138,51 @@ def main(args):
             if name in selnames:
                 print("Loading %s from %s " % (name, mod))
                 modules.append(getattr(obj, name)())
+    return modules
+
+
+def process(md, args, jobid, workdir=None):
+    '''Run the postprocessing of one job and hadd its outputs, return the path of the merged file'''
+
+    # load modules
+    modules = load_modules(md)
+
+    # pileup profile of the whole dataset for the modules computing it from the MC (autoPU),
+    # merged once by the pre-pass and shipped with the job; without the pre-pass the first
+    # jobs would all scan the whole dataset, so each job uses (and caches) the profiles of its own files
+    for m in modules:
+        if md.get('puProfileFile') and hasattr(m, 'setDatasetProfile'):
+            m.setDatasetProfile(os.path.abspath(os.path.basename(md['puProfileFile'])), md['jobs'][jobid]['samp'])
+        elif md.get('puProfileCache') and hasattr(m, 'setProfileDataset'):
+            m.setProfileDataset(None, md['puProfileCache'])
 
     # remove any existing root files
-    for f in os.listdir('.'):
+    for f in os.listdir(workdir or '.'):
         if f.endswith('.root'):
             print('Removing file %s' % f)
-            os.remove(f)
+            os.remove(os.path.join(workdir or '.', f))
 
     # run postprocessor
-    inputfiles = args.files if len(args.files) else md['jobs'][args.jobid]['inputfiles']
+    job = md['jobs'][jobid]
+    inputfiles = args.files if len(args.files) else job['inputfiles']
     filepaths, allow_prefetch = xrd_prefix(inputfiles)
     print(filepaths)
-    outputname = outputName(md, args.jobid)
-    branchsel_in = os.path.basename(md['branchsel_in']) if md['branchsel_in'] else None
-    branchsel_out = os.path.basename(md['branchsel_out']) if md['branchsel_out'] else None
+    prefetch = allow_prefetch and md.get('prefetch', False) and job.get('prefetch', True)
+    if prefetch and job.get('bytes'):
+        # the input files are copied to TMPDIR, read them remotely if they do not fit
+        st = os.statvfs(os.environ.get('TMPDIR', '/tmp'))
+        if st.f_bavail * st.f_frsize < 1.2 * job['bytes']:
+            print('Not enough space in TMPDIR to prefetch %.1f GB of input files' % (job['bytes'] / 1.e9))
+            prefetch = False
+    outputname = os.path.join(workdir, outputName(md, jobid)) if workdir else outputName(md, jobid)
+    branchsel_in = os.path.abspath(os.path.basename(md['branchsel_in'])) if md['branchsel_in'] else None
+    branchsel_out = os.path.abspath(os.path.basename(md['branchsel_out'])) if md['branchsel_out'] else None
     tmpoutdir = md.get('tmpoutdir', '.')
     if "$" in tmpoutdir: tmpoutdir = os.environ[tmpoutdir.replace('$','')]
+    if workdir:
+        tmpoutdir = workdir
+    # the outputs are merged while the next input files are processed
+    merger = IncrementalMerger(outputname)
     p = PostProcessor(outputDir=tmpoutdir,
                       inputFiles=filepaths,
                       cut=md.get('cut'),
@@ -89,30 +194,40 @@ def main(args):
                       jsonInput=md.get('json'),
                       provenance=md.get('provenance', False),
                       haddFileName=None,
-                      prefetch=(allow_prefetch and md.get('prefetch', False)),
+                      prefetch=prefetch,
                       longTermCache=md.get('longTermCache', False),
-                      maxEntries=md.get('maxEntries', None),
-                      firstEntry=md.get('firstEntry', 0),
-                      outputbranchsel=branchsel_out
+                      friendIndex=md.get('friendIndex', False),
+                      cacheSize=md.get('cacheSize', 50),
+                      asyncPrefetch=md.get('asyncPrefetch', False),
+                      # entry range of the job if its file was split, else the global one
+                      maxEntries=job.get('maxEntries', md.get('maxEntries', None)),
+                      firstEntry=job.get('firstEntry', md.get('firstEntry', 0)),
+                      outputbranchsel=branchsel_out,
+                      outputCallback=merger.add
                       )
     p.run()
 
     # hadd files
-    p = subprocess.Popen('haddnano.py %s %s' % (outputname, os.path.join(tmpoutdir, '*.root')), shell=True)
-    p.communicate()
-    if p.returncode != 0:
-        raise RuntimeError('Hadd failed!')
+    merger.close()
 
     # keep only the hadd file
     for f in os.listdir(tmpoutdir):
-        if f.endswith('.root') and f != outputname:
+        if f.endswith('.root') and f != os.path.basename(outputname):
             os.remove(os.path.join(tmpoutdir, f))
 
-    # stage out
+    return outputname
+
+
+def stage_out(md, args, outputname):
+    tmpoutdir = md.get('tmpoutdir', '.')
+    if "$" in tmpoutdir: tmpoutdir = os.environ[tmpoutdir.replace('$','')]
     #if md['outputdir'].startswith('/eos'):
     if os.path.abspath(md['outputdir']) != os.path.abspath(tmpoutdir):
-        cmd = 'xrdcp --silent -p -f {outputname} {outputdir}/{outputname}'.format(
-            outputname=outputname, outputdir=xrd_prefix(md['joboutputdir'])[0][0])
+        # xrdcp checks the checksum of the copy against the one of the local file
+        from filecatalog import adler32
+        cmd = 'xrdcp --silent -p -f --cksum adler32:{checksum} {outputname} {outputdir}/{basename}'.format(
+            checksum=adler32(outputname), outputname=outputname, basename=os.path.basename(outputname),
+            outputdir=xrd_prefix(md['joboutputdir'])[0][0])
         print(cmd)
         success = False
         for count in range(args.max_retry):
@@ -121,13 +236,120 @@ def main(args):
             if p.returncode == 0:
                 success = True
                 break
-            else:
-                time.sleep(args.sleep)
+            elif count + 1 < args.max_retry:
+                # exponential backoff
+                wait = args.sleep * 2 ** count
+                print('Stage out failed, retrying in %d s' % wait)
+                time.sleep(wait)
         if not success:
             raise RuntimeError("Stage out FAILED!")
 
         # clean up
         os.remove(outputname)
+    elif os.path.dirname(outputname):
+        # output transferred by condor from the top directory of the job
+        os.rename(outputname, os.path.basename(outputname))
+
+
+def report(jobid, returncode):
+    # same wording as the condor logs, see check_job_status in runPostProcessing.py
+    print('Job %d terminated: return value %d' % (jobid, returncode))
+    sys.stdout.flush()
+
+
+def run_packed(md, args, jobids):
+    '''
+    Run several jobs in this slot, up to nprocs at a time, each in its own
+    process and directory. The merged output of each job is staged out by
+    a separate thread while the other jobs are still running.
+    '''
+    import threading
+    try:
+        from queue import Queue
+    except ImportError:
+        from Queue import Queue
+
+    nprocs = args.nprocs or int(os.environ.get('OMP_NUM_THREADS', len(jobids)))
+    print('Running %d jobs with %d processes' % (len(jobids), nprocs))
+
+    # remove any existing root files
+    for f in os.listdir('.'):
+        if f.endswith('.root'):
+            print('Removing file %s' % f)
+            os.remove(f)
+
+    failed = []
+    stageout_queue = Queue()
+
+    def stager():
+        while True:
+            item = stageout_queue.get()
+            if item is None:
+                return
+            jobid, outputname = item
+            try:
+                stage_out(md, args, outputname)
+                report(jobid, 0)
+            except Exception as e:
+                print('Stage out of job %d failed: %s' % (jobid, str(e)))
+                failed.append(jobid)
+                report(jobid, 1)
+
+    stage_thread = threading.Thread(target=stager)
+    stage_thread.start()
+
+    pending = list(jobids)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < nprocs:
+                jobid = pending.pop(0)
+                workdir = os.path.abspath('job_%d' % jobid)
+                if not os.path.exists(workdir):
+                    os.makedirs(workdir)
+                cmd = [sys.executable, os.path.abspath(__file__), '-m', os.path.abspath(args.metadata),
+                       '--workdir', workdir, '--no-stageout', str(jobid)]
+                logfile = open(os.path.join(workdir, 'processor.log'), 'w')
+                print('Starting job %d' % jobid)
+                running[jobid] = (subprocess.Popen(cmd, stdout=logfile, stderr=subprocess.STDOUT), logfile, workdir)
+            time.sleep(1)
+            for jobid in list(running):
+                proc, logfile, workdir = running[jobid]
+                if proc.poll() is None:
+                    continue
+                del running[jobid]
+                logfile.close()
+                with open(logfile.name) as f:
+                    print('==== Output of job %d ====\n%s' % (jobid, f.read()))
+                if proc.returncode == 0:
+                    stageout_queue.put((jobid, os.path.join(workdir, outputName(md, jobid))))
+                else:
+                    failed.append(jobid)
+                    report(jobid, proc.returncode)
+    finally:
+        stageout_queue.put(None)
+        stage_thread.join()
+
+    if failed:
+        raise RuntimeError('Jobs %s FAILED!' % ','.join(str(j) for j in sorted(failed)))
+
+
+def main(args):
+
+    # load job metadata
+    with open(args.metadata) as fp:
+        md = json.load(fp)
+
+    jobids = [int(j) for j in args.jobid.split('+')]
+    if len(jobids) > 1:
+        run_packed(md, args, jobids)
+        return
+
+    outputname = process(md, args, jobids[0], args.workdir)
+
+    # stage out
+    if not args.no_stageout:
+        stage_out(md, args, outputname)
 
 
 if __name__ == "__main__":
@@ -136,17 +358,26 @@ if __name__ == "__main__":
                         default='metadata.json',
                         help='Path to the metadata file. Default:%(default)s')
     parser.add_argument('--max-retry',
-                        type=int, default=3,
-                        help='Max number of retry for stageout. Default: %(default)s'
+                        type=int, default=5,
+                        help='Max number of attempts for stageout. Default: %(default)s'
                         )
     parser.add_argument('--sleep',
-                        type=int, default=120,
-                        help='Seconds to wait before retry stageout. Default: %(default)s'
+                        type=int, default=15,
+                        help='Seconds to wait before the first retry of the stageout, doubled at each retry. Default: %(default)s'
                         )
     parser.add_argument('--files',
                         nargs='*', default=[],
                         help='Run over the specified input file. Default:%(default)s')
-    parser.add_argument('jobid', type=int, help='Index of the output job.')
+    parser.add_argument('--nprocs',
+                        type=int, default=0,
+                        help='Number of jobs run in parallel when several are given (0: OMP_NUM_THREADS, set by condor to request_cpus, else all). Default: %(default)s')
+    parser.add_argument('--workdir',
+                        default=None,
+                        help='Directory for the outputs of the job, instead of tmpoutdir. Default:%(default)s')
+    parser.add_argument('--no-stageout',
+                        action='store_true', default=False,
+                        help='Leave the output file in the work directory. Default:%(default)s')
+    parser.add_argument('jobid', help='Index of the output job, or indices joined by "+" to run several jobs in this slot.')
 
     args = parser.parse_args()
     main(args)
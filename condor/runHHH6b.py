@@ -165,6 +165,8 @@ def _process(args):
                 print('run signal')
                 opts.outputdir = opts.outputdir+'_signal'
                 opts.jobdir = opts.jobdir+'_signal'
+            if args.friend_syst:
+                opts.friend_of = args.outputdir
             run(opts, configs={nn_cfgname: cfg})
 
         # JER up/down
@@ -180,6 +182,8 @@ def _process(args):
                 print('run signal')
                 opts.outputdir = opts.outputdir+'_signal'
                 opts.jobdir = opts.jobdir+'_signal'
+            if args.friend_syst:
+                opts.friend_of = args.outputdir
             run(opts, configs={nn_cfgname: cfg})
 
         # MET unclustered up/down
@@ -209,6 +213,11 @@ def main():
                         help='Run all the systematic trees. Default: %(default)s'
                         )
 
+    parser.add_argument('--friend-syst',
+                        action='store_true', default=False,
+                        help='Write the systematic trees as friends of the nominal skim, which must have been produced already. Default: %(default)s'
+                        )
+
     parser.add_argument('--run-data',
                         action='store_true', default=False,
                         help='Run over data. Default: %(default)s'
@@ -13,6 +13,9 @@ import logging
 #logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(levelname)s: %(message)s')
 
+# merged pileup profiles of the datasets written by the pre-pass, shipped with the jobs
+PU_PROFILE_FILE = 'pu_profiles.root'
+
 
 def splitlist(a, n):
     k, m = divmod(len(a), n)
@@ -42,158 +45,37 @@ def get_filenames(listfile):
         filenames.append(line.strip())
     return filenames
 
-def add_weight_branch_list(filelist, xsec, lumi=1., treename='Events', wgtbranch='xsecWeight'):
-    from array import array
-    import ROOT
-    ROOT.PyConfig.IgnoreCommandLineOptions = True
+def load_nominal_metadata(nominal_outputdir, metadata='metadata.json'):
+    """Return the metadata of the nominal skim stored in its output directory"""
+    import gzip
+    with gzip.open(os.path.join(nominal_outputdir, metadata + '.gz')) as f:
+        return json.loads(f.read().decode('utf-8'))
 
-    def _get_sum(tree, wgtvar):
-        htmp = ROOT.TH1D('htmp', 'htmp', 1, 0, 10)
-        tree.Project('htmp', '1.0', wgtvar)
-        return float(htmp.Integral())
-
-    def _fill_const_branch(tree, branch_name, buff, lenVar=None):
-        if lenVar is not None:
-            b = tree.Branch(branch_name, buff, '%s[%s]/F' % (branch_name, lenVar))
-            b_lenVar = tree.GetBranch(lenVar)
-            buff_lenVar = array('I', [0])
-            b_lenVar.SetAddress(buff_lenVar)
-        else:
-            b = tree.Branch(branch_name, buff, branch_name + '/F')
-
-        b.SetBasketSize(tree.GetEntries() * 2)  # be sure we do not trigger flushing                                                                                                                        
-        for i in range(tree.GetEntries()):
-            if lenVar is not None:
-                b_lenVar.GetEntry(i)
-            b.Fill()
-
-        b.ResetAddress()
-        if lenVar is not None:
-            b_lenVar.ResetAddress()
-
-    # open all files
-    sumw = 0
-    for fname in filelist:
-        f = ROOT.TFile.Open(fname)
-        run_tree = f.Get('Runs')
-        sumwgts = _get_sum(run_tree, 'genEventSumw')
-        sumw += sumwgts
-        f.Close()
-
-    # normalize by sumq
-    for fname in filelist:
-        f = ROOT.TFile(fname,'UPDATE')
-        tree = f.Get(treename)
-        print('fill xsec ',xsec,' lumi ',lumi ,' sumwgt ',sumw)
-        xsecwgt = xsec * lumi / sumw
-        xsec_buff = array('f', [xsecwgt])
-        _fill_const_branch(tree, wgtbranch, xsec_buff)
-        tree.Write(treename, ROOT.TObject.kOverwrite)
-        f.Close()
-
-def add_weight_branch(file, xsec, lumi=1., treename='Events', wgtbranch='xsecWeight'):
-    print("Here")
-    from array import array
+def verify_friend_parts(parts_dir, nominal_parts_dir, samp):
+    """Check that the merged friend trees of a sample are aligned with the merged nominal skim"""
+    import glob
     import ROOT
     ROOT.PyConfig.IgnoreCommandLineOptions = True
-
-    def _get_sum(tree, wgtvar):
-        htmp = ROOT.TH1D('htmp', 'htmp', 1, 0, 10)
-        tree.Project('htmp', '1.0', wgtvar)
-        return float(htmp.Integral())
-
-    def _fill_const_branch(tree, branch_name, buff, lenVar=None):
-        if lenVar is not None:
-            b = tree.Branch(branch_name, buff, '%s[%s]/F' % (branch_name, lenVar))
-            b_lenVar = tree.GetBranch(lenVar)
-            buff_lenVar = array('I', [0])
-            b_lenVar.SetAddress(buff_lenVar)
-        else:
-            b = tree.Branch(branch_name, buff, branch_name + '/F')
-
-        b.SetBasketSize(tree.GetEntries() * 2)  # be sure we do not trigger flushing
-        for i in range(tree.GetEntries()):
-            if lenVar is not None:
-                b_lenVar.GetEntry(i)
-            b.Fill()
-
-        b.ResetAddress()
-        if lenVar is not None:
-            b_lenVar.ResetAddress()
-
-    f = ROOT.TFile(file, 'UPDATE')
-    sumEv=False
-    print("Here 2")
-    try:
-        print("Here 3")
-        nevents = f.Get('nEvents')
-        nevents.GetBinContent(1)
-        sumev=True
-    except:
-        sumev=False
-        
-    print("Here 4")
-    #try:
-    if 'sumLHE' in [i.GetName() for i in f.GetListOfKeys()]:
-        print("Here 5")
-        lhetree = f.Get('sumLHE')
-        print('lhetree ',lhetree)
-    else:
-    #except:
-        print('no lhetree')
-
-    print("Here 6")
-    run_tree = f.Get('Runs')
-    print('run tree',run_tree)
-    tree = f.Get(treename)
-
-    # fill cross section weights to the 'Events' tree
-    sumwgts = _get_sum(run_tree, 'genEventSumw')
-    sumevts = _get_sum(run_tree, 'genEventCount')
-    print(sumwgts)
-    if sumev:
-        print('fill xsec ',xsec,' lumi ',lumi ,' sumevt w ',nevents.GetBinContent(1),' sumwgts ',sumwgts,' sumevts ',sumevts)
-        #xsecwgt = xsec * lumi / nevents.GetBinContent(1)
-        xsecwgt = xsec * lumi / sumwgts
-    else:
-        print('fill xsec ',xsec,' lumi ',lumi ,' sumwgt ',sumwgts,' sumevts ',sumevts)
-        xsecwgt = xsec * lumi / sumwgts
-
-    xsec_buff = array('f', [xsecwgt])
-    _fill_const_branch(tree, wgtbranch, xsec_buff)
-
-    # fill lhe re-norm factors
-    if sumev:
-        run_tree.GetEntry(0)
-        nScaleWeights = run_tree.nLHEScaleSumw
-
-        scale_weight_norm_buff = array('f', [nevents.GetBinContent(1) / _get_sum(lhetree,'sumweight_%i'%i) for i in range(nScaleWeights)])
-        print([_get_sum(lhetree,'sumweight_%i'%i) for i in  range(nScaleWeights)])
-        print(str(scale_weight_norm_buff))
-        logging.info('LHEScaleWeightNormNew: ' + str(scale_weight_norm_buff))
-        _fill_const_branch(tree, 'LHEScaleWeightNormNew', scale_weight_norm_buff, lenVar='nLHEScaleWeight')
-
-    # fill LHE weight re-normalization factors
-    print("Entering ScaleWeight")
-    if tree.GetBranch('LHEScaleWeight'):
-        print("In ScaleWeight")
-        run_tree.GetEntry(0)
-        nScaleWeights = run_tree.nLHEScaleSumw
-        scale_weight_norm_buff = array('f', [sumwgts / _get_sum(run_tree, 'LHEScaleSumw[%d]*genEventSumw' % i) for i in range(nScaleWeights)])
-        logging.info('LHEScaleWeightNorm: ' + str(scale_weight_norm_buff))
-        _fill_const_branch(tree, 'LHEScaleWeightNorm', scale_weight_norm_buff, lenVar='nLHEScaleWeight')
-
-    print("Entering PdfWeight")
-    if tree.GetBranch('LHEPdfWeight'):
-        print("In PdgWeight")
-        run_tree.GetEntry(0)
-        nPdfWeights = run_tree.nLHEPdfSumw
-        pdf_weight_norm_buff = array('f', [sumwgts / _get_sum(run_tree, 'LHEPdfSumw[%d]*genEventSumw' % i) for i in range(nPdfWeights)])
-        logging.info('LHEPdfWeightNorm: ' + str(pdf_weight_norm_buff))
-        _fill_const_branch(tree, 'LHEPdfWeightNorm', pdf_weight_norm_buff, lenVar='nLHEPdfWeight')
-
-    tree.Write(treename, ROOT.TObject.kOverwrite)
-    f.Close()
+    from PhysicsTools.NanoAODTools.postprocessing.framework.friends import verifyFriend
+
+    all_ok = True
+    for fname in sorted(glob.glob(os.path.join(parts_dir, '%s_tree*.root' % samp))):
+        nominal = os.path.join(nominal_parts_dir, os.path.basename(fname))
+        if not os.path.exists(nominal):
+            logging.warning('Cannot find nominal file %s to verify friend %s' % (nominal, fname))
+            all_ok = False
+            continue
+        f_nominal = ROOT.TFile.Open(nominal)
+        f_friend = ROOT.TFile.Open(fname)
+        try:
+            verifyFriend(f_nominal.Get('Events'), f_friend)
+            logging.info('Friend %s is aligned with %s' % (fname, nominal))
+        except RuntimeError as e:
+            logging.error(str(e))
+            all_ok = False
+        f_friend.Close()
+        f_nominal.Close()
+    return all_ok
 
 def load_dataset_file(dataset_file):
     import yaml
@@ -263,6 +145,21 @@ def create_metadata(args):
     md['jobs'] = []
     md['xsec'] = {}
 
+    if args.friend_of:
+        # systematics pass written as friend trees of an existing nominal skim:
+        # one job per nominal job, reading back the output of that job
+        nominal_md = load_nominal_metadata(args.friend_of, args.metadata)
+        md['friend'] = True
+        md['cut'] = None
+        md['json'] = None
+        md['samples'] = nominal_md['samples']
+        md['xsec'] = nominal_md['xsec']
+        for job in nominal_md['jobs']:
+            piece = os.path.join(nominal_md['joboutputdir'], '{samp}_{idx}_tree.root'.format(samp=job['samp'], idx=job['idx']))
+            md['inputfiles'].setdefault(job['samp'], []).append(piece)
+            md['jobs'].append({'samp': job['samp'], 'idx': job['idx'], 'inputfiles': [piece], 'tidx': job['tidx']})
+        return md
+
     def select_sample(dataset):
         samp = dataset
         keep = True
@@ -305,68 +202,78 @@ def create_metadata(args):
     # sort the samples
     md['samples'] = natural_sort(md['samples'])
 
-    def dasgoclient(query):
-      dascmd = 'dasgoclient --query="%s" -json'%(query)
-      out = ""
-      try:
-        process = subprocess.Popen(dascmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,shell=True)
-        for line in iter(process.stdout.readline,b""):
-          if isinstance(line,bytes):
-            line = line.decode('utf-8')
-          out += line
-        process.stdout.close()
-        retcode = process.wait()
-        out = out.strip()
-      except Exception as e:
-        print("EXCEPTION:",e)
-        return ""
-      if retcode:
-        return ""
-      return out
-
-    def GetNevents(daspath):
-      output = dasgoclient(daspath)
-      # output is string (including "\n") of list of jsons
-      listoutput = eval(''.join(output.split()).replace("null", "None"))
-      for tempjson in listoutput:
-        if tempjson["das"]["services"][0]=="dbs3:files":
-          myjson = tempjson
-          return myjson["file"][0]["nevents"]
-      return 0
-
-    # discover the files
+    # target number of events per job: given directly or from the job time
+    events_per_job = args.events_per_job
+    if not events_per_job and args.job_time:
+        events_per_job = int(args.job_time / args.seconds_per_event)
+
+    catalog = None
+    if events_per_job or args.prefetch or any('Run2023' in f or 'Run2024' in f for samp in md['samples'] for f in md['inputfiles'][samp]):
+        from filecatalog import FileCatalog
+        catalog = FileCatalog(args.file_catalog)
+        catalog.scan([f for samp in md['samples'] for f in md['inputfiles'][samp]], nprocs=args.scan_procs)
+
+    # create the jobs
+    from filecatalog import plan_jobs
     tidx = 0
     for samp in md['samples']:
         # sort the input list
         md['inputfiles'][samp] = natural_sort(md['inputfiles'][samp])
 
-        # create jobs
-        additional = 0
-        for idx, chunk in enumerate(get_chunks(md['inputfiles'][samp], args.nfiles_per_job)):
-            nevents = 0
-            if 'Run2023' in chunk[0] or 'Run2024' in chunk[0]:
-                for c in chunk:
-                  nevents += GetNevents('/store/'+c.split('/store/')[-1])
-                print(c)
-                if nevents < 400000:
-                    md['jobs'].append({'samp': samp, 'idx': idx+additional, 'inputfiles': chunk, 'tidx': tidx})
-                    tidx = tidx+1
-                else:
-                    div = int(nevents/400000)+1
-                    maxent = int(nevents/div)+1
-                    start = 0
-                    for i in range(div):
-                        md['jobs'].append({'samp': samp, 'idx': idx+additional, 'inputfiles': chunk, 'tidx': tidx, 'firstEntry': start, 'maxEntries': maxent})
-                        tidx = tidx+1
-                        if i!=div-1:
-                          additional += 1
-                          start += maxent
-            else:
-                md['jobs'].append({'samp': samp, 'idx': idx+additional, 'inputfiles': chunk, 'tidx': tidx})
-                tidx = tidx+1
+        target = events_per_job
+        if not target and ('Run2023' in md['inputfiles'][samp][0] or 'Run2024' in md['inputfiles'][samp][0]):
+            # these eras are always split by events
+            target = 400000
+        if target:
+            jobs = plan_jobs(md['inputfiles'][samp], catalog, target)
+        else:
+            jobs = [{'inputfiles': chunk} for chunk in get_chunks(md['inputfiles'][samp], args.nfiles_per_job)]
+        for idx, job in enumerate(jobs):
+            job.update({'samp': samp, 'idx': idx, 'tidx': tidx})
+            if catalog:
+                # prefetching copies whole files: worth it only if the job reads most of them
+                job['bytes'] = sum(catalog.bytes(f) or 0 for f in job['inputfiles'])
+                if 'maxEntries' in job:
+                    job['prefetch'] = 2 * job['maxEntries'] >= (catalog.entries(job['inputfiles'][0]) or 0)
+            md['jobs'].append(job)
+            tidx = tidx+1
+        logging.info('%s: %d files in %d jobs' % (samp, len(md['inputfiles'][samp]), len(jobs)))
     return md
 
 
+def fill_pu_profile_cache(args, md):
+    '''
+    Pre-pass computing the pileup profile of every input file in the cache
+    shared by the jobs, and merging them once per dataset into one file
+    shipped with the jobs, which then only read the profile of their dataset
+    (for the modules using the MC profile of the sample, autoPU). Only the
+    modules imported from a python module defining a pileup weight producer
+    are instantiated.
+    '''
+    from importlib import import_module
+    from processor import xrd_prefix
+    from PhysicsTools.NanoAODTools.postprocessing.modules.common.puProfile import fillCache, datasetProfile, \
+        datasetProfileName, writeDatasetProfiles
+    profiles = {}
+    for mod, names in args.imports:
+        obj = import_module(mod)
+        if not any(isinstance(v, type) and hasattr(v, 'setDatasetProfile') for v in vars(obj).values()):
+            continue
+        for name in names.split(','):
+            m = getattr(obj, name)()
+            if not (hasattr(m, 'setDatasetProfile') and getattr(m, 'autoPU', False)):
+                continue
+            for samp in md['samples']:
+                logging.info('Filling pileup profile cache for %s (%s)' % (samp, name))
+                inputfiles = xrd_prefix(md['inputfiles'][samp])[0]
+                fillCache(inputfiles, m.nvtxVar, m.myh, args.puProfileCache, nProcs=args.pu_prepass)
+                profiles[datasetProfileName(samp, m.nvtxVar, m.myh)] = datasetProfile(
+                    inputfiles, m.nvtxVar, m.myh, args.puProfileCache)
+    if profiles:
+        writeDatasetProfiles(os.path.join(args.jobdir, PU_PROFILE_FILE), profiles)
+        md['puProfileFile'] = PU_PROFILE_FILE
+
+
 def load_metadata(args):
     metadatafile = os.path.join(args.jobdir, args.metadata)
     with open(metadatafile) as f:
@@ -374,38 +281,11 @@ def load_metadata(args):
     return md
 
 def check_job_status(args):
+    from jobstatus import JobStatusTracker
     md = load_metadata(args)
     njobs = len(md['jobs'])
-    jobids = {'running': [], 'failed': [], 'completed': []}
-    for jobid in range(njobs):
-        logpath = os.path.join(args.jobdir, '%d.log' % jobid)
-        if not os.path.exists(logpath):
-            logging.debug('Cannot find log file %s' % logpath)
-            jobids['failed'].append(str(jobid))
-            continue
-        with open(logpath) as logfile:
-            errormsg = None
-            finished = False
-            for line in reversed(logfile.readlines()):
-                if 'Job removed' in line or 'aborted' in line:
-                    errormsg = line
-                if 'Job submitted from host' in line:
-                    # if seeing this first: the job has been resubmited
-                    break
-                if 'return value' in line:
-                    if 'return value 0' in line:
-                        finished = True
-                    else:
-                        errormsg = line
-                    break
-            if errormsg:
-                logging.debug(logpath + '\n   ' + errormsg)
-                jobids['failed'].append(str(jobid))
-            else:
-                if finished:
-                    jobids['completed'].append(str(jobid))
-                else:
-                    jobids['running'].append(str(jobid))
+    # only the lines appended to the logs since the last check are read
+    jobids = JobStatusTracker(args.jobdir).update(njobs, nthreads=args.scan_procs)
     assert sum(len(jobids[k]) for k in jobids) == njobs
     all_completed = len(jobids['completed']) == njobs
     info = {k: len(jobids[k]) for k in jobids if len(jobids[k])}
@@ -414,11 +294,30 @@ def check_job_status(args):
     return all_completed, jobids
 
 
+def slot_resources(args):
+    '''
+    Memory and max runtime of a condor job: --request-memory and --max-runtime
+    are per job, so with --jobs-per-slot the memory is scaled by the number of
+    jobs running at the same time and the runtime by the number of rounds
+    needed to run all the jobs on the cores of the slot.
+    '''
+    request_memory, max_runtime = args.request_memory, args.max_runtime
+    if args.jobs_per_slot > 1:
+        parallel = min(args.jobs_per_slot, args.cpus_per_slot or args.jobs_per_slot)
+        rounds = -(-args.jobs_per_slot // parallel)
+        request_memory = '(%s)*%d' % (request_memory, parallel)
+        if max_runtime and rounds > 1:
+            max_runtime = '(%s)*%d' % (max_runtime, rounds)
+    return request_memory, max_runtime
+
+
 def submit(args, configs):
     logging.info('Preparing jobs...\n  - modules: %s\n  - cut: %s\n  - outputdir: %s' % (str(args.imports), args.cut, args.outputdir))
 
     scriptfile = os.path.join(os.path.dirname(__file__), args.jobprocessor)
     macrofile = os.path.join(os.path.dirname(__file__), 'processor.py')
+    # used by processor.py for the checksum of the stage out
+    catalogfile = os.path.join(os.path.dirname(__file__), 'filecatalog.py')
     metadatafile = os.path.join(args.jobdir, args.metadata)
     joboutputdir = os.path.join(args.outputdir, 'pieces')
 
@@ -466,6 +365,8 @@ def submit(args, configs):
         # create metadata file
         md = create_metadata(args)
         md['joboutputdir'] = joboutputdir
+        if args.puProfileCache and args.pu_prepass:
+            fill_pu_profile_cache(args, md)
         with open(metadatafile, 'w') as f:
             json.dump(md, f, ensure_ascii=True, indent=2, sort_keys=True)
         # store the metadata file to the outputdir as well
@@ -482,23 +383,36 @@ def submit(args, configs):
         jobids = check_job_status(args)[1]['failed']
         jobids_file = os.path.join(args.jobdir, 'resubmit.txt')
 
+    if args.jobs_per_slot > 1:
+        # several jobs per condor job, passed to processor.py as "id1+id2+..."
+        jobids = ['+'.join(chunk) for chunk in get_chunks(jobids, args.jobs_per_slot)]
     with open(jobids_file, 'w') as f:
         f.write('\n'.join(jobids))
 
+    # cpus and live stdout (with the status of each job) for the condor jobs running several jobs
+    slot_options = ''
+    request_memory, max_runtime = slot_resources(args)
+    if args.jobs_per_slot > 1:
+        slot_options = 'request_cpus          = %d\nstream_output         = true' % (args.cpus_per_slot or args.jobs_per_slot)
+
     # prepare the list of files to transfer
     files_to_transfer = [#os.path.expandvars('$CMSSW_BASE/../CMSSW%s.tar.gz' % args.tarball_suffix), 
-        macrofile, metadatafile] + configfiles
+        macrofile, catalogfile, metadatafile] + configfiles
     if args.branchsel_in:
         files_to_transfer.append(args.branchsel_in)
         shutil.copy2(args.branchsel_in, args.jobdir)
     if args.branchsel_out:
         files_to_transfer.append(args.branchsel_out)
         shutil.copy2(args.branchsel_out, args.jobdir)
+    if os.path.exists(os.path.join(args.jobdir, PU_PROFILE_FILE)):
+        # merged pileup profiles of the datasets, from the pre-pass
+        files_to_transfer.append(os.path.join(args.jobdir, PU_PROFILE_FILE))
     if args.extra_transfer:
         for f in args.extra_transfer.split(','):
             files_to_transfer.append(f)
             shutil.copy2(f, args.jobdir)
     shutil.copy2(macrofile, args.jobdir)
+    shutil.copy2(catalogfile, args.jobdir)
     files_to_transfer = [os.path.abspath(f) for f in files_to_transfer]
 
     if args.condordescV!=2:
@@ -520,6 +434,7 @@ WhenToTransferOutput  = ON_EXIT
 want_graceful_removal = true
 periodic_release      = (NumJobStarts < 3) && ((CurrentTime - EnteredCurrentStatus) > 10*60)
 {transfer_output}
+{slot_options}
 {site}
 {maxruntime}
 {condor_extras}
@@ -531,10 +446,11 @@ queue jobid from {jobids_file}
            # when outputdir is on EOS, disable file transfer as file is manually copied to EOS in processor.py
            initialdir=os.path.abspath(args.jobdir) if joboutputdir.startswith('/eos') else joboutputdir,
            transfer_output='transfer_output_files = ""' if joboutputdir.startswith('/eos') else '',
+           slot_options=slot_options,
            jobids_file=os.path.abspath(jobids_file),
            site='+DESIRED_Sites = "%s"' % args.site if args.site else '',
-           maxruntime='+MaxRuntime = %s' % args.max_runtime if args.max_runtime else '',
-           request_memory=args.request_memory,
+           maxruntime='+MaxRuntime = %s' % max_runtime if max_runtime else '',
+           request_memory=request_memory,
            condor_extras=args.condor_extras,
         )
     else:
@@ -556,6 +472,7 @@ want_graceful_removal = true
 periodic_release      = (NumJobStarts < 3) && ((CurrentTime - EnteredCurrentStatus) > 10*60)
 getenv                = true
 {transfer_output}
+{slot_options}
 {site}
 {maxruntime}
 {condor_extras}
@@ -567,10 +484,11 @@ queue jobid from {jobids_file}
            # when outputdir is on EOS, disable file transfer as file is manually copied to EOS in processor.py
            initialdir=os.path.abspath(args.jobdir) if joboutputdir.startswith('/eos') else joboutputdir,
            transfer_output='transfer_output_files = ""' if joboutputdir.startswith('/eos') else '',
+           slot_options=slot_options,
            jobids_file=os.path.abspath(jobids_file),
            site='+DESIRED_Sites = "%s"' % args.site if args.site else '',
-           maxruntime='+MaxRuntime = %s' % args.max_runtime if args.max_runtime else '',
-           request_memory=args.request_memory,
+           maxruntime='+MaxRuntime = %s' % max_runtime if max_runtime else '',
+           request_memory=request_memory,
            condor_extras=args.condor_extras,
         )
 
@@ -600,98 +518,66 @@ def run_add_weight(args):
     if not os.path.exists(parts_dir):
         os.makedirs(parts_dir)
 
+    import glob
+    from filecatalog import FileCatalog
+    from filecatalog import plan_merge
+    from mergeplan import MergeState, plan_sample, run_plan, cleanup, save_groups, load_groups, friend_groups
+    catalog = FileCatalog(args.file_catalog)
+    nominal_groups = load_groups(os.path.join(md['friend_of'], 'parts')) if md.get('friend_of') else {}
+
+    # merge tree of each sample, the weights being added by the final merges
+    nodes = {}
     for samp in md['samples']:
-        outfile = '{parts_dir}/{samp}_tree.root'.format(parts_dir=parts_dir, samp=samp)
-        if os.path.isfile(outfile):
-            print(samp,"is done!")
-            continue # Skip already successful hadds, assume the user removed the failures beforehand. This obsoletes the "status_file"
-        os.system('ls {outputdir}/pieces/{samp}_*_tree.root > tmp.txt'.format(outputdir=args.outputdir, samp=samp))
-        with open("tmp.txt","r") as f: d = f.readlines()
-        cmd = ''
-        isTooLong = False
-        isTooTooLong = False
-
-        if len(d)>100: isTooLong = True
-
-        if isTooLong:
-            #for idx, chunk in enumerate(get_chunks(d, 100)):
-            #cmd += 'haddnano.py {outfile}  \n'.format(outfile=outfile.replace('.root','_%i.root'%idx), chunk=' '.join(chunk))
-            
-            if len(d) < 1000:
-                for idx in range(0,10):
-                    cmd += 'haddnano.py {outfile} {outputdir}/pieces/{samp}_{idx}*_tree.root  \n'.format(outfile=outfile.replace('.root','_%i.root'%idx), outputdir=args.outputdir, samp=samp, idx=idx)
-                print('cmd ',cmd)
-            else: 
-                # Split list in 20 subset
-                print("Hadding into subsets")
-                subset_d = list(splitlist(d,20))
-                cmd_list = []
-                
-                print('Elements in subset list', len(subset_d))
-
-                for idx in range(len(subset_d)):
-                    # create temporary list of files to pass to haddnano.py modified
-                    out = ''
-                    
-                    for f_in in subset_d[idx]:
-                        out += f_in 
-                    tmp_fname = 'tmp_files_files_%d.txt'%idx
-                    with open(tmp_fname,'w') as f_write:
-                        f_write.write(out)
-                    cmd += 'haddnano.py {outfile} {tmp_fname} \n'.format(outfile=outfile.replace('.root','_%i.root'%idx),tmp_fname=tmp_fname)
-                print(cmd)
-        else:
-            cmd = 'haddnano.py {outfile} {outputdir}/pieces/{samp}_*_tree.root \n'.format(outfile=outfile, outputdir=args.outputdir, samp=samp)
-        logging.debug('...' + cmd)
-
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        log = p.communicate()[0]
-        log_lower = log.lower().decode('utf-8')
-        if 'error' in log_lower or 'fail' in log_lower:
-            logging.error(log)
-        if p.returncode != 0:
-            print('Hadd failed on %s!' % samp)
-            continue
-            #raise RuntimeError('Hadd failed on %s!' % samp)
-        if isTooLong:
-            #cmd = 'haddnano.py {outfile} {parts_dir}/{samp}_tree_*.root \n'.format(outfile=outfile, parts_dir=parts_dir, samp=samp)
-            #os.system(cmd)
-            #p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            #log = p.communicate()[0]
-            #log_lower = log.lower().decode('utf-8')
-            #if 'error' in log_lower or 'fail' in log_lower:
-            #    logging.error(log)
-            #if p.returncode == 0:
-            #    os.system('rm {parts_dir}/{samp}_tree_*.root'.format(parts_dir=parts_dir, samp=samp))
-            if args.weight_file:
-                import glob
-                filelists = glob.glob("{parts_dir}/{samp}_tree_*.root".format(parts_dir=parts_dir, samp=samp))
-                print(filelists)
-                dataset_xs = md['xsec'][samp]
-                if dataset_xs == 1: continue
-                xsec = xsec_dict[dataset_xs]
-                if xsec is not None:
-                    logging.info('Adding xsec weight to files, xsec=%f' % (xsec))
-                    add_weight_branch_list(filelists, xsec)
-
-        # add weight
-        if args.weight_file and not isTooLong:
-            dataset_xs = md['xsec'][samp]
-            if dataset_xs == 1: continue
+        xsec = None
+        if args.weight_file and not md.get('friend_of') and md['xsec'][samp] != 1:
             try:
-                xsec = xsec_dict[dataset_xs]
-                print(xsec)
-                if xsec is not None:
-                    logging.info('Adding xsec weight to file %s, xsec=%f' % (outfile, xsec))
-                    add_weight_branch(outfile, xsec)
+                xsec = xsec_dict[md['xsec'][samp]]
             except KeyError as e:
                 if '-' not in samp and '_' not in samp:
                     # data
-                    logging.info('Not ing weight to sample %s' % samp)
+                    logging.info('Not adding weight to sample %s' % samp)
                 else:
                     raise e
-    #with open(status_file, 'w'):
-    #    pass
+        pieces = natural_sort(glob.glob('{outputdir}/pieces/{samp}_*_tree.root'.format(outputdir=args.outputdir, samp=samp)))
+        if not pieces:
+            logging.error('No output files for %s!' % samp)
+            continue
+        if md.get('friend_of'):
+            # the friend parts must hold the same events as the nominal parts of the same names
+            nominal = nominal_groups.get(samp)
+            if nominal is None:
+                # nominal merged before the groups were kept: group its pieces again as it did
+                nominal_pieces = natural_sort(md['inputfiles'][samp])
+                catalog.scan(nominal_pieces, nprocs=args.scan_procs)
+                nominal = plan_merge(nominal_pieces, catalog, args.merge_size * 1.e9)
+            groups = friend_groups(pieces, nominal)
+            if groups is None:
+                logging.error('Friend pieces of %s do not match the nominal merge in %s, not merging them'
+                              % (samp, os.path.join(md['friend_of'], 'parts')))
+                continue
+        else:
+            # group the pieces by size (and compression) using the catalogue, scanning the new ones
+            catalog.scan(pieces, nprocs=args.scan_procs)
+            groups = plan_merge(pieces, catalog, args.merge_size * 1.e9)
+        save_groups(parts_dir, samp, groups)
+        nodes.update(plan_sample(samp, pieces, catalog, parts_dir, args.merge_size * 1.e9,
+                                 fan_in=args.merge_fan_in, xsec=xsec, groups=groups))
+
+    # run the merges of all the samples with a pool of workers, resuming from the steps already done
+    failed = run_plan(nodes, MergeState(parts_dir), nprocs=args.merge_procs, catalog=catalog)
+    cleanup(nodes, failed)
+    failed_samples = sorted(set(nodes[n]['samp'] for n in failed))
+    for samp in failed_samples:
+        print('Hadd failed on %s!' % samp)
+
+    if md.get('friend_of'):
+        # friends carry no weights, they are read together with the nominal skim
+        for samp in md['samples']:
+            if samp in failed_samples:
+                continue
+            if not verify_friend_parts(parts_dir, os.path.join(md['friend_of'], 'parts'), samp):
+                logging.error('Friend trees of %s are not aligned with the nominal skim!' % samp)
+
 
 def get_arg_parser():
     import argparse
@@ -746,6 +632,46 @@ def get_arg_parser():
         type=int, default=3,
         help='Number of input files to process in one job. Default: %(default)s'
     )
+    parser.add_argument('--jobs-per-slot',
+        type=int, default=1,
+        help='Number of jobs run by each condor job, in parallel on --cpus-per-slot cores. Default: %(default)s'
+    )
+    parser.add_argument('--cpus-per-slot',
+        type=int, default=0,
+        help='Number of cores requested by the condor jobs running several jobs (0: --jobs-per-slot). Default: %(default)s'
+    )
+    parser.add_argument('--events-per-job',
+        type=int, default=0,
+        help='Split the jobs to process about this number of events each, using the file catalogue (0: use --nfiles-per-job). Default: %(default)s'
+    )
+    parser.add_argument('--job-time',
+        type=float, default=0,
+        help='Split the jobs to run about this number of seconds each, with --seconds-per-event (if --events-per-job is not set). Default: %(default)s'
+    )
+    parser.add_argument('--seconds-per-event',
+        type=float, default=0.01,
+        help='Estimated processing time per event, for --job-time. Default: %(default)s'
+    )
+    parser.add_argument('--merge-size',
+        type=float, default=5,
+        help='Maximum size in GB of the files merged together when adding the weights, larger samples are merged into several parts. Default: %(default)s'
+    )
+    parser.add_argument('--merge-fan-in',
+        type=int, default=100,
+        help='Maximum number of files merged by one haddnano.py, more are merged in several steps. Default: %(default)s'
+    )
+    parser.add_argument('--merge-procs',
+        type=int, default=4,
+        help='Number of merges run in parallel when adding the weights. Default: %(default)s'
+    )
+    parser.add_argument('--file-catalog',
+        default='filecatalog.json',
+        help='Catalogue of the metadata (entries, size, clusters, ...) of the input and output files, see filecatalog.py. Default: %(default)s'
+    )
+    parser.add_argument('--scan-procs',
+        type=int, default=8,
+        help='Number of processes opening the files missing from the catalogue. Default: %(default)s'
+    )
     parser.add_argument('--dryrun',
         action='store_true', default=False,
         help='Do not convert -- only produce metadata. Default: %(default)s'
@@ -760,11 +686,11 @@ def get_arg_parser():
     )
     parser.add_argument('--max-runtime',
         default='24*60*60',
-        help='Max runtime, in seconds. Default: %(default)s'
+        help='Max runtime of a job, in seconds, multiplied by the rounds of jobs run on the cores of a condor job with --jobs-per-slot. Default: %(default)s'
     )
     parser.add_argument('--request-memory',
         default='2000',
-        help='Request memory, in MB. Default: %(default)s'
+        help='Request memory of a job, in MB, multiplied by the jobs run in parallel in a condor job with --jobs-per-slot. Default: %(default)s'
     )
     parser.add_argument('--add-weight',
         action='store_true', default=False,
@@ -790,9 +716,15 @@ def get_arg_parser():
     parser.add_argument("--bi", "--branch-selection-input", dest="branchsel_in", default='keep_and_drop_input.txt', help="Branch selection input")
     parser.add_argument("--bo", "--branch-selection-output", dest="branchsel_out", default='keep_and_drop_output.txt', help="Branch selection output")
     parser.add_argument("--friend", dest="friend", action="store_true", default=False, help="Produce friend trees in output (current default is to produce full trees)")
+    parser.add_argument("--friend-of", dest="friend_of", default=None, help="Output directory of a completed nominal skim: run the modules on its pieces and write only friend trees aligned with them")
+    parser.add_argument("--friend-index", dest="friendIndex", action="store_true", default=False, help="Match the friends given as 'file,friendfile' by (run, luminosityBlock, event) instead of entry number")
     parser.add_argument("-I", "--import", dest="imports", default=[], action="append", nargs=2, help="Import modules (python package, comma-separated list of ")
     parser.add_argument("-z", "--compression", dest="compression", default=("LZ4:4"), help="Compression: none, or (algo):(level) ")
     parser.add_argument("-P", "--prefetch", dest="prefetch", action="store_true", default=False, help="Prefetch input files locally instead of accessing them via xrootd")
+    parser.add_argument("--cache-size", dest="cacheSize", type=int, default=50, help="Size in MB of the TTreeCache holding the active input branches (0 to disable)")
+    parser.add_argument("--async-prefetch", dest="asyncPrefetch", action="store_true", default=False, help="Prefetch the next TTreeCache block asynchronously while processing")
+    parser.add_argument("--pu-profile-cache", dest="puProfileCache", default=None, help="Directory shared by the jobs (e.g. on EOS) caching the pileup profile of each input file: with autoPU the merged profile of the whole dataset is used for all its files")
+    parser.add_argument("--pu-prepass", dest="pu_prepass", type=int, default=0, help="Fill the pileup profile cache before submitting, with this number of processes, so the jobs use the profile of the whole dataset (0: each job uses and caches the profiles of its own files)")
     parser.add_argument("--long-term-cache", dest="longTermCache", action="store_true", default=False, help="Keep prefetched files across runs instead of deleting them at the end")
     parser.add_argument("-N", "--max-entries", dest="maxEntries", type=int, default=None, help="Maximum number of entries to process from any single given input tree")
     parser.add_argument("--first-entry", dest="firstEntry", type=int, default=0, help="First entry to process in the three (to be used together with --max-entries)")
@@ -5,23 +5,8 @@ Creates 'train' and 'test' directories in the `source_dir` and moves the files i
 
 """
 import os
-import subprocess
-
-eosbase = "root://cmseos.fnal.gov/"
-
-def eos_rec_search(startdir,suffix,dirs):
-    dirlook = subprocess.check_output(f"eos {eosbase} ls {startdir}", shell=True).decode('utf-8').split("\n")[:-1]
-    donedirs = [[] for d in dirlook]
-    for di,d in enumerate(dirlook):
-        if d.endswith(suffix):
-            donedirs[di].append(startdir+"/"+d)
-        elif d=="log":
-            continue
-        else:
-            # print(f"Searching {d}")
-            donedirs[di] = donedirs[di] + eos_rec_search(startdir+"/"+d,suffix,dirs+donedirs[di])
-    donedir = [d for da in donedirs for d in da]
-    return dirs+donedir
+import argparse
+from eos_discovery import rec_search, get_backend, add_arguments, ListingCache, eosbase
 
 from pathlib import Path
 import random
@@ -36,17 +21,23 @@ from math import ceil
 source_dir = '/store/user/lpcdihiggsboost/cmantill/DNNtuples_coli/'
 SPLIT_FRAC = 0.15  # fraction of data for testing
 
-samples = os.listdir(f"/eos/uscms/{source_dir}")
+parser = argparse.ArgumentParser("Split the samples into training and testing files")
+add_arguments(parser)
+args = parser.parse_args()
+
+samples = [sample for sample in os.listdir(f"/eos/uscms/{source_dir}") if sample not in ('test', 'train')]
 
-for sample in samples:
-    if sample == 'test' or sample == 'train': continue
+# search all the samples at once, before moving any file
+curdirs = [f"{source_dir}/{sample}/" for sample in samples]
+found = rec_search(get_backend(args), curdirs, ".root", nthreads=args.nthreads,
+                   cache=ListingCache(args.cache) if args.cache else None)
 
+for sample, curdir in zip(samples, curdirs):
     print(f"splitting {sample}")
     Path(f'/eos/uscms/{source_dir}/train/{sample}').mkdir(parents=True, exist_ok=True)
     Path(f'/eos/uscms/{source_dir}/test/{sample}').mkdir(parents=True, exist_ok=True)
 
-    curdir = f"{source_dir}/{sample}/"
-    files = eos_rec_search(curdir,".root",[])
+    files = found[curdir]
     
     random.shuffle(files)
     split_index = ceil(len(files) * SPLIT_FRAC)
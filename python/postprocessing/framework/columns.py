@@ -0,0 +1,186 @@
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import _currentTreeEntry, _remakeAllReaders
+import numpy as np
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+
+class Chunk:
+    """Values of a set of branches for the consecutive tree entries [first, first + n).
+
+       Scalar branches are numpy arrays with one value per entry. For variable
+       length arrays, the values of all the entries are concatenated and
+       offsets[lenVar] gives where each entry starts (n + 1 values), so that
+       entry i of Jet_pt is Jet_pt[offsets['nJet'][i]:offsets['nJet'][i + 1]].
+    """
+
+    def __init__(self, first, n):
+        self.first = first
+        self.n = n
+        self.columns = {}
+        self.offsets = {}
+        self.lenVars = {}
+        # results computed by the modules for this chunk, keyed as they like
+        self.results = {}
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def contains(self, entry):
+        return self.first <= entry < self.first + self.n
+
+    def slice(self, name, i):
+        """Return the values of branch name for the i-th entry of the chunk"""
+        if name not in self.lenVars:
+            return self.columns[name][i]
+        off = self.offsets[self.lenVars[name]]
+        return self.columns[name][off[i]:off[i + 1]]
+
+    def counts(self, lenVar):
+        return np.diff(self.offsets[lenVar])
+
+    def eventIndex(self, lenVar):
+        """Index within the chunk of the entry each value of a lenVar collection belongs to"""
+        return np.repeat(np.arange(self.n), self.counts(lenVar))
+
+
+# numpy types of the leaves; floats are widened as the event values are python floats
+_leafType2dtype = {
+    'Bool_t': np.bool_,
+    'Char_t': np.int8,
+    'UChar_t': np.uint8,
+    'Short_t': np.int16,
+    'UShort_t': np.uint16,
+    'Int_t': np.int32,
+    'UInt_t': np.uint32,
+    'Float_t': np.float64,
+    'Double_t': np.float64,
+    'Long64_t': np.int64,
+    'ULong64_t': np.uint64,
+}
+
+
+def _asArray(values, dtype):
+    """numpy array of type dtype from a column returned by AsNumpy (chars may come as bytes)"""
+    values = np.asarray(values)
+    if values.dtype.kind == 'S':
+        values = values.view(np.uint8)
+    return values.astype(dtype, copy=False)
+
+
+class ChunkReader:
+    """Bulk reader of input branches, in chunks of consecutive tree entries.
+
+       Lets a module compute its outputs for many events at once with numpy
+       and then fill them event by event from the event loop. The columns are
+       read with RDataFrame::AsNumpy from the input tree of the event loop, so
+       they go through its TTreeCache and keep the type of the branches.
+       Branches of friend trees are not read in chunks: get then returns no
+       chunk and the module uses the event values instead.
+    """
+
+    def __init__(self, tree, branches, chunkSize=10000):
+        self._tree = tree
+        self.nEntries = tree.GetEntries()
+        self.chunkSize = chunkSize
+        self.branches = []
+        self.lenVars = {}
+        self.dtypes = {}
+        self.friendBranches = []
+        for name in branches:
+            self.addBranch(name)
+        self._df = None
+        self._chunk = None
+
+    def addBranch(self, name):
+        if name in self.branches:
+            return
+        branch = self._tree.GetBranch(name)
+        if not branch:
+            raise RuntimeError("Can't find branch '%s'" % name)
+        if ROOT.addressof(branch.GetTree()) != ROOT.addressof(self._tree):
+            self.friendBranches.append(name)
+        leaf = branch.GetLeaf(name)
+        leafCount = leaf.GetLeafCount()
+        if bool(leafCount):
+            self.lenVars[name] = leafCount.GetName()
+            self.dtypes[leafCount.GetName()] = _leafType2dtype[leafCount.GetTypeName()]
+        self.dtypes[name] = _leafType2dtype[leaf.GetTypeName()]
+        self.branches.append(name)
+
+    def close(self):
+        self._chunk = None
+        self._df = None
+
+    def _columns(self, names, first, n):
+        if self._df is None:
+            self._df = ROOT.RDataFrame(self._tree)
+        return self._df.Range(first, first + n).AsNumpy(names)
+
+    def read(self, first):
+        """Read the chunk starting at tree entry first"""
+        n = min(self.chunkSize, self.nEntries - first)
+        chunk = Chunk(first, n)
+        lenVars = sorted(set(self.lenVars.values()))
+        names = self.branches + [l for l in lenVars if l not in self.branches]
+        columns = self._columns(names, first, n)
+        for name in names:
+            if name not in self.lenVars:
+                chunk.columns[name] = _asArray(columns[name], self.dtypes[name])
+        for lenVar in lenVars:
+            chunk.offsets[lenVar] = np.concatenate([[0], np.cumsum(chunk.columns[lenVar].astype(np.int64))])
+        for name, lenVar in self.lenVars.items():
+            # one RVec per entry, concatenated
+            dtype = self.dtypes[name]
+            chunk.columns[name] = np.concatenate(
+                [np.zeros(0, dtype)] + [_asArray(v, dtype) for v in columns[name]])
+            chunk.lenVars[name] = lenVar
+        return chunk
+
+    def get(self, event):
+        """Return the chunk containing the current entry of event, and the index of the entry in the chunk.
+
+           Returns (None, -1) if one of the branches was overwritten by a previous
+           module for this event, or is in a friend tree, in which case the caller
+           must use the event values.
+        """
+        if self.friendBranches:
+            return None, -1
+        tree = event._tree
+        if tree._extrabranches and any(b in tree._extrabranches for b in self.branches):
+            return None, -1
+        entry = _currentTreeEntry(tree)
+        if self._chunk is None or not self._chunk.contains(entry):
+            self._chunk = self.read(entry)
+            # the chunk was read through the branches of the event loop tree:
+            # make the readers of the event loop read the current entry again
+            _remakeAllReaders(tree)
+            tree.gotoEntry(tree.entry, forceCall=True)
+        return self._chunk, entry - self._chunk.first
+
+
+def segmentProd(values, offsets):
+    """Product of the values of each entry, given the offsets of the entries (1 for an empty entry)"""
+    ret = np.ones(len(offsets) - 1)
+    nonEmpty = np.diff(offsets) > 0
+    if nonEmpty.any():
+        ret[nonEmpty] = np.multiply.reduceat(values, offsets[:-1][nonEmpty])
+    return ret
+
+
+def segmentSum(values, offsets):
+    """Sum of the values of each entry, given the offsets of the entries (0 for an empty entry)"""
+    ret = np.zeros(len(offsets) - 1)
+    nonEmpty = np.diff(offsets) > 0
+    if nonEmpty.any():
+        ret[nonEmpty] = np.add.reduceat(values, offsets[:-1][nonEmpty])
+    return ret
+
+
+def maskedOffsets(offsets, mask):
+    """Offsets of the entries after keeping only the values where mask is True"""
+    counts = np.bincount(np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))[mask],
+                         minlength=len(offsets) - 1)
+    return np.concatenate([[0], np.cumsum(counts)])
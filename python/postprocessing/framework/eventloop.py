@@ -56,8 +56,10 @@ class Module(object):
 def eventLoop(
         modules, inputFile, outputFile, inputTree, wrappedOutputTree,
         maxEvents=-1, eventRange=None, progress=(10000, sys.stdout),
-        filterOutput=True
+        filterOutput=True, moduleTimes=None
 ):
+    """Run the modules on the events of inputTree. If moduleTimes is a list
+       (one float per module), the time spent in each module is added to it."""
     for m in modules:
         m.beginFile(inputFile, outputFile, inputTree, wrappedOutputTree)
 
@@ -78,8 +80,13 @@ def eventLoop(
         clearExtraBranches(inputTree)
         doneEvents += 1
         ret = True
-        for m in modules:
-            ret = m.analyze(e)
+        for im, m in enumerate(modules):
+            if moduleTimes is not None:
+                tm = time.time()
+                ret = m.analyze(e)
+                moduleTimes[im] += time.time() - tm
+            else:
+                ret = m.analyze(e)
             if not ret:
                 break
         if ret:
@@ -0,0 +1,195 @@
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+# name of the TObjString stored next to a friend tree, holding its checksum
+CHECKSUM_KEY = "FriendChecksum"
+
+# branches identifying an event, also stored in the friend trees
+EVENT_KEYS = ("run", "luminosityBlock", "event")
+# TTreeIndex keys equivalent to (run, luminosityBlock, event): the lumi is packed
+# in the low 32 bits of the major key, so the event number is kept untouched
+INDEX_MAJOR = "run*4294967296+luminosityBlock"
+INDEX_MINOR = "event"
+
+_MODULUS = (1 << 61) - 1
+_BASE = 1000003
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _mix64(x):
+    # splitmix64 finalizer, stable across python versions (unlike hash())
+    x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & _MASK64
+    x = (x ^ (x >> 27)) * 0x94D049BB133111EB & _MASK64
+    return x ^ (x >> 31)
+
+
+class EventChecksum:
+    """Order-sensitive checksum of a sequence of (run, luminosityBlock, event).
+
+       The checksum of a concatenation can be obtained from the checksums of
+       the pieces (see extend), so trees merged with haddnano.py can still be
+       compared with the merged nominal skim.
+    """
+
+    def __init__(self, entries=0, value=0):
+        self.entries = entries
+        self.value = value
+
+    def add(self, run, lumi, event):
+        h = _mix64(_mix64(_mix64(int(run) & _MASK64) ^ (int(lumi) & _MASK64)) ^ (int(event) & _MASK64))
+        self.value = (self.value * _BASE + h) % _MODULUS
+        self.entries += 1
+
+    def extend(self, other):
+        self.value = (self.value * pow(_BASE, other.entries, _MODULUS) + other.value) % _MODULUS
+        self.entries += other.entries
+
+    def __eq__(self, other):
+        return (self.entries, self.value) == (other.entries, other.value)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        return "%d:%x" % (self.entries, self.value)
+
+    def __repr__(self):
+        return "<EventChecksum %s>" % self
+
+    @staticmethod
+    def fromString(text):
+        entries, value = text.split(":")
+        return EventChecksum(int(entries), int(value, 16))
+
+    def write(self, tfile, name=CHECKSUM_KEY):
+        tfile.WriteTObject(ROOT.TObjString(str(self)), name)
+
+
+def readChecksum(tfile, name=CHECKSUM_KEY):
+    """Return the EventChecksum stored in tfile, or None if there is none"""
+    obj = tfile.Get(name)
+    if not obj:
+        return None
+    return EventChecksum.fromString(str(obj.GetString()))
+
+
+def treeChecksum(tree):
+    """Compute the EventChecksum of all the entries of tree.
+
+       Only the run, luminosityBlock and event branches are read, and the
+       branch status of the tree is left untouched.
+    """
+    branches = [tree.GetBranch(n) for n in ("run", "luminosityBlock", "event")]
+    if not all(branches):
+        raise RuntimeError("Tree %s has no run/luminosityBlock/event branches" % tree.GetName())
+    leaves = [b.GetLeaf(b.GetName()) for b in branches]
+    checksum = EventChecksum()
+    for i in range(tree.GetEntries()):
+        for b in branches:
+            b.GetEntry(i)
+        checksum.add(*[l.GetValueLong64() for l in leaves])
+    return checksum
+
+
+def verifyFriend(tree, friendFile, name=CHECKSUM_KEY, checksum=None):
+    """Check that the friend tree stored in friendFile is aligned entry by entry with tree.
+
+       The checksum of tree can be passed if already known, to avoid reading it again.
+    """
+    expected = readChecksum(friendFile, name)
+    if expected is None:
+        raise RuntimeError("No %s found in %s, cannot verify the friend alignment" % (name, friendFile.GetName()))
+    found = checksum if checksum is not None else treeChecksum(tree)
+    if found != expected:
+        raise RuntimeError("Friend %s is not aligned with tree %s (checksum %s, expected %s)" % (
+            friendFile.GetName(), tree.GetName(), found, expected))
+    return True
+
+
+def attachFriends(tree, friendFiles, treeName="Friends", verify=True):
+    """Attach the friend trees written by a systematics pass to tree.
+
+       friendFiles is a dict alias -> file name (the alias is then used to
+       access the branches, e.g. 'jes_up.fj_1_pt'), or a list of file names.
+       Returns the list of opened friend files, to be kept alive by the caller.
+    """
+    if not isinstance(friendFiles, dict):
+        friendFiles = dict((None, f) for f in friendFiles) if len(friendFiles) == 1 \
+            else dict(("friend%d" % i, f) for i, f in enumerate(friendFiles))
+    opened = []
+    checksum = treeChecksum(tree) if verify else None
+    for alias, fname in friendFiles.items():
+        ffile = ROOT.TFile.Open(fname)
+        if not ffile or ffile.IsZombie():
+            raise IOError("Could not open friend file %s" % fname)
+        ftree = ffile.Get(treeName)
+        if not ftree:
+            raise RuntimeError("No tree %s in friend file %s" % (treeName, fname))
+        if verify:
+            verifyFriend(tree, ffile, checksum=checksum)
+        if alias:
+            tree.AddFriend(ftree, alias)
+        else:
+            tree.AddFriend(ftree)
+        opened.append(ffile)
+    return opened
+
+
+def hasEventKeys(tree):
+    return all(tree.GetBranch(n) for n in EVENT_KEYS)
+
+
+def eventIndex(tree):
+    """Read the run, luminosityBlock and event columns of tree in bulk, as numpy arrays"""
+    import numpy as np
+    cols = ROOT.RDataFrame(tree).AsNumpy(list(EVENT_KEYS))
+    return tuple(np.asarray(cols[c], dtype=np.uint64) for c in EVENT_KEYS)
+
+
+def matchEntries(tree, friendTree, keys=None, fkeys=None):
+    """For every entry of tree, find the entry of friendTree with the same (run, luminosityBlock, event).
+
+       The join is done with a single sort of the keys of both trees, so it does
+       not depend on the ordering of the two trees nor on them having been
+       skimmed in the same way. Returns a numpy array with the friend entry
+       number for each entry of tree, -1 where there is no matching event.
+       The keys of the trees (see eventIndex) can be passed if already read.
+    """
+    import numpy as np
+    if keys is None:
+        keys = eventIndex(tree)
+    if fkeys is None:
+        fkeys = eventIndex(friendTree)
+    n, nf = len(keys[0]), len(fkeys[0])
+    run, lumi, event = [np.concatenate([f, k]) for f, k in zip(fkeys, keys)]
+    # friend entries come first, and sort before main entries with the same key
+    isMain = np.concatenate([np.zeros(nf, dtype=bool), np.ones(n, dtype=bool)])
+    entry = np.concatenate([np.arange(nf), np.arange(n)])
+    order = np.lexsort((isMain, event, lumi, run))
+    run, lumi, event, isMain, entry = run[order], lumi[order], event[order], isMain[order], entry[order]
+    # position of the last friend entry at or before each position in the sorted keys
+    pos = np.arange(n + nf)
+    lastFriend = np.maximum.accumulate(np.where(isMain, -1, pos))
+    cand = np.maximum(lastFriend, 0)
+    found = (lastFriend >= 0) & (run[cand] == run) & (lumi[cand] == lumi) & (event[cand] == event)
+    matched = np.full(n, -1, dtype=np.int64)
+    matched[entry[isMain]] = np.where(found[isMain], entry[cand][isMain], -1)
+    return matched
+
+
+def attachIndexedFriend(tree, friendTree, matched=None):
+    """Attach friendTree to tree through a (run, luminosityBlock, event) TTreeIndex instead of the entry number.
+
+       Returns the array of matching friend entries (see matchEntries), to find the unmatched events.
+    """
+    if not hasEventKeys(friendTree):
+        raise RuntimeError("Friend tree %s has no run/luminosityBlock/event branches, it cannot be matched by event "
+                           "(friend trees written before the keys were stored must be attached by entry)" % friendTree.GetName())
+    if matched is None:
+        keys, fkeys = eventIndex(tree), eventIndex(friendTree)
+        if any(len(k[0]) and k[0].max() >= (1 << 31) for k in (keys, fkeys)):
+            raise RuntimeError("Run numbers from 2^31 do not fit in the TTreeIndex major key %s" % INDEX_MAJOR)
+        matched = matchEntries(tree, friendTree, keys, fkeys)
+    friendTree.BuildIndex(INDEX_MAJOR, INDEX_MINOR)
+    tree.AddFriend(friendTree)
+    return matched
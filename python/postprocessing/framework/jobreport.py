@@ -1,4 +1,5 @@
 import xml.etree.cElementTree as ET
+import hashlib
 import re
 #import lxml.etree.ElementTree as ET
 
@@ -18,10 +19,19 @@ class JobReport:
                       Name="Parameter-untracked-string-cacheHint", Value="application-only")
         ET.SubElement(self.performancesummary, "Metric",
                       Name="Parameter-untracked-string-readHint", Value="auto-detect")
-        ET.SubElement(self.performancesummary, "Metric",
+        self.readMegabytes = ET.SubElement(self.performancesummary, "Metric",
                       Name="ROOT-tfile-read-totalMegabytes", Value="0")
-        ET.SubElement(self.performancesummary, "Metric",
+        self.writeMegabytes = ET.SubElement(self.performancesummary, "Metric",
                       Name="ROOT-tfile-write-totalMegabytes", Value="0")
+        self.readOperations = ET.SubElement(self.performancesummary, "Metric",
+                      Name="ROOT-tfile-read-numOperations", Value="0")
+        self.readMsecs = ET.SubElement(self.performancesummary, "Metric",
+                      Name="ROOT-tfile-read-totalMsecs", Value="0")
+        self.unzipMsecs = ET.SubElement(self.performancesummary, "Metric",
+                      Name="ROOT-tfile-unzip-totalMsecs", Value="0")
+        self.timingsummary = ET.SubElement(
+            self.performancereport, "PerformanceSummary", Metric="Timing")
+        self._storage = {"readBytes": 0, "writeBytes": 0, "readCalls": 0, "readTime": 0., "unzipTime": 0.}
  # <Metric Name="Parameter-untracked-bool-enabled" Value="true"/>
  # <Metric Name="Parameter-untracked-bool-stats" Value="true"/>
  # <Metric Name="Parameter-untracked-string-cacheHint" Value="application-only"/>
@@ -33,6 +43,32 @@ class JobReport:
 # <GeneratorInfo>
 # </GeneratorInfo>
 
+    def addStorageStatistics(self, readBytes=0, readCalls=0, writeBytes=0, readTime=0., unzipTime=0.):
+        """Add the I/O done for one file (times in seconds), the totals are reported"""
+        st = self._storage
+        st["readBytes"] += readBytes
+        st["readCalls"] += readCalls
+        st["writeBytes"] += writeBytes
+        st["readTime"] += readTime
+        st["unzipTime"] += unzipTime
+        self.readMegabytes.set("Value", "%.3f" % (st["readBytes"] / 1024. ** 2))
+        self.writeMegabytes.set("Value", "%.3f" % (st["writeBytes"] / 1024. ** 2))
+        self.readOperations.set("Value", "%d" % st["readCalls"])
+        self.readMsecs.set("Value", "%.1f" % (1000 * st["readTime"]))
+        self.unzipMsecs.set("Value", "%.1f" % (1000 * st["unzipTime"]))
+
+    def setTiming(self, totalTime, events, moduleTimes=None):
+        """Report the total job time, the event rate and the time (in seconds) spent in each module"""
+        self.timingsummary.clear()
+        self.timingsummary.set("Metric", "Timing")
+        ET.SubElement(self.timingsummary, "Metric",
+                      Name="TotalJobTime", Value="%.3f" % totalTime)
+        ET.SubElement(self.timingsummary, "Metric",
+                      Name="EventThroughput", Value="%.3f" % (events / totalTime if totalTime > 0 else 0))
+        for name, t in (moduleTimes or {}).items():
+            ET.SubElement(self.timingsummary, "Metric",
+                          Name="Module-%s-totalMsecs" % name, Value="%.1f" % (1000 * t))
+
     def addInputFile(self, filename, eventsRead=1, runsAndLumis={"1": [1]}):
         infile = ET.SubElement(self.fjr, "InputFile")
         ET.SubElement(infile, "LFN").text = re.sub(
@@ -50,7 +86,7 @@ class JobReport:
             for l in ls:
                 ET.SubElement(run, "LumiSection", ID="%s" % l)
 
-    def addOutputFile(self, filename, events=1, runsAndLumis={"1": [1]}):
+    def addOutputFile(self, filename, events=1, runsAndLumis={"1": [1]}, branchHash="dc90308e392b2fa1e0eff46acbfa24bc"):
         infile = ET.SubElement(self.fjr, "File")
         ET.SubElement(infile, "LFN").text = ""
         ET.SubElement(infile, "PFN").text = filename
@@ -59,8 +95,7 @@ class JobReport:
         ET.SubElement(infile, "OutputModuleClass").text = "PoolOutputModule"
         ET.SubElement(infile, "GUID").text = ""
         ET.SubElement(infile, "DataType").text = ""
-        ET.SubElement(
-            infile, "BranchHash").text = "dc90308e392b2fa1e0eff46acbfa24bc"
+        ET.SubElement(infile, "BranchHash").text = branchHash
         ET.SubElement(infile, "TotalEvents").text = "%s" % events
         runs = ET.SubElement(infile, "Runs")
         for r, ls in runsAndLumis.items():
@@ -72,3 +107,27 @@ class JobReport:
         tree = ET.ElementTree(self.fjr)
         tree.write(filename)  # , pretty_print=True)
         pass
+
+
+def runsAndLumis(tfile, jsonFilter=None):
+    """Return the {run: [lumis]} content of the LuminosityBlocks tree of tfile, optionally filtered by a JSONFilter"""
+    ret = {}
+    tree = tfile.Get("LuminosityBlocks")
+    if not tree:
+        return ret
+    for i in range(tree.GetEntries()):
+        tree.GetEntry(i)
+        run, lumi = int(tree.run), int(tree.luminosityBlock)
+        if jsonFilter and not jsonFilter.filterRunLumi(run, lumi):
+            continue
+        ret.setdefault(str(run), set()).add(lumi)
+    return dict((r, sorted(ls)) for r, ls in ret.items())
+
+
+def branchHash(tree):
+    """Hash of the names and types of the branches of tree, to identify the output content"""
+    h = hashlib.md5()
+    for name, typ in sorted((b.GetName(), b.GetLeaf(b.GetName()).GetTypeName() if b.GetLeaf(b.GetName()) else "")
+                            for b in tree.GetListOfBranches()):
+        h.update(("%s/%s;" % (name, typ)).encode("utf-8"))
+    return h.hexdigest()
@@ -1,4 +1,5 @@
 from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import setExtraBranch
+from PhysicsTools.NanoAODTools.postprocessing.framework.friends import EventChecksum, EVENT_KEYS
 from array import array
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
@@ -188,3 +189,21 @@ class FriendOutput(OutputTree):
         outputTree = ROOT.TTree(
             treeName, "Friend tree for " + inputTree.GetName())
         OutputTree.__init__(self, outputFile, outputTree, inputTree)
+        # friends are attached entry by entry, keep track of which events were written
+        self._checksum = EventChecksum()
+        # and store the event keys, to attach them by event instead (--friend-index)
+        self._keys = [OutputBranch(outputTree, name, t) for name, t in zip(EVENT_KEYS, "iil")]
+
+    def fill(self):
+        key = [self._intree.readBranch(name) for name in EVENT_KEYS]
+        for branch, value in zip(self._keys, key):
+            branch.fill(value)
+        self._checksum.add(*key)
+        OutputTree.fill(self)
+
+    def checksum(self):
+        return self._checksum
+
+    def write(self):
+        OutputTree.write(self)
+        self._checksum.write(self._file)
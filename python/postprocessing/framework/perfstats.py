@@ -0,0 +1,113 @@
+import os
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+
+class IOProfiler:
+    """Measure where the input I/O time goes, to tune the input branch
+       selection and the basket layout.
+
+       For every input file a TTreePerfStats is attached to the tree during the
+       event loop (its graph is saved to the output ROOT file). After the loop,
+       the baskets of each active branch covering the processed entries are
+       loaded once more with a dedicated TTreePerfStats, which gives the disk
+       read and unzip time of every branch. The branches are reported sorted by
+       their total cost, in a text file and as histograms in the ROOT file.
+    """
+
+    def __init__(self, outFileName):
+        self.outFileName = outFileName
+        self.nFiles = 0
+        self._perfs = []
+        # branch name -> [disk time, unzip time, bytes read, read calls, zip bytes, tot bytes, baskets]
+        self.branchStats = {}
+
+    def beginFile(self, inTree):
+        """Attach the TTreePerfStats for the event loop, returned so it can be reused"""
+        self._perf = ROOT.TTreePerfStats("ioperf_%d" % self.nFiles, inTree)
+        self.nFiles += 1
+        return self._perf
+
+    def endFile(self, inTree, firstEntry, nEntries):
+        """Profile the active branches, to be called after the event loop and perf.Finish()"""
+        self._perfs.append(self._perf)
+        # read the baskets from the file, not from the TTreeCache filled by the event loop
+        inTree.SetCacheSize(0)
+        for b in inTree.GetListOfBranches():
+            if inTree.GetBranchStatus(b.GetName()):
+                self.profileBranch(inTree, b, firstEntry, firstEntry + nEntries)
+        # do not leave the last per-branch monitor active
+        inTree.SetPerfStats(ROOT.nullptr)
+        ROOT.gROOT.ProcessLine("gPerfStats = nullptr;")
+
+    def profileBranch(self, tree, branch, firstEntry, lastEntry):
+        name = branch.GetName()
+        perf = ROOT.TTreePerfStats("ioperf_" + name, tree)
+        nBaskets = branch.GetWriteBasket()
+        basketEntry = branch.GetBasketEntry()
+        zipBytes = 0
+        totBytes = 0
+        used = 0
+        branch.DropBaskets("all")
+        for ib in range(nBaskets):
+            end = basketEntry[ib + 1] if ib + 1 < nBaskets else branch.GetEntries()
+            if end <= firstEntry or basketEntry[ib] >= lastEntry:
+                continue
+            basket = branch.GetBasket(ib)
+            if basket:
+                zipBytes += basket.GetNbytes()
+                totBytes += basket.GetObjlen()
+                used += 1
+            branch.DropBaskets("all")
+        perf.Finish()
+        st = self.branchStats.setdefault(name, [0., 0., 0, 0, 0, 0, 0])
+        st[0] += perf.GetDiskTime()
+        st[1] += perf.GetUnzipTime()
+        st[2] += perf.GetBytesRead()
+        st[3] += perf.GetReadCalls()
+        st[4] += zipBytes
+        st[5] += totBytes
+        st[6] += used
+
+    def sortedStats(self):
+        return sorted(self.branchStats.items(), key=lambda kv: kv[1][0] + kv[1][1], reverse=True)
+
+    def report(self):
+        stats = self.sortedStats()
+        totRead = sum(st[0] for _, st in stats)
+        totUnzip = sum(st[1] for _, st in stats)
+        lines = ["%-50s %10s %10s %7s %10s %10s %6s %8s" % (
+            "branch", "read [s]", "unzip [s]", "cost %", "zip [MB]", "tot [MB]", "ratio", "baskets")]
+        for name, (disk, unzip, nread, ncalls, zipb, totb, nb) in stats:
+            lines.append("%-50s %10.4f %10.4f %7.2f %10.3f %10.3f %6.2f %8d" % (
+                name, disk, unzip, 100. * (disk + unzip) / max(totRead + totUnzip, 1e-9),
+                zipb / 1024. ** 2, totb / 1024. ** 2, totb / float(zipb) if zipb else 0, nb))
+        lines.append("Total over %d branches: read %.3f s, unzip %.3f s" % (len(stats), totRead, totUnzip))
+        return "\n".join(lines)
+
+    def save(self):
+        text = self.report()
+        print(text)
+        with open(os.path.splitext(self.outFileName)[0] + ".txt", "w") as f:
+            f.write(text + "\n")
+
+        prevdir = ROOT.gDirectory
+        outFile = ROOT.TFile.Open(self.outFileName, "RECREATE")
+        for perf in self._perfs:
+            # contains the I/O vs entry graph, use perf.Draw() to display it
+            perf.Write()
+        stats = self.sortedStats()
+        hists = [ROOT.TH1D(hname, title, max(len(stats), 1), 0, max(len(stats), 1)) for hname, title in (
+            ("branchReadTime", "disk read time per branch;;s"),
+            ("branchUnzipTime", "unzip time per branch;;s"),
+            ("branchZipBytes", "compressed size per branch;;bytes"),
+            ("branchTotBytes", "uncompressed size per branch;;bytes"))]
+        for i, (name, st) in enumerate(stats):
+            for h, val in zip(hists, (st[0], st[1], st[4], st[5])):
+                h.GetXaxis().SetBinLabel(i + 1, name)
+                h.SetBinContent(i + 1, val)
+        for h in hists:
+            h.Write()
+        outFile.Close()
+        prevdir.cd()
+        print("I/O profile written to %s" % self.outFileName)
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
-from PhysicsTools.NanoAODTools.postprocessing.framework.jobreport import JobReport
+from PhysicsTools.NanoAODTools.postprocessing.framework.jobreport import JobReport, runsAndLumis, branchHash
 from PhysicsTools.NanoAODTools.postprocessing.framework.preskimming import preSkim
 from PhysicsTools.NanoAODTools.postprocessing.framework.output import FriendOutput, FullOutput
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import eventLoop
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import InputTree
 from PhysicsTools.NanoAODTools.postprocessing.framework.branchselection import BranchSelection
+from PhysicsTools.NanoAODTools.postprocessing.framework.perfstats import IOProfiler
+from PhysicsTools.NanoAODTools.postprocessing.framework.friends import readChecksum, verifyFriend, attachIndexedFriend
 import os
 import time
 import hashlib
@@ -20,7 +22,8 @@ class PostProcessor:
             noOut=False, justcount=False, provenance=False, haddFileName=None,
             fwkJobReport=False, histFileName=None, histDirName=None,
             outputbranchsel=None, maxEntries=None, firstEntry=0, prefetch=False,
-            longTermCache=False
+            longTermCache=False, friendIndex=False, cacheSize=50, asyncPrefetch=False,
+            perfStats=None, outputCallback=None
     ):
         self.outputDir = outputDir
         self.inputFiles = inputFiles
@@ -58,6 +61,16 @@ class PostProcessor:
         self.prefetch = prefetch  # prefetch files to TMPDIR using xrdcp
         # keep cached files across runs (it's then up to you to clean up the temp)
         self.longTermCache = longTermCache
+        # match friends given as 'fname,ffname' by (run, luminosityBlock, event) instead of entry number
+        self.friendIndex = friendIndex
+        # size in MB of the TTreeCache used to read the input (0 to disable)
+        self.cacheSize = cacheSize
+        # let TFile prefetch the next cache block in the background while processing
+        self.asyncPrefetch = asyncPrefetch
+        # ROOT file where to write a per-branch I/O profile of the input (None to disable)
+        self.ioProfiler = IOProfiler(perfStats) if perfStats else None
+        # called with the name of each output file once it is closed, e.g. to merge it while the next ones are processed
+        self.outputCallback = outputCallback
 
     def prefetchFile(self, fname, verbose=True):
         tmpdir = os.environ['TMPDIR'] if 'TMPDIR' in os.environ else "/tmp"
@@ -95,6 +108,43 @@ class PostProcessor:
                     pass
             return fname, False
 
+    def matchedEntryList(self, matched, elist, nEntries):
+        """Restrict the entries to process (elist, or the whole range if None) to those with a matched friend"""
+        inRange = matched[self.firstEntry:self.firstEntry + nEntries] >= 0
+        if elist:
+            # only the unmatched entries are looked up, the pre-selected ones are not walked in python
+            matchedList = elist.Clone('matchedList')
+            for entry in (~inRange).nonzero()[0]:
+                matchedList.Remove(int(entry) + self.firstEntry)
+        else:
+            matchedList = ROOT.TEntryList('matchedList', 'matchedList')
+            for entry in inRange.nonzero()[0]:
+                matchedList.Enter(int(entry) + self.firstEntry)
+        return matchedList
+
+    def setupReadCache(self, inFile, inTree, nEntries):
+        """Read the active branches of inTree through a TTreeCache, so that
+           their baskets are fetched with a few vectored reads per cluster
+           instead of one request per basket"""
+        if not self.cacheSize:
+            return
+        inTree.SetCacheSize(int(self.cacheSize * 1024 * 1024))
+        inTree.SetCacheEntryRange(self.firstEntry, self.firstEntry + nEntries)
+        nActive = 0
+        for b in inTree.GetListOfBranches():
+            if inTree.GetBranchStatus(b.GetName()):
+                inTree.AddBranchToCache(b, True)
+                nActive += 1
+        # the set of branches is known, no need to learn it from the first entries
+        inTree.StopCacheLearningPhase()
+        print('Using a %d MB TTreeCache for %d active branches' % (self.cacheSize, nActive))
+
+    def printReadStats(self, inFile, inTree, fname):
+        cache = inFile.GetCacheRead(inTree)
+        print('Read %.2f MB from %s in %d read calls%s' % (
+            inFile.GetBytesRead() / 1024. ** 2, fname, inFile.GetReadCalls(),
+            ' (TTreeCache efficiency %.1f%%)' % (100 * cache.GetEfficiency()) if cache else ''))
+
     def run(self):
         outpostfix = self.postfix if self.postfix is not None else (
             "_Friend" if self.friend else "_Skim")
@@ -142,7 +192,12 @@ class PostProcessor:
             else:
                 m.beginJob()
 
+        if self.asyncPrefetch:
+            # needs to be set before opening the input files
+            ROOT.gEnv.SetValue("TFile.AsyncPrefetching", 1)
+
         fullClone = (len(self.modules) == 0)
+        moduleTimes = [0.] * len(self.modules) if self.jobReport else None
         outFileNames = []
         t0 = time.time()
         totEntriesRead = 0
@@ -185,6 +240,17 @@ class PostProcessor:
                 if inAddTree is None:
                     inAddTree = inAddFiles[-1].Get("Friends")
                 inAddTrees.append(inAddTree)
+                if self.friendIndex:
+                    matched = attachIndexedFriend(inTree, inAddTree)
+                    unmatched = matched < 0
+                    print('Friend %s: matched %d / %d entries by (run, luminosityBlock, event), %d unmatched entries will be skipped' % (
+                        ffname, len(matched) - unmatched.sum(), len(matched), unmatched.sum()))
+                    if unmatched.any():
+                        elist = self.matchedEntryList(matched, elist, nEntries)
+                    continue
+                if readChecksum(inAddFiles[-1]) is not None:
+                    # friend written by a systematics pass: check it is aligned with this tree
+                    verifyFriend(inTree, inAddFiles[-1])
                 inTree.AddFriend(inAddTree)
 
             if fullClone:
@@ -197,6 +263,8 @@ class PostProcessor:
                     inTree = InputTree(inTree, elist)
                 else:
                     inTree = InputTree(inTree)
+                # the file read may be a local copy (prefetch), keep the name it was given with
+                inTree.inputFileName = fname
 
             # prepare output file
             if not self.noOut:
@@ -230,24 +298,47 @@ class PostProcessor:
 
             # process events, if needed
             if not fullClone:
+                self.setupReadCache(inFile, inTree, nEntries)
+                if self.ioProfiler:
+                    perfStats = self.ioProfiler.beginFile(inTree)
+                else:
+                    perfStats = ROOT.TTreePerfStats("ioperf", inTree) if self.jobReport else None
                 eventRange = range(self.firstEntry, self.firstEntry +
                                     nEntries) if nEntries > 0 and not elist else None
+                # friend trees must keep one entry per input entry to stay aligned
                 (nall, npass, timeLoop) = eventLoop(
                     self.modules, inFile, outFile, inTree, outTree,
-                    eventRange=eventRange, maxEvents=self.maxEntries
+                    eventRange=eventRange, maxEvents=self.maxEntries,
+                    filterOutput=not self.friend, moduleTimes=moduleTimes
                 )
+                if perfStats:
+                    perfStats.Finish()
                 print('Processed %d preselected entries from %s (%s entries). Finally selected %d entries' % (nall, fname, nEntries, npass))
             else:
                 nall = nEntries
+                perfStats = None
                 print('Selected %d / %d entries from %s (%.2f%%)' % (outTree.tree().GetEntries(), nall, fname, outTree.tree().GetEntries() / (0.01 * nall) if nall else 0))
 
+            bytesRead, readCalls = inFile.GetBytesRead(), inFile.GetReadCalls()
+            self.printReadStats(inFile, inTree, fname)
+            if self.ioProfiler and not fullClone:
+                # the per-branch pass reads the input again, after the numbers above are taken
+                self.ioProfiler.endFile(inTree, self.firstEntry, nEntries)
+
             # now write the output
             if not self.noOut:
                 outTree.write()
                 outFile.Close()
                 print("Done %s" % outFileName)
+                if self.outputCallback:
+                    self.outputCallback(outFileName)
             if self.jobReport:
-                self.jobReport.addInputFile(fname, nall)
+                self.jobReport.addInputFile(fname, nall, runsAndLumis(inFile, jsonFilter))
+                self.jobReport.addStorageStatistics(
+                    readBytes=bytesRead, readCalls=readCalls,
+                    writeBytes=outFile.GetBytesWritten() if outFile else 0,
+                    readTime=perfStats.GetDiskTime() if perfStats else 0.,
+                    unzipTime=perfStats.GetUnzipTime() if perfStats else 0.)
             if self.prefetch:
                 if toBeDeleted:
                     os.unlink(ftoread)
@@ -255,6 +346,9 @@ class PostProcessor:
         for m in self.modules:
             m.endJob()
 
+        if self.ioProfiler:
+            self.ioProfiler.save()
+
         print("Total time %.1f sec. to process %i events. Rate = %.1f Hz." % ((time.time() - t0), totEntriesRead, totEntriesRead / (time.time() - t0)))
 
         if self.haddFileName:
@@ -263,5 +357,22 @@ class PostProcessor:
             os.system("%s %s %s" %
                       (haddnano, self.haddFileName, " ".join(outFileNames)))
         if self.jobReport:
-            self.jobReport.addOutputFile(self.haddFileName)
+            moduleNames = []
+            for m in self.modules:
+                name = m.__class__.__name__
+                moduleNames.append(name if name not in moduleNames else "%s_%d" % (name, len(moduleNames)))
+            self.jobReport.setTiming(time.time() - t0, totEntriesRead,
+                                     dict(zip(moduleNames, moduleTimes)))
+            haddFile = ROOT.TFile.Open(self.haddFileName)
+            try:
+                events = haddFile.Get("Events" if not self.friend else "Friends") if haddFile and not haddFile.IsZombie() else None
+                if events:
+                    self.jobReport.addOutputFile(self.haddFileName, events.GetEntries(),
+                                                 runsAndLumis(haddFile), branchHash(events))
+                else:
+                    print("Could not read %s, the job report will have no output file content" % self.haddFileName)
+                    self.jobReport.addOutputFile(self.haddFileName)
+            finally:
+                if haddFile:
+                    haddFile.Close()
             self.jobReport.save()
@@ -20,6 +20,9 @@ class LeptonEfficiencyCorrector {
 
   float getSF(int pdgid, float pt, float eta);
   float getSFErr(int pdgid, float pt, float eta);
+  // same as getSF / getSFErr for n leptons at once, the results are written to out
+  void getSFs(int n, const int *pdgid, const float *pt, const float *eta, float *out);
+  void getSFErrs(int n, const int *pdgid, const float *pt, const float *eta, float *out);
   const std::vector<float> & run();
 
 private:
@@ -82,6 +85,31 @@ float LeptonEfficiencyCorrector::getSFErr(int pdgid, float pt, float eta) {
   return out;
 }
 
+void LeptonEfficiencyCorrector::getSFs(int n, const int *pdgid, const float *pt, const float *eta, float *out) {
+  std::vector<float> x(n), y(n);
+  for(int i=0; i<n; ++i) {
+    x[i] = abs(pdgid[i])==13 ? pt[i] : eta[i];
+    y[i] = abs(pdgid[i])==13 ? fabs(eta[i]) : pt[i];
+    out[i] = 1.;
+  }
+  for(std::vector<TH2F*>::iterator hist=effmaps_.begin(); hist<effmaps_.end(); ++hist) {
+    WeightCalculatorFromHistogram wc(*hist);
+    for(int i=0; i<n; ++i) out[i] *= wc.getWeight(x[i],y[i]);
+  }
+}
+
+void LeptonEfficiencyCorrector::getSFErrs(int n, const int *pdgid, const float *pt, const float *eta, float *out) {
+  std::vector<float> y(n);
+  for(int i=0; i<n; ++i) {
+    y[i] = abs(pdgid[i])==13 ? fabs(eta[i]) : eta[i];
+    out[i] = 1.;
+  }
+  for(std::vector<TH2F*>::iterator hist=effmaps_.begin(); hist<effmaps_.end(); ++hist) {
+    WeightCalculatorFromHistogram wc(*hist);
+    for(int i=0; i<n; ++i) out[i] *= wc.getWeightErr(pt[i],y[i]);
+  }
+}
+
 const std::vector<float> & LeptonEfficiencyCorrector::run() {
   ret_.clear();
   for (int iL = 0, nL = nLep_; iL < nL; ++iL) {
@@ -2,8 +2,9 @@
 # https://twiki.cern.ch/twiki/bin/viewauth/CMS/TauIDRecommendationForRun2
 # Source: https://github.com/cms-tau-pog/TauIDSFs
 import os
+import numpy as np
 from math import sqrt
-from PhysicsTools.NanoAODTools.postprocessing.tools import ensureTFile, extractTH1
+from PhysicsTools.NanoAODTools.postprocessing.tools import ensureTFile, extractTH1, HistArrays, evalTF1
 datapath  = os.path.join(os.environ.get('CMSSW_BASE','CMSSW_BASE'),"src/PhysicsTools/NanoAODTools/python/postprocessing/data/tau")
 campaigns = ['2016Legacy','2017ReReco','2018ReReco']
 
@@ -38,9 +39,12 @@ class TauIDSFTool:
             self.hist = extractTH1(file,wp)
             self.hist.SetDirectory(0)
             file.Close()
+            self.histArrays = HistArrays(self.hist)
             self.DMs = [0,1,10] if 'oldDM' in id else [0,1,10,11]
             self.getSFvsPT  = self.disabled
             self.getSFvsEta = self.disabled
+            self.getSFvsPTArray  = self.disabled
+            self.getSFvsEtaArray = self.disabled
             if otherVSlepWP:
               if emb:
                 self.extraUnc = 0.05
@@ -61,11 +65,14 @@ class TauIDSFTool:
             file.Close()
             self.getSFvsDM  = self.disabled
             self.getSFvsEta = self.disabled
+            self.getSFvsDMArray  = self.disabled
+            self.getSFvsEtaArray = self.disabled
             if otherVSlepWP:
               if emb:
-                self.extraUnc = lambda pt: (0.05 if pt<100 else 0.15)
+                self.extraUncPt = (0.05,0.15) # below / above 100 GeV
               else:
-                self.extraUnc = lambda pt: (0.03 if pt<100 else 0.15)
+                self.extraUncPt = (0.03,0.15)
+              self.extraUnc = lambda pt: (self.extraUncPt[0] if pt<100 else self.extraUncPt[1])
         elif id in ['antiMu3','antiEleMVA6','DeepTau2017v2p1VSmu','DeepTau2017v2p1VSe']:
             if emb:
               raise IOError("Scale factors for embedded samples not available for ID '%s'!"%id)
@@ -74,9 +81,12 @@ class TauIDSFTool:
             self.hist = extractTH1(file,wp)
             self.hist.SetDirectory(0)
             file.Close()
+            self.histArrays = HistArrays(self.hist)
             self.genmatches = [1,3] if any(s in id.lower() for s in ['ele','vse']) else [2,4]
             self.getSFvsPT  = self.disabled
             self.getSFvsDM  = self.disabled
+            self.getSFvsPTArray = self.disabled
+            self.getSFvsDMArray = self.disabled
         else:
           raise IOError("Did not recognize tau ID '%s'!"%id)
     
@@ -141,11 +151,57 @@ class TauIDSFTool:
           return 1.0, 1.0, 1.0
         return 1.0
     
+    def getSFvsPTArray(self, pt, genmatch=5, unc=None):
+        """Get tau ID SF vs. tau pT for arrays of taus, same as getSFvsPT."""
+        pt   = np.asarray(pt,dtype=np.float64)
+        sel  = np.broadcast_to(np.asarray(genmatch)==5,pt.shape)
+        func = lambda key: np.where(sel,evalTF1(self.func[key],pt),1.)
+        sf   = func(None)
+        if self.extraUnc:
+          extraUnc = np.where(pt<100,self.extraUncPt[0],self.extraUncPt[1])
+          errDown  = np.where(sel,np.sqrt( (sf-func('Down'))**2 + (sf*extraUnc)**2 ),0.)
+          errUp    = np.where(sel,np.sqrt( (sf-func('Up'  ))**2 + (sf*extraUnc)**2 ),0.)
+          return selectUnc(sf-errDown,sf,sf+errUp,unc)
+        if unc in ['Up','Down','All']:
+          return selectUnc(func('Down'),sf,func('Up'),unc)
+        return sf
+    
+    def getSFvsDMArray(self, pt, dm, genmatch=5, unc=None):
+        """Get tau ID SF vs. tau DM for arrays of taus, same as getSFvsDM."""
+        pt  = np.asarray(pt,dtype=np.float64)
+        sel = (np.asarray(genmatch)==5) & np.isin(dm,self.DMs) & (pt>40)
+        sf  = np.where(sel,self.histArrays.getBinContent(dm),1.)
+        err = np.where(sel,self.histArrays.getBinError(dm),0.)
+        if self.extraUnc:
+          err = np.where(sel,np.sqrt( err**2 + (sf*self.extraUnc)**2 ),0.)
+        return selectUnc(sf-err,sf,sf+err,unc)
+    
+    def getSFvsEtaArray(self, eta, genmatch, unc=None):
+        """Get tau ID SF vs. tau eta for arrays of taus, same as getSFvsEta."""
+        eta = np.abs(np.asarray(eta,dtype=np.float64))
+        sel = np.broadcast_to(np.isin(genmatch,self.genmatches),eta.shape)
+        sf  = np.where(sel,self.histArrays.getBinContent(eta),1.)
+        err = np.where(sel,self.histArrays.getBinError(eta),0.)
+        if self.extraUnc:
+          err = np.where(sel,np.sqrt( err**2 + (sf*self.extraUnc)**2 ),0.)
+        return selectUnc(sf-err,sf,sf+err,unc)
+    
     @staticmethod
     def disabled(*args,**kwargs):
         raise AttributeError("Disabled method.")
     
 
+def selectUnc(down, central, up, unc):
+    """Return the arrays for the variation unc (all three as (down, central, up) for 'All')."""
+    if unc=='Up':
+      return up
+    elif unc=='Down':
+      return down
+    elif unc=='All':
+      return down, central, up
+    return central
+    
+
 class TauESTool:
     def __init__(self, year, id='DeepTau2017v2p1VSjet', path=datapath):
         """Choose the IDs and WPs for SFs."""
@@ -156,6 +212,8 @@ class TauESTool:
         self.hist_highpt = extractTH1(file_highpt,'tes')
         self.hist_lowpt.SetDirectory(0)
         self.hist_highpt.SetDirectory(0)
+        self.arrays_lowpt  = HistArrays(self.hist_lowpt)
+        self.arrays_highpt = HistArrays(self.hist_highpt)
         self.pt_low  = 34  # average pT in Z -> tautau measurement (incl. in DM)
         self.pt_high = 170 # average pT in W* -> taunu measurement (incl. in DM)
         self.DMs     = [0,1,10] if "oldDM" in id else [0,1,10,11]
@@ -189,6 +247,22 @@ class TauESTool:
           return 1.0, 1.0, 1.0
         return 1.0
     
+    def getTESArray(self, pt, dm, genmatch=5, unc=None):
+        """Get tau ES vs. tau DM for arrays of taus, same as getTES."""
+        pt       = np.asarray(pt,dtype=np.float64)
+        sel      = (np.asarray(genmatch)==5) & np.isin(dm,self.DMs)
+        tes      = np.where(sel,self.arrays_lowpt.getBinContent(dm),1.)
+        if unc is None:
+          return tes
+        err_low  = self.arrays_lowpt.getBinError(dm)
+        err_high = self.arrays_highpt.getBinError(dm)
+        err      = np.where(pt>=self.pt_high,err_high, # high pT
+                   np.where(pt>self.pt_low, # linearly interpolate between low and high pT
+                            err_low + (err_high-err_low)/(self.pt_high-self.pt_low)*(pt-self.pt_low),
+                            err_low)) # low pT
+        err      = np.where(sel,err,0.)
+        return selectUnc(tes-err,tes,tes+err,unc)
+    
     def getTES_highpt(self, dm, genmatch=5, unc=None):
         """Get tau ES vs. tau DM for pt > 100 GeV"""
         if genmatch==5 and dm in self.DMs:
@@ -227,6 +301,8 @@ class TauFESTool:
         self.FESs       = FESs
         self.DMs        = [0,1]
         self.genmatches = [1,3]
+        # (down, central, up) FES as an array indexed by [region][dm]
+        self.FESArray   = np.array([[FESs[region][dm] for dm in DMs] for region in ['barrel','endcap']])
     
     def getFES(self, eta, dm, genmatch=1, unc=None):
         """Get electron -> tau FES vs. tau DM."""
@@ -244,3 +320,12 @@ class TauFESTool:
           return 1.0, 1.0, 1.0
         return 1.0
     
+    def getFESArray(self, eta, dm, genmatch=1, unc=None):
+        """Get electron -> tau FES vs. tau DM for arrays of taus, same as getFES."""
+        eta    = np.asarray(eta,dtype=np.float64)
+        dm     = np.asarray(dm).astype(np.int64)
+        sel    = np.isin(dm,self.DMs) & np.isin(genmatch,self.genmatches)
+        region = np.where(np.abs(eta)<1.5,0,1)
+        fes    = self.FESArray[region,np.where(sel,dm,0)]
+        fes    = np.where(sel[:,None],fes,1.)
+        return selectUnc(fes[:,0],fes[:,1],fes[:,2],unc)
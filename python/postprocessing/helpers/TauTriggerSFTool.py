@@ -9,7 +9,9 @@ Source: https://github.com/cms-tau-pog/TauTriggerSFs
 '''
 import os
 import ROOT
+import numpy as np
 from math import sqrt
+from PhysicsTools.NanoAODTools.postprocessing.tools import HistArrays, evalTF1
 datapath  = os.path.join(os.environ.get('CMSSW_BASE','CMSSW_BASE'),"src/PhysicsTools/NanoAODTools/python/postprocessing/data/tau")
 
 
@@ -92,6 +94,9 @@ class TauTriggerSFTool :
         self.effEtaPhiAvgMCMap[ 1 ] = self.f.Get('%s_%s%s_dm1_MC_AVG' % (etaPhiTrigger, etaPhiWP, self.wpType) )
         self.effEtaPhiAvgMCMap[ 10 ] = self.f.Get('%s_%s%s_dm10_MC_AVG' % (etaPhiTrigger, etaPhiWP, self.wpType) )
 
+        # Arrays of the histogram contents for the array methods, filled when first needed
+        self.histArrays = {}
+
 
     # Make sure we stay on our histograms
     def ptCheck( self, pt ) :
@@ -265,3 +270,98 @@ class TauTriggerSFTool :
             return sf * (1. - deltaSF)
     
 
+
+    # Array versions of the methods above, for arrays of taus (pt, eta, phi and dm arrays)
+    def getHistArrays( self, hist ) :
+        key = hist.GetName()
+        if key not in self.histArrays :
+            self.histArrays[ key ] = HistArrays( hist )
+        return self.histArrays[ key ]
+
+    def ptCheckArray( self, pt ) :
+        return np.clip( np.asarray( pt, dtype=np.float64 ), 20, 450 )
+
+    def dmCheckArray( self, dm ) :
+        dm = np.asarray( dm ).astype( np.int64 )
+        dm = np.where( dm == 2, 1, dm )
+        assert( np.isin( dm, [0, 1, 10] ).all() ), "Efficiencies only provided for DMs 0, 1, 10.  You provided DMs %s" % np.unique( dm )
+        return dm
+
+    def getEfficiencyArray( self, pt, eta, phi, fit, uncHist, etaPhiHist, etaPhiAvgHist, uncert='Nominal') :
+        pt = self.ptCheckArray( pt )
+        eff = evalTF1( fit, pt )
+        if uncert != 'Nominal' :
+            assert( uncert in ['Up', 'Down'] ), "Uncertainties are provided using 'Up'/'Down'"
+            err = self.getHistArrays( uncHist ).getBinError( pt )
+            eff = eff + err if uncert == 'Up' else eff - err
+        eta = np.asarray( eta, dtype=np.float64 )
+        eta = np.where( eta == 2.1, 2.09, np.where( eta == -2.1, -2.09, eta ) )
+        etaPhiVal = self.getHistArrays( etaPhiHist ).getBinContent( eta, phi )
+        etaPhiAvg = self.getHistArrays( etaPhiAvgHist ).getBinContent( eta, phi )
+        outside = etaPhiAvg <= 0.0
+        if outside.any() :
+            print("%d of the provided tau (eta, phi) values are outside the boundary of triggering taus" % outside.sum())
+            print("Returning efficiency = 0.0")
+        eff = eff * np.where( outside, 0., etaPhiVal ) / np.where( outside, 1., etaPhiAvg )
+        return np.clip( eff, 0., 1. ) # Some efficiency fits go negative at very low tau pT, prevent that.
+
+    def getTriggerEfficiencyArray( self, pt, eta, phi, dm, fitMap, uncMap, etaPhiMap, etaPhiAvgMap, uncert='Nominal' ) :
+        dm = self.dmCheckArray( dm )
+        pt, eta, phi = [ np.asarray( x, dtype=np.float64 ) for x in ( pt, eta, phi ) ]
+        eff = np.zeros( len( pt ) )
+        for mode in np.unique( dm ) :
+            sel = dm == mode
+            eff[ sel ] = self.getEfficiencyArray( pt[ sel ], eta[ sel ], phi[ sel ], fitMap[ mode ], uncMap[ mode ], \
+                etaPhiMap[ mode ], etaPhiAvgMap[ mode ], uncert )
+        return eff
+
+    def getTriggerEfficiencyDataArray( self, pt, eta, phi, dm, uncert='Nominal' ) :
+        return self.getTriggerEfficiencyArray( pt, eta, phi, dm, self.fitDataMap, self.fitUncDataMap, \
+            self.effEtaPhiDataMap, self.effEtaPhiAvgDataMap, uncert )
+
+    def getTriggerEfficiencyMCArray( self, pt, eta, phi, dm, uncert='Nominal' ) :
+        return self.getTriggerEfficiencyArray( pt, eta, phi, dm, self.fitMCMap, self.fitUncMCMap, \
+            self.effEtaPhiMCMap, self.effEtaPhiAvgMCMap, uncert )
+
+    def getBinnedScaleFactorArray( self, pt, dm ) :
+        pt = self.ptCheckArray( pt )
+        dm = self.dmCheckArray( dm )
+        sf, sfUnc = np.zeros( len( pt ) ), np.zeros( len( pt ) )
+        for mode in np.unique( dm ) :
+            sel = dm == mode
+            hist = self.getHistArrays( self.binnedSFMap[ mode ] )
+            sf[ sel ] = hist.getBinContent( pt[ sel ] )
+            sfUnc[ sel ] = hist.getBinError( pt[ sel ] )
+        return sf, sfUnc
+
+    def getTriggerScaleFactorArray( self, pt, eta, phi, dm, uncert='Nominal' ) :
+        """Data/MC scale factors of arrays of taus, same as getTriggerScaleFactor(Uncert)"""
+        assert( uncert in ['Nominal', 'Up', 'Down'] ), "Uncertainties are provided using 'Up'/'Down'"
+        pt = self.ptCheckArray( pt )
+        effData = self.getTriggerEfficiencyDataArray( pt, eta, phi, dm )
+        effMC = self.getTriggerEfficiencyMCArray( pt, eta, phi, dm )
+        lowMC = effMC < 1e-5
+        if lowMC.any() and uncert == 'Nominal' :
+            print("Eff MC is suspiciously low for %d taus. Please contact Tau POG." % lowMC.sum())
+        effMC = np.where( lowMC, 1., effMC )
+        sf = effData / effMC
+        if uncert != 'Nominal' :
+            effDataDown = self.getTriggerEfficiencyDataArray( pt, eta, phi, dm, 'Down' )
+            effMCDown = self.getTriggerEfficiencyMCArray( pt, eta, phi, dm, 'Down' )
+            relDataDiff = ( effData - effDataDown ) / np.where( effData != 0, effData, 1. )
+            relMCDiff = ( effMC - effMCDown ) / effMC
+            deltaSF = np.sqrt( relDataDiff**2 + relMCDiff**2 )
+        if(self.year == 2016):
+            if(self.trigger == 'ditau'): pt_recommended = 40
+            elif(self.trigger == 'mutau' or self.trigger  == 'etau'): pt_recommended = 25
+            sf_binned, deltaSF_binned = self.getBinnedScaleFactorArray( pt, dm )
+            useFit = pt > pt_recommended
+            sf = np.where( useFit, sf, sf_binned )
+            if uncert != 'Nominal' :
+                deltaSF = np.where( useFit, deltaSF, deltaSF_binned )
+        sf = np.where( lowMC, 0., sf )
+        if uncert == 'Up' :
+            return sf * (1. + deltaSF)
+        elif uncert == 'Down' :
+            return sf * (1. - deltaSF)
+        return sf
@@ -0,0 +1,158 @@
+import csv
+import numpy as np
+
+# functions allowed in the formulas of the BTV csv files, as numpy ufuncs
+_formulaFunctions = {
+    'log': np.log, 'exp': np.exp, 'sqrt': np.sqrt, 'pow': np.power,
+    'abs': np.abs, 'fabs': np.abs, 'max': np.maximum, 'min': np.minimum,
+    'Log': np.log, 'Exp': np.exp, 'Sqrt': np.sqrt, 'Power': np.power,
+    'Abs': np.abs, 'Max': np.maximum, 'Min': np.minimum,
+}
+
+_opNames = {"l": 0, "m": 1, "t": 2, "shape_corr": 3, "loose": 0, "medium": 1, "tight": 2, "reshaping": 3}
+
+
+def compileFormula(formula):
+    """Compile a TFormula expression of x into a function of a numpy array"""
+    expr = formula.replace("TMath::", "").replace("^", "**")
+    try:
+        code = compile(expr, "<btag formula>", "eval")
+        unknown = [n for n in code.co_names if n != "x" and n not in _formulaFunctions]
+    except SyntaxError:
+        unknown = [expr]
+    if unknown:
+        # not a plain arithmetic expression, let TF1 evaluate it
+        import ROOT
+        tf1 = ROOT.TF1("btagFormula_%d" % abs(hash(formula)), formula)
+        return np.vectorize(tf1.Eval, otypes=[np.float64])
+    env = dict(_formulaFunctions)
+
+    def func(x):
+        env["x"] = x
+        return np.broadcast_to(eval(code, {"__builtins__": {}}, env), np.shape(x)).astype(np.float64)
+    return func
+
+
+class _EntryTable:
+    """The bins of one (operating point, measurement type, sysType, jetFlavor), in file order"""
+
+    def __init__(self, rows, formulas):
+        cols = list(zip(*rows)) if rows else [()] * 7
+        self.etaMin, self.etaMax, self.ptMin, self.ptMax, self.discrMin, self.discrMax = [
+            np.array(c, dtype=np.float32) for c in cols[:6]]
+        self.func = np.array(cols[6], dtype=np.int64)
+        self.formulas = formulas
+        # like BTagCalibrationReader, use |eta| unless some bin has a negative lower edge
+        self.useAbsEta = not bool(np.any(self.etaMin < 0))
+
+    def __len__(self):
+        return len(self.func)
+
+    def _etaMatch(self, eta):
+        return (self.etaMin[None, :] <= eta[:, None]) & (eta[:, None] <= self.etaMax[None, :])
+
+    def _discrMatch(self, discr):
+        return (self.discrMin[None, :] <= discr[:, None]) & (discr[:, None] < self.discrMax[None, :])
+
+    def eval(self, eta, pt, discr, useDiscr):
+        """Vectorised BTagCalibrationReader::eval: first bin containing the jet, 0 if none"""
+        ret = np.zeros(len(pt))
+        if not len(self):
+            return ret
+        if self.useAbsEta:
+            eta = np.abs(eta)
+        match = self._etaMatch(eta) & (self.ptMin[None, :] < pt[:, None]) & (pt[:, None] <= self.ptMax[None, :])
+        if useDiscr:
+            match &= self._discrMatch(discr)
+        found = match.any(axis=1)
+        ibin = np.argmax(match, axis=1)
+        x = (discr if useDiscr else pt).astype(np.float64)
+        funcs = np.where(found, self.func[ibin], -1)
+        for f in np.unique(funcs[funcs >= 0]):
+            sel = funcs == f
+            ret[sel] = self.formulas[f](x[sel])
+        return ret
+
+    def ptBounds(self, eta, discr, useDiscr):
+        """Vectorised BTagCalibrationReader::min_max_pt, (-1, -1) if no bin matches eta"""
+        if self.useAbsEta:
+            eta = np.abs(eta)
+        n = len(eta)
+        if not len(self):
+            return np.full(n, -1, dtype=np.float32), np.full(n, -1, dtype=np.float32)
+        match = self._etaMatch(eta)
+        found = match.any(axis=1)
+        first = np.argmax(match, axis=1)
+        # the first bin matching in eta initialises the range whatever its discriminator range
+        others = match & (np.arange(len(self))[None, :] > first[:, None])
+        if useDiscr:
+            others &= self._discrMatch(discr)
+        minPt = np.minimum(self.ptMin[first], np.where(others, self.ptMin[None, :], np.inf).min(axis=1))
+        maxPt = np.maximum(self.ptMax[first], np.where(others, self.ptMax[None, :], -np.inf).max(axis=1))
+        return (np.where(found, minPt, -1).astype(np.float32), np.where(found, maxPt, -1).astype(np.float32))
+
+
+class BTagCalibrationTables:
+    """Array version of BTagCalibration + BTagCalibrationReader.
+
+       The csv file is parsed once into one table of bins per (jet flavor,
+       sysType) for the given operating point, with the formulas compiled to
+       numpy expressions, so that eval_auto_bounds can be computed for many
+       jets at once. The results are the same as the C++ reader (including the
+       pt clamping and the doubled uncertainty out of the pt range).
+    """
+
+    def __init__(self, csvFile, operatingPoint, measurementTypes, systs):
+        """measurementTypes is a dict jetFlavor (0, 1, 2) -> measurement type"""
+        if not isinstance(operatingPoint, int):
+            operatingPoint = _opNames[operatingPoint.lower()]
+        self.operatingPoint = operatingPoint
+        self.useDiscr = (operatingPoint == 3)
+        self.systs = list(systs)
+        rows = {}
+        formulas = []
+        formulaIndex = {}
+        with open(csvFile) as f:
+            lines = [l for l in f if l.strip() and ';' not in l.split(',')[0]]
+        for fields in csv.reader(lines, skipinitialspace=True):
+            fields = [x.strip() for x in fields]
+            op = fields[0]
+            op = _opNames[op.lower()] if op.lower() in _opNames else int(op)
+            if op != operatingPoint:
+                continue
+            measurement, sysType, flavor = fields[1], fields[2], int(fields[3])
+            formula = fields[10].strip('"')
+            if formula not in formulaIndex:
+                formulaIndex[formula] = len(formulas)
+                formulas.append(formula)
+            rows.setdefault((measurement, sysType, flavor), []).append(
+                [float(v) for v in fields[4:10]] + [formulaIndex[formula]])
+        # files using the hadron flavour convention (5, 4, 0) instead of (0, 1, 2)
+        if any(flav in (4, 5) for (_, _, flav) in rows):
+            rows = dict(((m, s, {5: 0, 4: 1, 0: 2}.get(flav, flav)), r) for (m, s, flav), r in rows.items())
+        compiled = [compileFormula(f) for f in formulas]
+        self.tables = {}
+        for flavor, measurement in measurementTypes.items():
+            for sysType in ["central"] + self.systs:
+                self.tables[(flavor, sysType)] = _EntryTable(rows.get((measurement, sysType, flavor), []), compiled)
+
+    def evalAutoBounds(self, syst, flavor, eta, pt, discr=None):
+        """Scale factors for jets of one flavor, like BTagCalibrationReader::eval_auto_bounds"""
+        eta = np.asarray(eta, dtype=np.float32)
+        pt = np.asarray(pt, dtype=np.float32)
+        discr = np.zeros(len(pt), dtype=np.float32) if discr is None else np.asarray(discr, dtype=np.float32)
+        central = self.tables[(flavor, "central")]
+        minPt, maxPt = central.ptBounds(eta, discr, self.useDiscr)
+        below = pt <= minPt
+        above = ~below & (pt > maxPt)
+        # the shifted bound is computed in double precision and stored in a float, as in C++
+        ptEval = np.where(below, (minPt.astype(np.float64) + .0001).astype(np.float32),
+                          np.where(above, (maxPt.astype(np.float64) - .0001).astype(np.float32), pt))
+        sf = central.eval(eta, ptEval, discr, self.useDiscr)
+        if syst == "central":
+            return sf
+        if (flavor, syst) not in self.tables:
+            raise ValueError("sysType not available (maybe not loaded?): %s" % syst)
+        sfErr = self.tables[(flavor, syst)].eval(eta, ptEval, discr, self.useDiscr)
+        outOfBounds = below | above
+        return np.where(outOfBounds, sf + 2 * (sfErr - sf), sfErr)
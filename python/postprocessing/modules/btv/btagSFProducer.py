@@ -1,5 +1,8 @@
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
+from PhysicsTools.NanoAODTools.postprocessing.modules.btv.btagCalibrationTables import BTagCalibrationTables
+import numpy as np
 import ROOT
 import os
 from itertools import chain
@@ -33,13 +36,19 @@ def is_relevant_syst_for_shape_corr(flavor_btv, syst, jesSystsForShape=["jes"]):
 
 class btagSFProducer(Module):
     """Calculate btagging scale factors
+
+       With batchSize > 0, the scale factors of all the jets of batchSize
+       consecutive events are computed at once for all the working points and
+       systematics, from array versions of the calibration tables (see
+       btagCalibrationTables), instead of one BTagCalibrationReader call per jet.
     """
 
     def __init__(
             self, era, algo='csvv2', selectedWPs=['M', 'shape_corr'],
-            sfFileName=None, verbose=0, jesSystsForShape=["jes"]
+            sfFileName=None, verbose=0, jesSystsForShape=["jes"], batchSize=0
     ):
         self.era = era
+        self.batchSize = batchSize
         self.algo = algo.lower()
         self.selectedWPs = selectedWPs
         self.verbose = verbose
@@ -242,7 +251,22 @@ class btagSFProducer(Module):
                         '_' + central_or_syst
             self.branchNames_central_and_systs[wp] = branchNames
 
+        self.discrBranch = {"csvv2": "btagCSVV2", "deepcsv": "btagDeepB",
+                            "cmva": "btagCMVA", "deepjet": "btagDeepFlavB"}.get(self.algo, None)
+
     def beginJob(self):
+        if self.batchSize:
+            self.tables = {}
+            for wp in self.selectedWPs:
+                if wp == "shape_corr":
+                    self.tables[wp] = BTagCalibrationTables(
+                        os.path.join(self.inputFilePath, self.inputFileName), 3,
+                        dict((flavor_btv, 'iterativefit') for flavor_btv in [0, 1, 2]), self.systs_shape_corr)
+                else:
+                    self.tables[wp] = BTagCalibrationTables(
+                        os.path.join(self.inputFilePath, self.inputFileName), wp,
+                        self.measurement_types, self.systs)
+            return
         # initialize BTagCalibrationReader
         # (cf. https://twiki.cern.ch/twiki/bin/viewauth/CMS/BTagCalibration )
         self.calibration = ROOT.BTagCalibration(
@@ -276,9 +300,13 @@ class btagSFProducer(Module):
         for central_or_syst in list(self.branchNames_central_and_systs.values()):
             for branch in list(central_or_syst.values()):
                 self.out.branch(branch, "F", lenVar="nJet")
+        if self.batchSize:
+            self.chunks = ChunkReader(inputTree, ["Jet_pt", "Jet_eta", "Jet_hadronFlavour", self.discrBranch],
+                                      self.batchSize)
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        pass
+        if self.batchSize:
+            self.chunks.close()
 
     def getReader(self, wp):
         """
@@ -347,22 +375,61 @@ class btagSFProducer(Module):
                 sf = 1.
             yield sf
 
+    def getSFsArray(self, pt, eta, hadronFlavour, discr):
+        """Scale factors of many jets for all working points and systematics, as a dict branch name -> array"""
+        epsilon = 1.e-3
+        max_abs_eta = self.max_abs_eta
+        eta = np.where(eta <= -max_abs_eta, -max_abs_eta + epsilon,
+                       np.where(eta >= max_abs_eta, max_abs_eta - epsilon, eta))
+        absFlavour = np.abs(hadronFlavour)
+        flavor_btv = np.select([absFlavour == 5, absFlavour == 4, np.isin(absFlavour, [0, 1, 2, 3, 21])],
+                               [0, 1, 2], -1)
+        ret = {}
+        for wp in self.selectedWPs:
+            isShape = (wp == 'shape_corr')
+            central_and_systs = (
+                self.central_and_systs_shape_corr if isShape else self.central_and_systs)
+            for central_or_syst in central_and_systs:
+                # jets of unknown flavor keep a SF of 1
+                sfs = np.ones(len(pt))
+                for flav in [0, 1, 2]:
+                    sel = (flavor_btv == flav)
+                    if not sel.any():
+                        continue
+                    syst = central_or_syst
+                    if isShape and not is_relevant_syst_for_shape_corr(flav, syst, self.jesSystsForShape):
+                        syst = 'central'
+                    sfs[sel] = self.tables[wp].evalAutoBounds(
+                        syst, flav, eta[sel], pt[sel], discr[sel] if isShape else None)
+                sfs[sfs < 0.01] = 1.
+                ret[self.branchNames_central_and_systs[wp][central_or_syst]] = sfs
+        return ret
+
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
-        jets = Collection(event, "Jet")
-
-        discr = None
-        if self.algo == "csvv2":
-            discr = "btagCSVV2"
-        elif self.algo == "deepcsv":
-            discr = "btagDeepB"
-        elif self.algo == "cmva":
-            discr = "btagCMVA"
-        elif self.algo == "deepjet":
-            discr = "btagDeepFlavB"
-        else:
+        discr = self.discrBranch
+        if discr is None:
             raise ValueError("ERROR: Invalid algorithm '%s'!" % self.algo)
 
+        if self.batchSize:
+            chunk, i = self.chunks.get(event)
+            if chunk is None:
+                # jets modified by a previous module, use the values of this event
+                jets = Collection(event, "Jet")
+                sfs = self.getSFsArray(*[np.array([getattr(jet, var) for jet in jets], dtype=np.float64)
+                                         for var in ("pt", "eta", "hadronFlavour", discr)])
+                for branch, values in sfs.items():
+                    self.out.fillBranch(branch, values)
+                return True
+            if not chunk.results:
+                chunk.results = self.getSFsArray(
+                    chunk["Jet_pt"], chunk["Jet_eta"], chunk["Jet_hadronFlavour"].astype(np.int64), chunk[discr])
+            off = chunk.offsets["nJet"]
+            for branch, values in chunk.results.items():
+                self.out.fillBranch(branch, values[off[i]:off[i + 1]])
+            return True
+
+        jets = Collection(event, "Jet")
         preloaded_jets = [(jet.pt, jet.eta, self.getFlavorBTV(
             jet.hadronFlavour), getattr(jet, discr)) for jet in jets]
         for wp in self.selectedWPs:
@@ -1,9 +1,12 @@
 import os
+import numpy as np
 import correctionlib
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader, segmentProd, maskedOffsets
 
 
 era_dict = {2015: '2016preVFP_UL', 2016: '2016postVFP_UL', 2017: '2017_UL', 2018: '2018_UL'}
@@ -40,16 +43,55 @@ systematics = [
 
 
 class FlavTagSFProducer(Module):
-
-    def __init__(self, year):
+    """Event weights from the ParticleNet AK4 flavour tagging shape SFs.
+
+       By default the jets are taken from event.ak4jets, with their tag
+       category in j.tag, as set by the analysis module running before. If
+       tagBranch is given, the jets are instead read from the branches of
+       the collection (pt, eta, hadronFlavour and the tag category in
+       tagBranch), jets with a category not in tag_dict (e.g. -1) being
+       skipped. With batchSize > 0 the branches are read for batchSize events
+       at once and the weights of all these events are computed together.
+       In all cases each systematic is evaluated with one correctionlib call
+       per tag category over arrays of jets.
+    """
+
+    def __init__(self, year, batchSize=0, collection='Jet', tagBranch=None):
         era = {2015: '2016preVFP_UL', 2016: '2016postVFP_UL', 2017: '2017_UL', 2018: '2018_UL'}[year]
         correction_file = os.path.expandvars(
             f'$CMSSW_BASE/src/PhysicsTools/NanoAODTools/data/flavTagSF/flavTaggingSF_{era}.json.gz')
         self.corr = correctionlib.CorrectionSet.from_file(correction_file)['particleNetAK4_shape']
+        self.collection = collection
+        self.tagBranch = tagBranch
+        self.batchSize = batchSize if tagBranch else 0
 
     def get_sf(self, j, syst='central'):
         return self.corr.evaluate(syst, j.hadronFlavour, tag_dict[j.tag], abs(j.eta), j.pt)
 
+    def get_sf_array(self, hadronFlavour, tag, eta, pt, syst='central'):
+        """SFs of arrays of jets, with one correctionlib call per tag category"""
+        sfs = np.ones(len(pt))
+        for code in np.unique(tag):
+            sel = (tag == code)
+            sfs[sel] = self.corr.evaluate(syst, hadronFlavour[sel], tag_dict[int(code)], np.abs(eta[sel]), pt[sel])
+        return sfs
+
+    def get_weights(self, hadronFlavour, tag, eta, pt, offsets):
+        """Event weights for flattened jet arrays, given the offsets of the events in them"""
+        hadronFlavour = np.asarray(hadronFlavour, dtype=np.int64)
+        tag = np.asarray(tag, dtype=np.int64)
+        eta = np.asarray(eta, dtype=np.float64)
+        pt = np.asarray(pt, dtype=np.float64)
+        wgts = {'flavTagWeight': segmentProd(self.get_sf_array(hadronFlavour, tag, eta, pt), offsets)}
+        for syst in systematics:
+            for var in ('UP', 'DOWN'):
+                wgts[f'flavTagWeight_{syst}_{var}'] = segmentProd(
+                    self.get_sf_array(hadronFlavour, tag, eta, pt, var.lower() + '_' + syst), offsets)
+        return wgts
+
+    def selectedJets(self, tag):
+        return np.isin(tag, list(tag_dict.keys()))
+
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.isMC = bool(inputTree.GetBranch('genWeight'))
         if self.isMC:
@@ -60,6 +102,19 @@ class FlavTagSFProducer(Module):
                 self.basewgts[f'flavTagWeight_{syst}_DOWN'] = 1.
             for name in self.basewgts.keys():
                 self.out.branch(name, "F")
+            self.chunks = None
+            # the tag branch may be produced by a module running before, then the event values are used
+            if self.batchSize and inputTree.GetBranch(self.tagBranch):
+                self.chunks = ChunkReader(inputTree, [self.collection + '_' + var for var in (
+                    'pt', 'eta', 'hadronFlavour')] + [self.tagBranch], self.batchSize)
+
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        if self.isMC and self.chunks:
+            self.chunks.close()
+
+    def fillWeights(self, wgts, i=0):
+        for name, val in wgts.items():
+            self.out.fillBranch(name, val[i])
 
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
@@ -67,25 +122,29 @@ class FlavTagSFProducer(Module):
         if not self.isMC:
             return True
 
-        jets = event.ak4jets
-        wgts = self.basewgts.copy()
-
-        # debug('------')
-        for j in jets:
-            # debug('jet pt:%.1f, eta:%.2f, flavor:%d, tag:%s, SF:%.4f' %
-            #       (j.pt, j.eta, j.hadronFlavour, j.tag, self.get_sf(j)))
-            wgts['flavTagWeight'] *= self.get_sf(j)
-            for syst in systematics:
-                wgts[f'flavTagWeight_{syst}_UP'] *= self.get_sf(j, 'up_' + syst)
-                wgts[f'flavTagWeight_{syst}_DOWN'] *= self.get_sf(j, 'down_' + syst)
-                # debug('syst:%s, up:%.4f, down:%.4f' %
-                #       (syst, self.get_sf(j, 'up_' + syst), self.get_sf(j, 'down_' + syst)))
-
-        # debug('Event wgt:\n - ' + ('\n - '.join(str(it) for it in wgts.items())))
-
-        for name, val in wgts.items():
-            self.out.fillBranch(name, val)
-
+        if self.chunks:
+            chunk, i = self.chunks.get(event)
+            if chunk is not None:
+                if not chunk.results:
+                    names = [self.collection + '_' + var for var in ('hadronFlavour', 'pt', 'eta')]
+                    tag = chunk[self.tagBranch]
+                    sel = self.selectedJets(tag)
+                    chunk.results = self.get_weights(
+                        chunk[names[0]][sel], tag[sel], chunk[names[2]][sel], chunk[names[1]][sel],
+                        maskedOffsets(chunk.offsets[chunk.lenVars[names[0]]], sel))
+                self.fillWeights(chunk.results, i)
+                return True
+
+        if self.tagBranch:
+            jets = Collection(event, self.collection)
+            tag = np.array([getattr(j, self.tagBranch[len(self.collection) + 1:]) for j in jets], dtype=np.int64)
+            jets = [j for j, t in zip(jets, tag) if t in tag_dict]
+            tag = tag[self.selectedJets(tag)]
+        else:
+            jets = event.ak4jets
+            tag = [j.tag for j in jets]
+        self.fillWeights(self.get_weights([j.hadronFlavour for j in jets], tag, [j.eta for j in jets],
+                                          [j.pt for j in jets], np.array([0, len(jets)])))
         return True
 
 
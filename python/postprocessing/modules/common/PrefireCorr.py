@@ -1,9 +1,10 @@
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader, segmentProd
+from PhysicsTools.NanoAODTools.postprocessing.tools import HistArrays
 import os
 import re
 import ROOT
-import math
+import numpy as np
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 
@@ -15,7 +16,8 @@ class PrefCorr(Module):
                  photonmapname="L1prefiring_photonpt_2017BtoF",
                  branchnames=[
                      "PrefireWeight", "PrefireWeight_Up", "PrefireWeight_Down"
-                 ]):
+                 ],
+                 batchSize=0):
         """Module to compute prefiring weights
 
         :param jetroot: Root file containing prefiring map for jets,
@@ -37,6 +39,10 @@ class PrefCorr(Module):
         :param branchnames: Output branch names for nominal, up, down variations,
             defaults to ["PrefireWeight","PrefireWeight_Up", "PrefireWeight_Down"]
         :type branchnames: list, optional
+
+        :param batchSize: Number of events for which the weights are computed
+            at once (0 to compute them event by event), defaults to 0
+        :type batchSize: int, optional
         """
 
         cmssw_base = os.getenv('CMSSW_BASE')
@@ -53,6 +59,27 @@ class PrefCorr(Module):
 
         self.UseEMpT = ("jetempt" in jetroot)
         self.branchnames = branchnames
+        self.batchSize = batchSize
+
+        # Options
+        self.JetMinPt = 20  # Min/Max Values may need to be fixed for new maps
+        self.JetMaxPt = 500
+        self.JetMinEta = 2.0
+        self.JetMaxEta = 3.0
+        self.PhotonMinPt = 20
+        self.PhotonMaxPt = 500
+        self.PhotonMinEta = 2.0
+        self.PhotonMaxEta = 3.0
+
+        # the maps as arrays, to look up all the objects at once
+        self.jet_map_arrays = HistArrays(self.jet_map)
+        self.photon_map_arrays = HistArrays(self.photon_map)
+
+        self.inputBranches = ["Jet_pt", "Jet_eta",
+                              "Photon_pt", "Photon_eta", "Photon_jetIdx", "Photon_electronIdx",
+                              "Electron_pt", "Electron_eta", "Electron_jetIdx", "Electron_photonIdx"]
+        if self.UseEMpT:
+            self.inputBranches += ["Jet_chEmEF", "Jet_neEmEF"]
 
     def open_root(self, path):
         r_file = ROOT.TFile.Open(path)
@@ -76,112 +103,118 @@ class PrefCorr(Module):
         self.out = wrappedOutputTree
         for bname in self.branchnames:
             self.out.branch(bname, "F")
+        self.chunks = None
+        if self.batchSize:
+            self.chunks = ChunkReader(inputTree, self.inputBranches, self.batchSize)
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        pass
+        if self.chunks:
+            self.chunks.close()
 
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail,
         go to next event)"""
 
-        jets = Collection(event, "Jet")
-
-        # Options
-        self.JetMinPt = 20  # Min/Max Values may need to be fixed for new maps
-        self.JetMaxPt = 500
-        self.JetMinEta = 2.0
-        self.JetMaxEta = 3.0
-        self.PhotonMinPt = 20
-        self.PhotonMaxPt = 500
-        self.PhotonMinEta = 2.0
-        self.PhotonMaxEta = 3.0
-
-        for i, bname in zip([0, 1, -1], self.branchnames):
-            self.variation = i
-            prefw = 1.0
-
-            for jid, jet in enumerate(jets):  # First loop over all jets
-                jetpf = 1.0
-                PhotonInJet = []
-
-                jetpt = jet.pt
-                if self.UseEMpT:
-                    jetpt *= (jet.chEmEF + jet.neEmEF)
-
-                if jetpt >= self.JetMinPt and abs(
-                        jet.eta) <= self.JetMaxEta and abs(
-                            jet.eta) >= self.JetMinEta:
-                    jetpf *= 1 - \
-                        self.GetPrefireProbability(
-                            self.jet_map, jet.eta, jetpt, self.JetMaxPt)
-
-                phopf = self.EGvalue(event, jid)
-                # The higher prefire-probablity between the jet and the
-                # lower-pt photon(s)/elecron(s) from the jet is chosen
-                prefw *= min(jetpf, phopf)
-
-            # Then loop over all photons/electrons not associated to jets
-            prefw *= self.EGvalue(event, -1)
-            self.out.fillBranch(bname, prefw)
+        if self.chunks:
+            chunk, i = self.chunks.get(event)
+            if chunk is not None:
+                if not chunk.results:
+                    chunk.results = self.GetPrefireWeights(
+                        chunk.columns, *[chunk.offsets[chunk.lenVars[coll + "_pt"]]
+                                         for coll in ("Jet", "Photon", "Electron")])
+                for bname, weights in chunk.results.items():
+                    self.out.fillBranch(bname, weights[i])
+                return True
+
+        columns = dict((name, np.array(list(getattr(event, name)), dtype=np.float64))
+                       for name in self.inputBranches)
+        weights = self.GetPrefireWeights(columns, *[np.array([0, len(columns[coll + "_pt"])])
+                                                    for coll in ("Jet", "Photon", "Electron")])
+        for bname, w in weights.items():
+            self.out.fillBranch(bname, w[0])
         return True
 
-    def EGvalue(self, event, jid):
-        photons = Collection(event, "Photon")
-        electrons = Collection(event, "Electron")
-        phopf = 1.0
-        PhotonInJet = []
-
-        for pid, pho in enumerate(photons):
-            if pho.jetIdx == jid:
-                if pho.pt >= self.PhotonMinPt and abs(
-                        pho.eta) <= self.PhotonMaxEta and abs(
-                            pho.eta) >= self.PhotonMinEta:
-                    phopf_temp = 1 - \
-                        self.GetPrefireProbability(
-                            self.photon_map, pho.eta, pho.pt, self.PhotonMaxPt)
-
-                    elepf_temp = 1.0
-                    if pho.electronIdx > -1:  # What if the electron
-                    # corresponding to the photon would return a different value?
-                        if event.Electron_pt[
-                                pho.electronIdx] >= self.PhotonMinPt and abs(
-                                    event.Electron_eta[pho.electronIdx]
-                                ) <= self.PhotonMaxEta and abs(
-                                    event.Electron_eta[
-                                        pho.electronIdx]) >= self.PhotonMinEta:
-                            elepf_temp = 1 - self.GetPrefireProbability(
-                                self.photon_map,
-                                event.Electron_eta[pho.electronIdx],
-                                event.Electron_pt[pho.electronIdx],
-                                self.PhotonMaxPt)
-
-                    # The higher prefire-probablity between the photon and
-                    # corresponding electron is chosen
-                    phopf *= min(phopf_temp, elepf_temp)
-                    PhotonInJet.append(pid)
-
-        for ele in electrons:
-            if ele.jetIdx == jid and (ele.photonIdx not in PhotonInJet):
-                if ele.pt >= self.PhotonMinPt and abs(
-                        ele.eta) <= self.PhotonMaxEta and abs(
-                            ele.eta) >= self.PhotonMinEta:
-                    phopf *= 1 - \
-                        self.GetPrefireProbability(
-                            self.photon_map, ele.eta, ele.pt, self.PhotonMaxPt)
-
-        return phopf
-
-    def GetPrefireProbability(self, Map, eta, pt, maxpt):
-        bin = Map.FindBin(eta, min(pt, maxpt - 0.01))
-        pref_prob = Map.GetBinContent(bin)
-
-        stat = Map.GetBinError(bin)  # bin statistical uncertainty
-        syst = 0.2 * pref_prob  # 20% of prefire rate
+    def GetPrefireWeights(self, c, jetOffsets, photonOffsets, electronOffsets):
+        """Nominal, up and down weights of a set of events in one pass.
 
-        if self.variation == 1:
-            pref_prob = min(pref_prob + math.sqrt(stat * stat + syst * syst),
-                            1.0)
-        if self.variation == -1:
-            pref_prob = max(pref_prob - math.sqrt(stat * stat + syst * syst),
-                            0.0)
-        return pref_prob
+        c holds the flattened Jet, Photon and Electron columns of the events,
+        the offsets giving where each event starts in them. For each jet the
+        smaller of the non-prefiring probabilities of the jet and of the
+        photons/electrons associated to it is taken, the photons/electrons
+        not associated to any jet being counted separately.
+        """
+        nEvents = len(jetOffsets) - 1
+        nJets = jetOffsets[-1]
+        photonEvent = np.repeat(np.arange(nEvents), np.diff(photonOffsets))
+        electronEvent = np.repeat(np.arange(nEvents), np.diff(electronOffsets))
+
+        jetpt = c["Jet_pt"]
+        if self.UseEMpT:
+            jetpt = jetpt * (c["Jet_chEmEF"] + c["Jet_neEmEF"])
+        jetPass = self.InAcceptance(jetpt, c["Jet_eta"], self.JetMinPt, self.JetMinEta, self.JetMaxEta)
+        jetpf = np.where(jetPass, 1 - self.GetPrefireProbabilities(
+            self.jet_map_arrays, c["Jet_eta"], jetpt, self.JetMaxPt), 1.)
+
+        phoPass = self.InAcceptance(c["Photon_pt"], c["Photon_eta"],
+                                    self.PhotonMinPt, self.PhotonMinEta, self.PhotonMaxEta)
+        phopf = 1 - self.GetPrefireProbabilities(self.photon_map_arrays, c["Photon_eta"], c["Photon_pt"],
+                                                 self.PhotonMaxPt)
+        elePass = self.InAcceptance(c["Electron_pt"], c["Electron_eta"],
+                                    self.PhotonMinPt, self.PhotonMinEta, self.PhotonMaxEta)
+        elepf = 1 - self.GetPrefireProbabilities(self.photon_map_arrays, c["Electron_eta"], c["Electron_pt"],
+                                                 self.PhotonMaxPt)
+
+        # The higher prefire-probablity between the photon and
+        # corresponding electron is chosen
+        eleIdx = c["Photon_electronIdx"].astype(np.int64)
+        hasEle = (eleIdx > -1) & (eleIdx < np.diff(electronOffsets)[photonEvent])
+        eleGlobal = electronOffsets[photonEvent][hasEle] + eleIdx[hasEle]
+        phoElepf = np.ones_like(phopf)
+        phoElepf[:, hasEle] = np.where(elePass[eleGlobal], elepf[:, eleGlobal], 1.)
+        phoTerm = np.where(phoPass, np.minimum(phopf, phoElepf), 1.)
+
+        # electrons whose photon was already counted for the same jet are skipped
+        phoJetIdx = c["Photon_jetIdx"].astype(np.int64)
+        eleJetIdx = c["Electron_jetIdx"].astype(np.int64)
+        phoIdx = c["Electron_photonIdx"].astype(np.int64)
+        hasPho = (phoIdx > -1) & (phoIdx < np.diff(photonOffsets)[electronEvent])
+        phoGlobal = photonOffsets[electronEvent][hasPho] + phoIdx[hasPho]
+        counted = np.zeros(len(phoIdx), dtype=bool)
+        counted[hasPho] = phoPass[phoGlobal] & (phoJetIdx[phoGlobal] == eleJetIdx[hasPho])
+        eleTerm = np.where(elePass & ~counted, elepf, 1.)
+
+        # photons/electrons are grouped by jet, those not associated to a jet
+        # go to one group per event after the jets
+        def groups(jetIdx, event):
+            nJetEvent = np.diff(jetOffsets)[event]
+            return np.where((jetIdx >= 0) & (jetIdx < nJetEvent), jetOffsets[event] + jetIdx,
+                            np.where(jetIdx == -1, nJets + event, -1))
+        group = np.concatenate([groups(phoJetIdx, photonEvent), groups(eleJetIdx, electronEvent)])
+        terms = np.concatenate([phoTerm, eleTerm], axis=1)
+        valid = group >= 0
+        egpf = np.ones((3, nJets + nEvents))
+        for v in range(3):
+            # sequential in the order of the objects, as the products of the per-event loops
+            np.multiply.at(egpf[v], group[valid], terms[v][valid])
+
+        weights = {}
+        jetTerm = np.minimum(jetpf, egpf[:, :nJets])
+        for v, bname in enumerate(self.branchnames):
+            weights[bname] = segmentProd(jetTerm[v], jetOffsets) * egpf[v, nJets:]
+        return weights
+
+    @staticmethod
+    def InAcceptance(pt, eta, minpt, mineta, maxeta):
+        return (pt >= minpt) & (np.abs(eta) <= maxeta) & (np.abs(eta) >= mineta)
+
+    def GetPrefireProbabilities(self, Map, eta, pt, maxpt):
+        """Nominal, up and down prefiring probabilities, as an array of shape (3, len(pt))"""
+        bins = Map.findBin(eta, np.minimum(pt, maxpt - 0.01))
+        pref_prob = Map.content[bins]
+
+        stat = Map.error[bins]  # bin statistical uncertainty
+        syst = 0.2 * pref_prob  # 20% of prefire rate
+        unc = np.sqrt(stat * stat + syst * syst)
+        return np.stack([pref_prob,
+                         np.minimum(pref_prob + unc, 1.0),
+                         np.maximum(pref_prob - unc, 0.0)])
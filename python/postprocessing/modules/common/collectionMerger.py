@@ -1,5 +1,6 @@
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
 import ROOT
 import numpy as np
 import itertools
@@ -18,6 +19,14 @@ _rootLeafType2rootBranchType = {
 }
 
 
+class _Columns:
+    """Columns of a collection as attributes, so that the sort key and the
+    selectors (e.g. lambda x: x.pt > 20) can be evaluated on arrays"""
+
+    def __init__(self, columns):
+        self.__dict__.update(columns)
+
+
 class collectionMerger(Module):
     def __init__(self,
                  input,
@@ -25,11 +34,13 @@ class collectionMerger(Module):
                  sortkey=lambda x: x.pt,
                  reverse=True,
                  selector=None,
-                 maxObjects=None):
+                 maxObjects=None,
+                 batchSize=0):
         self.input = input
         self.output = output
         self.nInputs = len(self.input)
         self.sortkey = lambda obj_j_i1: sortkey(obj_j_i1[0])
+        self.arraySortkey = sortkey
         self.reverse = reverse
         # pass dict([(collection_name,lambda obj : selection(obj)])
         self.selector = [(selector[coll] if coll in selector else
@@ -37,6 +48,11 @@ class collectionMerger(Module):
                          for coll in self.input] if selector else None
         # save only the first maxObjects objects passing the selection in the merged collection
         self.maxObjects = maxObjects
+        # the merge is done on the columns of the collections, for each event or
+        # for batchSize events at a time if batchSize > 0; if the sort key or a
+        # selector can't be evaluated on arrays, the objects are merged one by one
+        self.batchSize = batchSize
+        self.useArrays = True
         self.branchType = {}
         pass
 
@@ -88,8 +104,16 @@ class collectionMerger(Module):
                             _rootLeafType2rootBranchType[self.branchType[br]],
                             lenVar="n%s" % self.output)
 
+        # the chunks can only be read if all the branches are in the input file
+        inputNames = ["%s_%s" % (coll, br) for j, coll in enumerate(self.input)
+                      for br in self.brlist_sep[j]]
+        self.chunks = None
+        if self.batchSize and all(inputTree.GetBranch(name) for name in inputNames):
+            self.chunks = ChunkReader(inputTree, inputNames, self.batchSize)
+
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        pass
+        if self.chunks:
+            self.chunks.close()
 
     def filterBranchNames(self, branches, collection):
         out = []
@@ -101,8 +125,86 @@ class collectionMerger(Module):
             self.branchType[out[-1]] = br.FindLeaf(br.GetName()).GetTypeName()
         return out
 
+    def merge(self, columns, offsets):
+        """Merge the collections of a set of events.
+
+        columns[j] are the flat columns of the input collection j and
+        offsets[j] where each event starts in them. Returns the merged columns
+        and where each event starts in those.
+        """
+        nEvents = len(offsets[0]) - 1
+        event = np.concatenate([np.repeat(np.arange(nEvents), np.diff(off)) for off in offsets])
+        keys, mask = [], []
+        for j in range(self.nInputs):
+            n = offsets[j][-1]
+            keys.append(np.broadcast_to(np.asarray(self.arraySortkey(_Columns(columns[j])), dtype=np.float64), (n,)))
+            mask.append(np.broadcast_to(np.asarray(self.selector[j](_Columns(columns[j])), dtype=bool), (n,))
+                        if self.selector else np.ones(n, dtype=bool))
+        keys = np.concatenate(keys)
+        # stable sort within each event, as list.sort (also with reverse)
+        order = np.lexsort((-keys if self.reverse else keys, event))
+        order = order[np.concatenate(mask)[order]]
+        counts = np.bincount(event[order], minlength=nEvents)
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        if self.maxObjects:
+            rank = np.arange(len(order)) - starts[event[order]]
+            order = order[rank < self.maxObjects]
+            starts = np.concatenate([[0], np.cumsum(np.minimum(counts, self.maxObjects))])
+        merged = {}
+        for bridx, br in enumerate(self.brlist_all):
+            merged[br] = np.concatenate([
+                columns[j][br] if self.is_there[bridx][j] else np.zeros(offsets[j][-1])
+                for j in range(self.nInputs)])[order]
+        return merged, starts
+
+    def eventColumn(self, event, coll, br):
+        values = getattr(event, "%s_%s" % (coll, br))
+        if self.branchType[br] in ('UChar_t', 'Char_t'):
+            # chars are read as str: convert them to integers as Collection does
+            return np.array([ord(v) if type(v) == str else v for v in values], dtype=np.uint8)
+        return np.array(list(values))
+
+    def chunkColumn(self, chunk, coll, br):
+        values = chunk["%s_%s" % (coll, br)]
+        # chars as unsigned integers, as the ord of the per-object merge
+        return values.astype(np.uint8) if self.branchType[br] in ('UChar_t', 'Char_t') else values
+
+    def fillMerged(self, merged, first, last):
+        for br in self.brlist_all:
+            values = merged[br][first:last]
+            if self.branchType[br] not in ('Float_t', 'Double_t'):
+                values = values.astype(np.int64)
+            self.out.fillBranch("%s_%s" % (self.output, br), values.tolist())
+
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
+        if self.useArrays:
+            try:
+                if self.chunks:
+                    chunk, i = self.chunks.get(event)
+                    if chunk is not None:
+                        if not chunk.results:
+                            columns = [dict((br, self.chunkColumn(chunk, coll, br)) for br in self.brlist_sep[j])
+                                       for j, coll in enumerate(self.input)]
+                            offsets = [chunk.offsets["n%s" % coll] for coll in self.input]
+                            chunk.results["merged"], chunk.results["starts"] = self.merge(columns, offsets)
+                        starts = chunk.results["starts"]
+                        self.fillMerged(chunk.results["merged"], starts[i], starts[i + 1])
+                        return True
+                columns = [dict((br, self.eventColumn(event, coll, br)) for br in self.brlist_sep[j])
+                           for j, coll in enumerate(self.input)]
+                offsets = [np.array([0, getattr(event, "n%s" % coll)]) for coll in self.input]
+                merged, starts = self.merge(columns, offsets)
+                self.fillMerged(merged, 0, starts[1])
+                return True
+            except (TypeError, ValueError) as e:
+                # e.g. a selector using 'and', which needs single objects
+                print("collectionMerger: can't evaluate the sort key or selectors on arrays (%s), merging objects one by one" % e)
+                self.useArrays = False
+                if self.chunks:
+                    self.chunks.close()
+                    self.chunks = None
+
         coll = [Collection(event, x) for x in self.input]
         objects = [(coll[j][i], j, i) for j in range(self.nInputs)
                    for i in range(len(coll[j]))]
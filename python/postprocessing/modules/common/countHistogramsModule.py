@@ -1,12 +1,50 @@
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
-from PhysicsTools.NanoAODTools.postprocessing.framework.output import FriendOutput
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 from array import array
+from itertools import chain
+import numpy as np
+
+
+def indexSums(values, offsets):
+    """Sum over the entries of the values of each index, given the offsets of the entries.
+
+       The values are laid out one row per index and summed along the rows,
+       which numpy does pairwise.
+    """
+    counts = np.diff(offsets)
+    eventIndex = np.repeat(np.arange(len(counts)), counts)
+    index = np.arange(offsets[-1]) - offsets[:-1][eventIndex]
+    rows = np.zeros((int(counts.max(initial=0)), len(counts)))
+    rows[index, eventIndex] = values
+    return rows.sum(axis=1)
+
 
 class countHistogramsProducer(Module):
-    def __init__(self):
-        pass
+    def __init__(self, weights=("LHEScaleWeight",), batchSize=0, bufferSize=1000):
+        """Module counting the processed events and the sums of weight vectors
+
+        :param weights: Weight vectors to sum (e.g. LHEScaleWeight, LHEPdfWeight,
+            PSWeight), each event entering with the sign of its Generator_weight.
+            Those missing from the input are skipped, defaults to ("LHEScaleWeight",)
+        :type weights: tuple, optional
+
+        :param batchSize: Number of events read at once to accumulate the sums
+            (0 to read them event by event), defaults to 0
+        :type batchSize: int, optional
+
+        :param bufferSize: When reading event by event, number of events whose
+            values are kept and then added at once, defaults to 1000
+        :type bufferSize: int, optional
+
+        Writes the nEvents histogram (sum of the signs) and the sumLHE tree,
+        with one entry laid out as the Runs tree: genEventCount, genEventSignSum,
+        and for each weight vector <name>Weight an array <name>Sumw[n<name>Sumw].
+        """
+        self.weights = weights
+        self.batchSize = batchSize
+        self.bufferSize = bufferSize
 
     def beginJob(self):
         pass
@@ -17,115 +55,111 @@ class countHistogramsProducer(Module):
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.h_nevents = ROOT.TH1D('nEvents', 'nEvents', 1, 1, 2)
         self.nevents = 0
-        self.sumlheweights = []
         self.nevents_pos = 0
+        self.hasGenWeight = bool(inputTree.GetBranch('Generator_weight'))
+        self.weightNames = [name for name in self.weights if inputTree.GetBranch(name)]
+        # float64 accumulators, extended to the longest vector seen, with
+        # their compensation terms (sum of the rounding errors of the additions)
+        self.sums = dict((name, np.zeros(0)) for name in self.weightNames)
+        self.compensations = dict((name, np.zeros(0)) for name in self.weightNames)
+        # values of the events read one by one, not yet added
+        self.rows = dict((name, []) for name in self.weightNames)
+        self.chunks = None
+        self._chunk = None
+        if self.batchSize:
+            branches = self.weightNames + (['Generator_weight'] if self.hasGenWeight else [])
+            self.chunks = ChunkReader(inputTree, branches, self.batchSize)
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        if self.chunks:
+            self.flush()
+            self.chunks.close()
+        self.flushRows()
         prevdir = ROOT.gDirectory
         outputFile.cd()
         self.h_nevents.SetBinContent(1, self.nevents)
-        self.h_nevents.Write("",ROOT.TObject.kOverwrite)
+        self.h_nevents.Write("", ROOT.TObject.kOverwrite)
 
         tree = ROOT.TTree("sumLHE", "LHE Sum")
-        sumweight_0 = array('f', [0.])
-        sumweight_1 = array('f', [0.])
-        sumweight_2 = array('f', [0.])
-        sumweight_3 = array('f', [0.])
-        sumweight_4 = array('f', [0.])
-        sumweight_5 = array('f', [0.])
-        sumweight_6 = array('f', [0.])
-        sumweight_7 = array('f', [0.])
-        sumweight_8 = array('f', [0.])
-        sumweight_9 = array('f', [0.])
-        sumweight_10 = array('f', [0.])
-        sumweight_11 = array('f', [0.])
-
-        nweights = len(self.sumlheweights)
-        tree.Branch("sumweight_0", sumweight_0,"sumweight_0/F")
-        tree.Branch("sumweight_1", sumweight_1,"sumweight_1/F")
-        tree.Branch("sumweight_2", sumweight_2,"sumweight_2/F")
-        tree.Branch("sumweight_3", sumweight_3,"sumweight_3/F")
-        tree.Branch("sumweight_4", sumweight_4,"sumweight_4/F")
-        tree.Branch("sumweight_5", sumweight_5,"sumweight_5/F")
-        tree.Branch("sumweight_6", sumweight_6,"sumweight_6/F")
-        tree.Branch("sumweight_7", sumweight_7,"sumweight_7/F")
-        tree.Branch("sumweight_8", sumweight_8,"sumweight_8/F")
-        tree.Branch("sumweight_9", sumweight_9,"sumweight_9/F")
-        tree.Branch("sumweight_10", sumweight_10,"sumweight_10/F")
-        tree.Branch("sumweight_11", sumweight_11,"sumweight_11/F")
-
-        if len(self.sumlheweights) > 4:
-            print('sum ',self.sumlheweights[4],' nevents ',self.nevents,' nevents_pos ',self.nevents_pos)
+        buffs = []
+        totals = dict((name, self.sums[name] + self.compensations[name]) for name in self.weightNames)
+        for bname, value in (("genEventCount", self.nevents_pos), ("genEventSignSum", self.nevents)):
+            buffs.append(array('d', [value]))
+            tree.Branch(bname, buffs[-1], bname + "/D")
+        for name in self.weightNames:
+            sumName = name[:-len("Weight")] + "Sumw" if name.endswith("Weight") else name + "Sumw"
+            n = array('i', [len(self.sums[name])])
+            buffs.append(n)
+            buffs.append(array('d', totals[name].tolist() or [0.]))
+            tree.Branch("n" + sumName, n, "n%s/I" % sumName)
+            tree.Branch(sumName, buffs[-1], "%s[n%s]/D" % (sumName, sumName))
+        tree.Fill()
+
+        if "LHEScaleWeight" in totals and len(totals["LHEScaleWeight"]) > 4:
+            print('sum ', totals["LHEScaleWeight"][4], ' nevents ', self.nevents, ' nevents_pos ', self.nevents_pos)
         else:
-            print('nevents ',self.nevents,' nevents_pos ',self.nevents_pos)
-        if len(self.sumlheweights) < 10:
-            try:
-                sumweight_0[0] = self.sumlheweights[0]
-            except:
-                sumweight_0[0] = 0
-            try:
-                sumweight_1[0] = self.sumlheweights[1]
-            except:
-                sumweight_1[0] = 0
-            try:
-                sumweight_2[0] = self.sumlheweights[2]
-            except:
-                sumweight_2[0] = 0
-            try:
-                sumweight_3[0] = self.sumlheweights[3]
-            except:
-                sumweight_3[0] = 0
-            try:
-                sumweight_4[0] = self.sumlheweights[4]
-            except:
-                sumweight_4[0] = 0
-            try:
-                sumweight_5[0] = self.sumlheweights[5]
-            except:
-                sumweight_5[0] = 0
-            try:
-                sumweight_6[0] = self.sumlheweights[6]
-            except:
-                sumweight_6[0] = 0
-            try:
-                sumweight_7[0] = self.sumlheweights[7]
-            except:
-                sumweight_7[0] = 0
-            try:
-                sumweight_8[0] = self.sumlheweights[8]
-            except:
-                sumweight_8[0] = 0
-            try:
-                sumweight_9[0] = self.sumlheweights[9]
-            except:
-                sumweight_9[0] = 0
-            try:
-                sumweight_10[0] = self.sumlheweights[10]
-            except:
-                sumweight_10[0] = 0
-            try:
-                sumweight_11[0] = self.sumlheweights[11]
-            except:
-                sumweight_11[0] = 0
-            tree.Fill()
-
-        tree.Write("", ROOT.TObject.kOverwrite);
+            print('nevents ', self.nevents, ' nevents_pos ', self.nevents_pos)
+
+        tree.Write("", ROOT.TObject.kOverwrite)
         prevdir.cd()
 
+    def accumulate(self, name, values):
+        """Add values to the sums of name, with Neumaier compensated summation"""
+        acc, comp = self.sums[name], self.compensations[name]
+        if len(values) > len(acc):
+            acc = self.sums[name] = np.concatenate([acc, np.zeros(len(values) - len(acc))])
+            comp = self.compensations[name] = np.concatenate([comp, np.zeros(len(values) - len(comp))])
+        n = len(values)
+        total = acc[:n] + values
+        comp[:n] += np.where(np.abs(acc[:n]) >= np.abs(values), (acc[:n] - total) + values, (values - total) + acc[:n])
+        acc[:n] = total
+
+    def flush(self):
+        """Add the events of the current chunk that went through analyze"""
+        chunk, self._chunk = self._chunk, None
+        if chunk is None:
+            return
+        selected = self._selected
+        sign = np.ones(chunk.n)
+        if self.hasGenWeight:
+            sign[chunk["Generator_weight"] < 0] = -1.
+        sign[~selected] = 0.
+        self.nevents += int(sign.sum())
+        self.nevents_pos += int(selected.sum())
+        for name in self.weightNames:
+            lenVar = chunk.lenVars[name]
+            self.accumulate(name, indexSums(chunk[name] * sign[chunk.eventIndex(lenVar)], chunk.offsets[lenVar]))
+
+    def flushRows(self):
+        """Add the values of the events read one by one"""
+        for name, rows in self.rows.items():
+            if not rows:
+                continue
+            offsets = np.concatenate([[0], np.cumsum([len(row) for row in rows])])
+            self.accumulate(name, indexSums(np.fromiter(chain.from_iterable(rows), np.float64, offsets[-1]), offsets))
+            self.rows[name] = []
+
     def analyze(self, event):
+        if self.chunks:
+            chunk, i = self.chunks.get(event)
+            if chunk is not None:
+                if chunk is not self._chunk:
+                    self.flush()
+                    self._chunk = chunk
+                    self._selected = np.zeros(chunk.n, dtype=bool)
+                self._selected[i] = True
+                return True
+
         sign = 1
-        if hasattr(event, 'Generator_weight') and event.Generator_weight < 0:
-            self.nevents += -1;
+        if self.hasGenWeight and event.Generator_weight < 0:
             sign = -1
-        else:
-            self.nevents += 1;
-        weights = []
-        self.nevents_pos += 1;
-        for i in range(event.nLHEScaleWeight):
-            if len(self.sumlheweights)>i:
-                self.sumlheweights[i] += event.LHEScaleWeight[i]*sign
-            else:
-                self.sumlheweights.append(event.LHEScaleWeight[i]*sign)
+        self.nevents += sign
+        self.nevents_pos += 1
+        for name in self.weightNames:
+            values = getattr(event, name)
+            self.rows[name].append([values[i] * sign for i in range(getattr(event, "n" + name))])
+        if self.weightNames and len(self.rows[self.weightNames[0]]) >= self.bufferSize:
+            self.flushRows()
         return True
 
 countHistogramsModule = lambda: countHistogramsProducer()
@@ -1,13 +1,63 @@
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
+from PhysicsTools.NanoAODTools.postprocessing.tools import findAxisBins
 import ROOT
 import os
 import numpy as np
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 
+class LeptonEfficiencyTables:
+    """NumPy version of LeptonEfficiencyCorrector::getSFs, from the same TH2 maps.
+
+       Used when the C++ worker can't be compiled. The results are the same:
+       the bins are clamped to the histogram range and the SFs are
+       multiplied in single precision.
+    """
+
+    def __init__(self, files, histos):
+        self.maps = []
+        for fname, hname in zip(files, histos):
+            tfile = ROOT.TFile.Open(fname, "read")
+            if not tfile:
+                print("WARNING! File %s cannot be opened. Skipping this scale factor" % fname)
+                continue
+            hist = tfile.Get(hname)
+            if not hist:
+                print("ERROR! Histogram %s not in file %s. Not considering this SF." % (hname, fname))
+                tfile.Close()
+                continue
+            xaxis, yaxis = hist.GetXaxis(), hist.GetYaxis()
+            cells = [[hist.GetBinContent(i, j) for j in range(hist.GetNbinsY() + 2)]
+                     for i in range(hist.GetNbinsX() + 2)]
+            # TAxis objects are copied, they must not depend on the file
+            self.maps.append((xaxis.Clone(), yaxis.Clone(), np.array(cells, dtype=np.float32)))
+            tfile.Close()
+
+    def getSFs(self, pdgId, pt, eta):
+        pt = np.asarray(pt, dtype=np.float32)
+        eta = np.asarray(eta, dtype=np.float32)
+        isMu = np.abs(np.asarray(pdgId)) == 13
+        x = np.where(isMu, pt, eta)
+        y = np.where(isMu, np.abs(eta), pt)
+        out = np.ones(len(pt), dtype=np.float32)
+        for xaxis, yaxis, cells in self.maps:
+            binx = np.clip(findAxisBins(xaxis, x), 1, xaxis.GetNbins())
+            biny = np.clip(findAxisBins(yaxis, y), 1, yaxis.GetNbins())
+            out *= cells[binx, biny]
+        return out
+
+
 class lepSFProducer(Module):
-    def __init__(self, muonSelectionTag, electronSelectionTag):
+    def __init__(self, muonSelectionTag, electronSelectionTag, batchSize=0, useCpp=True):
+        """Muon and electron efficiency SFs.
+
+        The SFs of all the leptons of an event, or of batchSize events if
+        batchSize > 0, are computed with one call to the C++ worker, or with
+        NumPy tables of the same histograms if useCpp is False or the worker
+        can't be compiled.
+        """
         if muonSelectionTag == "LooseWP_2016":
             mu_f = ["Mu_Trg.root", "Mu_ID.root", "Mu_Iso.root"]
             mu_h = [
@@ -38,16 +88,25 @@ class lepSFProducer(Module):
             self.el_f[i] = el_f[i]
             self.el_h[i] = el_h[i]
 
-        if "/LeptonEfficiencyCorrector_cc.so" not in ROOT.gSystem.GetLibraries(
+        self.batchSize = batchSize
+        self.useCpp = useCpp
+        if useCpp and "/LeptonEfficiencyCorrector_cc.so" not in ROOT.gSystem.GetLibraries(
         ):
             print("Load C++ Worker")
             ROOT.gROOT.ProcessLine(
                 ".L %s/src/PhysicsTools/NanoAODTools/python/postprocessing/helpers/LeptonEfficiencyCorrector.cc+"
                 % os.environ['CMSSW_BASE'])
+            if not hasattr(ROOT, "LeptonEfficiencyCorrector"):
+                print("Could not load the C++ worker, using NumPy tables")
+                self.useCpp = False
 
     def beginJob(self):
-        self._worker_mu = ROOT.LeptonEfficiencyCorrector(self.mu_f, self.mu_h)
-        self._worker_el = ROOT.LeptonEfficiencyCorrector(self.el_f, self.el_h)
+        if self.useCpp:
+            self._worker_mu = ROOT.LeptonEfficiencyCorrector(self.mu_f, self.mu_h)
+            self._worker_el = ROOT.LeptonEfficiencyCorrector(self.el_f, self.el_h)
+        else:
+            self._worker_mu = LeptonEfficiencyTables(list(self.mu_f), list(self.mu_h))
+            self._worker_el = LeptonEfficiencyTables(list(self.el_f), list(self.el_h))
 
     def endJob(self):
         pass
@@ -56,20 +115,46 @@ class lepSFProducer(Module):
         self.out = wrappedOutputTree
         self.out.branch("Muon_effSF", "F", lenVar="nMuon")
         self.out.branch("Electron_effSF", "F", lenVar="nElectron")
+        self.chunks = None
+        if self.batchSize:
+            self.chunks = ChunkReader(inputTree, ["%s_%s" % (coll, var) for coll in ("Muon", "Electron")
+                                                  for var in ("pdgId", "pt", "eta")], self.batchSize)
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        pass
+        if self.chunks:
+            self.chunks.close()
+
+    def getSFs(self, worker, pdgId, pt, eta):
+        """SFs of arrays of leptons"""
+        pdgId = np.ascontiguousarray(pdgId, dtype=np.int32)
+        pt = np.ascontiguousarray(pt, dtype=np.float32)
+        eta = np.ascontiguousarray(eta, dtype=np.float32)
+        if not self.useCpp:
+            return worker.getSFs(pdgId, pt, eta)
+        out = np.ones(len(pt), dtype=np.float32)
+        if len(pt):
+            worker.getSFs(len(pt), pdgId, pt, eta, out)
+        return out
 
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
+        if self.chunks:
+            chunk, i = self.chunks.get(event)
+            if chunk is not None:
+                if not chunk.results:
+                    chunk.results = {
+                        "Muon_effSF": self.getSFs(self._worker_mu, chunk["Muon_pdgId"], chunk["Muon_pt"], chunk["Muon_eta"]),
+                        "Electron_effSF": self.getSFs(self._worker_el, chunk["Electron_pdgId"], chunk["Electron_pt"], chunk["Electron_eta"]),
+                    }
+                for name, sfs in chunk.results.items():
+                    off = chunk.offsets[chunk.lenVars[name.replace("effSF", "pt")]]
+                    self.out.fillBranch(name, sfs[off[i]:off[i + 1]])
+                return True
+
         muons = Collection(event, "Muon")
         electrons = Collection(event, "Electron")
-        sf_el = [
-            self._worker_el.getSF(el.pdgId, el.pt, el.eta) for el in electrons
-        ]
-        sf_mu = [
-            self._worker_mu.getSF(mu.pdgId, mu.pt, mu.eta) for mu in muons
-        ]
+        sf_el = self.getSFs(self._worker_el, *[[getattr(el, var) for el in electrons] for var in ("pdgId", "pt", "eta")])
+        sf_mu = self.getSFs(self._worker_mu, *[[getattr(mu, var) for mu in muons] for var in ("pdgId", "pt", "eta")])
         self.out.fillBranch("Muon_effSF", sf_mu)
         self.out.fillBranch("Electron_effSF", sf_el)
         return True
@@ -1,27 +1,60 @@
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
+from PhysicsTools.NanoAODTools.postprocessing.tools import counterUniform, rngStream, RNG_DOMAIN_MUONSCALERES
 import ROOT
 import os
-import random
+import numpy as np
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
-
-def mk_safe(fct, *args):
-    try:
-        return fct(*args)
-    except Exception as e:
-        if any('Error in function boost::math::erf_inv' in arg
-               for arg in e.args):
-            print(
-                'WARNING: catching exception and returning -1. Exception arguments: %s'
-                % e.args)
-            return -1.
-        else:
-            raise e
+# loop over arrays of muons in C++, returning -1 when RoccoR fails in erf_inv
+_roccorBatchCode = """
+#include <cstring>
+#include <iostream>
+#include <stdexcept>
+template <typename F> double nanoAODTools_roccorSafe(F f) {
+  try {
+    return f();
+  } catch (std::exception &e) {
+    if (!std::strstr(e.what(), "Error in function boost::math::erf_inv")) throw;
+    std::cout << "WARNING: catching exception and returning -1. Exception arguments: " << e.what() << std::endl;
+    return -1.;
+  }
+}
+void nanoAODTools_roccorMC(const RoccoR &rc, int n, const int *charge, const double *pt, const double *eta,
+                           const double *phi, const int *nLayers, const double *genPt, const double *u,
+                           double *corr, double *err) {
+  for (int i = 0; i < n; ++i) {
+    if (genPt[i] >= 0) {
+      corr[i] = nanoAODTools_roccorSafe([&] { return rc.kSpreadMC(charge[i], pt[i], eta[i], phi[i], genPt[i]); });
+      err[i] = nanoAODTools_roccorSafe([&] { return rc.kSpreadMCerror(charge[i], pt[i], eta[i], phi[i], genPt[i]); });
+    } else {
+      corr[i] = nanoAODTools_roccorSafe([&] { return rc.kSmearMC(charge[i], pt[i], eta[i], phi[i], nLayers[i], u[i]); });
+      err[i] = nanoAODTools_roccorSafe([&] { return rc.kSmearMCerror(charge[i], pt[i], eta[i], phi[i], nLayers[i], u[i]); });
+    }
+  }
+}
+void nanoAODTools_roccorDT(const RoccoR &rc, int n, const int *charge, const double *pt, const double *eta,
+                           const double *phi, double *corr, double *err) {
+  for (int i = 0; i < n; ++i) {
+    corr[i] = nanoAODTools_roccorSafe([&] { return rc.kScaleDT(charge[i], pt[i], eta[i], phi[i]); });
+    err[i] = nanoAODTools_roccorSafe([&] { return rc.kScaleDTerror(charge[i], pt[i], eta[i], phi[i]); });
+  }
+}
+"""
 
 
 class muonScaleResProducer(Module):
-    def __init__(self, rc_dir, rc_corrections, dataYear):
+    def __init__(self, rc_dir, rc_corrections, dataYear, batchSize=0, seed=0):
+        """Rochester corrections of the muon pt.
+
+        The corrections of all the muons of an event, or of batchSize events
+        if batchSize > 0, are computed in one C++ loop. The random number used
+        to smear MC muons without a generator match depends only on (run,
+        lumi, event, muon index) and seed (a stream of the muon domain of
+        the generator, see tools.rngStream), so the results are the same
+        whatever the batching or the splitting of the jobs.
+        """
         p_postproc = '%s/src/PhysicsTools/NanoAODTools/python/postprocessing' % os.environ[
             'CMSSW_BASE']
         p_roccor = p_postproc + '/data/' + rc_dir
@@ -29,7 +62,12 @@ class muonScaleResProducer(Module):
             p_helper = '%s/RoccoR.cc' % p_roccor
             print('Loading C++ helper from ' + p_helper)
             ROOT.gROOT.ProcessLine('.L ' + p_helper)
+        if not hasattr(ROOT, "nanoAODTools_roccorMC"):
+            ROOT.gInterpreter.Declare(_roccorBatchCode)
         self._roccor = ROOT.RoccoR(p_roccor + '/' + rc_corrections)
+        self.batchSize = batchSize
+        self.seed = seed
+        self.rngStream = rngStream(RNG_DOMAIN_MUONSCALERES, seed)
 
     def beginJob(self):
         pass
@@ -43,56 +81,79 @@ class muonScaleResProducer(Module):
         self.out.branch("Muon_correctedUp_pt", "F", lenVar="nMuon")
         self.out.branch("Muon_correctedDown_pt", "F", lenVar="nMuon")
         self.is_mc = bool(inputTree.GetBranch("GenJet_pt"))
+        self.chunks = None
+        if self.batchSize:
+            branches = ["Muon_%s" % var for var in ("charge", "pt", "eta", "phi")]
+            if self.is_mc:
+                branches += ["Muon_nTrackerLayers", "Muon_genPartIdx", "GenPart_pt",
+                             "run", "luminosityBlock", "event"]
+            self.chunks = ChunkReader(inputTree, branches, self.batchSize)
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        pass
+        if self.chunks:
+            self.chunks.close()
+
+    def getCorrections(self, charge, pt, eta, phi, nLayers=None, genPt=None, u=None):
+        """Corrected pt and variations of arrays of muons.
+
+        genPt is the pt of the generator muon, negative for the muons without
+        one, and u the random numbers used to smear those.
+        """
+        n = len(pt)
+        charge = np.ascontiguousarray(charge, dtype=np.int32)
+        pt, eta, phi = [np.ascontiguousarray(x, dtype=np.float64) for x in (pt, eta, phi)]
+        corr, err = np.zeros(n), np.zeros(n)
+        if n and self.is_mc:
+            ROOT.nanoAODTools_roccorMC(self._roccor, n, charge, pt, eta, phi,
+                                       np.ascontiguousarray(nLayers, dtype=np.int32),
+                                       np.ascontiguousarray(genPt, dtype=np.float64),
+                                       np.ascontiguousarray(u, dtype=np.float64), corr, err)
+        elif n:
+            ROOT.nanoAODTools_roccorDT(self._roccor, n, charge, pt, eta, phi, corr, err)
+        pt_corr, pt_err = pt * corr, pt * err
+        return {"Muon_corrected_pt": pt_corr,
+                "Muon_correctedUp_pt": np.maximum(pt_corr + pt_err, 0.0),
+                "Muon_correctedDown_pt": np.maximum(pt_corr - pt_err, 0.0)}
+
+    def matchedGenPt(self, genPartIdx, genPt, genOffsets, muonEvent):
+        """pt of the generator muons, -1 for the muons without a valid genPartIdx"""
+        genPartIdx = genPartIdx.astype(np.int64)
+        valid = (genPartIdx >= 0) & (genPartIdx < np.diff(genOffsets)[muonEvent])
+        ret = np.full(len(genPartIdx), -1.)
+        ret[valid] = genPt[genOffsets[muonEvent[valid]] + genPartIdx[valid]]
+        return ret
 
     def analyze(self, event):
+        if self.chunks:
+            chunk, i = self.chunks.get(event)
+            if chunk is not None:
+                if not chunk.results:
+                    args = [chunk["Muon_" + var] for var in ("charge", "pt", "eta", "phi")]
+                    if self.is_mc:
+                        muonEvent = chunk.eventIndex(chunk.lenVars["Muon_pt"])
+                        muonOffsets = chunk.offsets[chunk.lenVars["Muon_pt"]]
+                        index = np.arange(len(muonEvent)) - muonOffsets[muonEvent]
+                        args += [chunk["Muon_nTrackerLayers"],
+                                 self.matchedGenPt(chunk["Muon_genPartIdx"], chunk["GenPart_pt"],
+                                                   chunk.offsets[chunk.lenVars["GenPart_pt"]], muonEvent),
+                                 counterUniform(chunk["run"][muonEvent], chunk["luminosityBlock"][muonEvent],
+                                                chunk["event"][muonEvent], index, self.rngStream)]
+                    chunk.results = self.getCorrections(*args)
+                off = chunk.offsets[chunk.lenVars["Muon_pt"]]
+                for name, values in chunk.results.items():
+                    self.out.fillBranch(name, values[off[i]:off[i + 1]])
+                return True
+
         muons = Collection(event, "Muon")
+        args = [[getattr(mu, var) for mu in muons] for var in ("charge", "pt", "eta", "phi")]
         if self.is_mc:
             genparticles = Collection(event, "GenPart")
-        roccor = self._roccor
-        if self.is_mc:
-            pt_corr = []
-            pt_err = []
-            for mu in muons:
-                genIdx = mu.genPartIdx
-                if genIdx >= 0 and genIdx < len(genparticles):
-                    genMu = genparticles[genIdx]
-                    pt_corr.append(mu.pt *
-                                   mk_safe(roccor.kSpreadMC, mu.charge, mu.pt,
-                                           mu.eta, mu.phi, genMu.pt))
-                    pt_err.append(mu.pt *
-                                  mk_safe(roccor.kSpreadMCerror, mu.charge,
-                                          mu.pt, mu.eta, mu.phi, genMu.pt))
-                else:
-                    u1 = random.uniform(0.0, 1.0)
-                    pt_corr.append(
-                        mu.pt * mk_safe(roccor.kSmearMC, mu.charge, mu.pt,
-                                        mu.eta, mu.phi, mu.nTrackerLayers, u1))
-                    pt_err.append(
-                        mu.pt * mk_safe(roccor.kSmearMCerror, mu.charge, mu.pt,
-                                        mu.eta, mu.phi, mu.nTrackerLayers, u1))
-
-        else:
-            pt_corr = list(
-                mu.pt *
-                mk_safe(roccor.kScaleDT, mu.charge, mu.pt, mu.eta, mu.phi)
-                for mu in muons)
-            pt_err = list(
-                mu.pt *
-                mk_safe(roccor.kScaleDTerror, mu.charge, mu.pt, mu.eta, mu.phi)
-                for mu in muons)
-
-        self.out.fillBranch("Muon_corrected_pt", pt_corr)
-        pt_corr_up = list(
-            max(pt_corr[imu] + pt_err[imu], 0.0)
-            for imu, mu in enumerate(muons))
-        pt_corr_down = list(
-            max(pt_corr[imu] - pt_err[imu], 0.0)
-            for imu, mu in enumerate(muons))
-        self.out.fillBranch("Muon_correctedUp_pt", pt_corr_up)
-        self.out.fillBranch("Muon_correctedDown_pt", pt_corr_down)
+            genPt = [genparticles[mu.genPartIdx].pt if 0 <= mu.genPartIdx < len(genparticles) else -1.
+                     for mu in muons]
+            args += [[mu.nTrackerLayers for mu in muons], genPt,
+                     counterUniform(event.run, event.luminosityBlock, event.event, np.arange(len(muons)), self.rngStream)]
+        for name, values in self.getCorrections(*args).items():
+            self.out.fillBranch(name, values)
         return True
 
 
@@ -0,0 +1,167 @@
+import hashlib
+import os
+from array import array
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+
+def logicalFileName(fileName):
+    """Strip the xrootd redirector, so the same file opened through different sites gives the same key"""
+    if '/store/' in fileName:
+        return '/store/' + fileName.split('/store/', 1)[1]
+    return os.path.abspath(fileName) if '://' not in fileName else fileName
+
+
+def binEdges(hist):
+    axis = hist.GetXaxis()
+    return [axis.GetBinLowEdge(i) for i in range(1, axis.GetNbins() + 2)]
+
+
+def _key(name, nvtxVar, template):
+    binning = ",".join("%r" % edge for edge in binEdges(template))
+    return hashlib.md5(("%s|%s|%s" % (name, nvtxVar, binning)).encode()).hexdigest()
+
+
+def profileKey(fileName, nvtxVar, template):
+    return _key(logicalFileName(fileName), nvtxVar, template)
+
+
+def datasetProfileName(dataset, nvtxVar, template):
+    """Name of the merged profile of a dataset in the file written by the pre-pass"""
+    return "autoPU_" + _key(dataset, nvtxVar, template)
+
+
+def scanProfile(fileName, nvtxVar, template, treeName="Events"):
+    """Fill a clone of template with nvtxVar for all the events of a file.
+
+       The file is opened on its own handle and only the nvtxVar branch is
+       enabled and cached, so only its baskets are read.
+    """
+    tfile = ROOT.TFile.Open(fileName)
+    if not tfile or tfile.IsZombie():
+        raise IOError("Could not open file %s" % fileName)
+    tree = tfile.Get(treeName)
+    tree.SetBranchStatus("*", 0)
+    tree.SetBranchStatus(nvtxVar, 1)
+    tree.SetCacheSize(10 * 1024 * 1024)
+    tree.AddBranchToCache(nvtxVar, True)
+    tree.StopCacheLearningPhase()
+    ROOT.gROOT.cd()
+    hist = template.Clone("autoPU_scan")
+    hist.Reset()
+    hist.SetDirectory(ROOT.gROOT)
+    tree.Project(hist.GetName(), nvtxVar)
+    hist.SetDirectory(0)
+    tfile.Close()
+    return hist
+
+
+class PUProfileCache:
+    """Pileup profiles of single files, stored on disk next to each other.
+
+       The profile of a file is computed once (see scanProfile) and stored as
+       <cacheDir>/<key>.root, the key being built from the logical file name,
+       the variable and the binning. Any later job needing it, for this or
+       another dataset-level merge, reads it back instead of scanning the file.
+    """
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        if cacheDir and not os.path.exists(cacheDir):
+            try:
+                os.makedirs(cacheDir)
+            except OSError:
+                # created by a concurrent job
+                pass
+
+    def path(self, fileName, nvtxVar, template):
+        return os.path.join(self.cacheDir, profileKey(fileName, nvtxVar, template) + ".root")
+
+    def load(self, path):
+        tfile = ROOT.TFile.Open(path)
+        if not tfile or tfile.IsZombie():
+            return None
+        hist = tfile.Get("autoPU")
+        if hist:
+            hist.SetDirectory(0)
+        tfile.Close()
+        return hist or None
+
+    def get(self, fileName, nvtxVar, template, source=None):
+        """Profile of fileName, scanned from source (e.g. a local copy of it) if not cached yet"""
+        path = self.path(fileName, nvtxVar, template)
+        if os.path.exists(path):
+            hist = self.load(path)
+            if hist is not None:
+                return hist
+        hist = scanProfile(source or fileName, nvtxVar, template)
+        # write to a temporary file first, concurrent jobs may look for the same profile
+        tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        tfile = ROOT.TFile.Open(tmpPath, "RECREATE")
+        hist.Write("autoPU")
+        ROOT.TNamed("source", logicalFileName(fileName)).Write()
+        tfile.Close()
+        os.rename(tmpPath, path)
+        return hist
+
+
+def datasetProfile(fileNames, nvtxVar, template, cacheDir=None):
+    """Merged pileup profile of all the files of a dataset"""
+    cache = PUProfileCache(cacheDir) if cacheDir else None
+    merged = template.Clone("autoPU_dataset")
+    merged.Reset()
+    merged.SetDirectory(0)
+    for i, fileName in enumerate(fileNames):
+        hist = cache.get(fileName, nvtxVar, template) if cache else scanProfile(fileName, nvtxVar, template)
+        merged.Add(hist)
+        if (i + 1) % 50 == 0:
+            print("Pileup profile: %d/%d files" % (i + 1, len(fileNames)))
+    return merged
+
+
+def writeDatasetProfiles(path, profiles):
+    """Write the merged profiles of the datasets, a dict name -> histogram (see datasetProfileName), to one file"""
+    tfile = ROOT.TFile.Open(path, "RECREATE")
+    for name, hist in profiles.items():
+        hist.Write(name)
+    tfile.Close()
+
+
+def readDatasetProfile(path, dataset, nvtxVar, template):
+    """Merged profile of dataset from the file written by writeDatasetProfiles"""
+    tfile = ROOT.TFile.Open(path)
+    if not tfile or tfile.IsZombie():
+        raise IOError("Could not open pileup profile file %s" % path)
+    hist = tfile.Get(datasetProfileName(dataset, nvtxVar, template))
+    if not hist:
+        tfile.Close()
+        raise RuntimeError("No pileup profile of %s for %s in %s" % (nvtxVar, dataset, path))
+    hist.SetDirectory(0)
+    tfile.Close()
+    return hist
+
+
+def _cacheProfile(job):
+    fileName, nvtxVar, edges, cacheDir = job
+    template = ROOT.TH1D("autoPU_template", "", len(edges) - 1, array('d', edges))
+    template.SetDirectory(0)
+    PUProfileCache(cacheDir).get(fileName, nvtxVar, template)
+    return fileName
+
+
+def fillCache(fileNames, nvtxVar, template, cacheDir, nProcs=4):
+    """Pre-pass computing the missing profiles of fileNames in cacheDir with nProcs processes"""
+    import multiprocessing
+    cache = PUProfileCache(cacheDir)
+    missing = [f for f in fileNames if not os.path.exists(cache.path(f, nvtxVar, template))]
+    if not missing:
+        return
+    edges = binEdges(template)
+    pool = multiprocessing.Pool(min(nProcs, len(missing)))
+    try:
+        for i, _ in enumerate(pool.imap_unordered(_cacheProfile, [(f, nvtxVar, edges, cacheDir) for f in missing])):
+            if (i + 1) % 50 == 0 or i + 1 == len(missing):
+                print("Pileup profile cache: %d/%d files scanned" % (i + 1, len(missing)))
+    finally:
+        pool.close()
+        pool.join()
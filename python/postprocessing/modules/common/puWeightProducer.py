@@ -1,5 +1,7 @@
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
+from PhysicsTools.NanoAODTools.postprocessing.modules.common.puProfile import PUProfileCache, datasetProfile, readDatasetProfile
 import ROOT
 import os
 import numpy as np
@@ -7,6 +9,20 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 
 class puWeightProducer(Module):
+    """Pileup weights from the ratio of the data and MC pileup profiles.
+
+       The weights only depend on the integer value of nvtx_var, so they are
+       tabulated once per file (see weightTable) and looked up by index. With
+       batchSize > 0, nvtx_var is read for batchSize events at a time and the
+       weights of all these events are obtained with one array indexing.
+
+       With myfile="auto" the MC profile is by default made from each input
+       file. If profileFiles (all the files of the dataset) is given, the
+       merged profile of the dataset is used for all the files instead, and
+       with profileCache the profiles of single files are stored in that
+       directory and reused by all the jobs (see puProfile). The merged
+       profile can also be read from a file (see setDatasetProfile).
+    """
     def __init__(self,
                  myfile,
                  targetfile,
@@ -16,7 +32,10 @@ class puWeightProducer(Module):
                  norm=True,
                  verbose=False,
                  nvtx_var="Pileup_nTrueInt",
-                 doSysVar=True
+                 doSysVar=True,
+                 batchSize=0,
+                 profileFiles=None,
+                 profileCache=None
      ):
         print(targetfile,targethist)
         self.targeth = self.loadHisto(targetfile, targethist)
@@ -40,6 +59,10 @@ class puWeightProducer(Module):
         self.verbose = verbose
         self.nvtxVar = nvtx_var
         self.doSysVar = doSysVar
+        self.batchSize = batchSize
+        self.profileFiles = profileFiles
+        self.profileCache = profileCache
+        self._datasetProfile = None
 
         # Try to load module via python dictionaries
         try:
@@ -58,6 +81,19 @@ class puWeightProducer(Module):
                     % os.environ['CMSSW_BASE'])
             dummy = ROOT.WeightCalculatorFromHistogram
 
+    def setProfileDataset(self, fileNames, cacheDir=None):
+        """Use the merged profile of all the files of the dataset with autoPU (fileNames None: the profile of each file, from cacheDir)"""
+        self.profileFiles = fileNames
+        self.profileCache = cacheDir
+        self._datasetProfile = None
+
+    def setDatasetProfile(self, profileFile, dataset):
+        """Use with autoPU the merged profile of dataset stored in profileFile (see puProfile.writeDatasetProfiles)"""
+        if self.autoPU:
+            self.profileFiles = None
+            self.profileCache = None
+            self._datasetProfile = readDatasetProfile(profileFile, dataset, self.nvtxVar, self.myh)
+
     def loadHisto(self, filename, hname):
         tf = ROOT.TFile.Open(filename)
         hist = tf.Get(hname)
@@ -75,10 +111,23 @@ class puWeightProducer(Module):
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         if self.autoPU:
             self.myh.Reset()
-            print("Computing PU profile for this file")
-            ROOT.gROOT.cd()
-            inputFile.Get("Events").Project("autoPU",
-                                            self.nvtxVar)  # doitfrom inputFile
+            if self.profileFiles and self._datasetProfile is None:
+                print("Computing PU profile for the dataset (%d files)" % len(self.profileFiles))
+                self._datasetProfile = datasetProfile(self.profileFiles, self.nvtxVar, self.myh,
+                                                      self.profileCache)
+            if self._datasetProfile is not None:
+                self.myh.Add(self._datasetProfile)
+            elif self.profileCache:
+                print("Loading PU profile for this file from %s" % self.profileCache)
+                # cached under the name given to the postprocessor, the file read may be a local copy
+                fileName = getattr(inputTree, 'inputFileName', inputFile.GetName())
+                self.myh.Add(PUProfileCache(self.profileCache).get(fileName, self.nvtxVar, self.myh,
+                                                                   source=inputFile.GetName()))
+            else:
+                print("Computing PU profile for this file")
+                ROOT.gROOT.cd()
+                inputFile.Get("Events").Project("autoPU",
+                                                self.nvtxVar)  # doitfrom inputFile
             if outputFile:
                 outputFile.cd()
                 self.myh.Write()
@@ -87,6 +136,7 @@ class puWeightProducer(Module):
             self.verbose)
         self.out = wrappedOutputTree
         self.out.branch(self.name, "F")
+        self.weights = {self.name: self.weightTable(self._worker)}
         if self.doSysVar:
             self._worker_plus = ROOT.WeightCalculatorFromHistogram(
                 self.myh, self.targeth_plus, self.norm, self.fixLargeWeights,
@@ -96,31 +146,47 @@ class puWeightProducer(Module):
                 self.verbose)
             self.out.branch(self.name + "Up", "F")
             self.out.branch(self.name + "Down", "F")
+            self.weights[self.name + "Up"] = self.weightTable(self._worker_plus)
+            self.weights[self.name + "Down"] = self.weightTable(self._worker_minus)
+        self.chunks = None
+        if self.batchSize and inputTree.GetBranch(self.nvtxVar):
+            self.chunks = ChunkReader(inputTree, [self.nvtxVar], self.batchSize)
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        pass
+        if self.chunks:
+            self.chunks.close()
+
+    def weightTable(self, worker):
+        """Weights for nvtx = 0 ... nbins - 1, followed by 1 for the values beyond the histogram"""
+        nbins = self.myh.GetNbinsX()
+        return np.array([worker.getWeight(nvtx) for nvtx in range(nbins)] + [1.], dtype=np.float32)
+
+    def getWeights(self, nvtx):
+        """Weights for an array of nvtx values, as a dict branch name -> array"""
+        idx = np.clip(np.asarray(nvtx).astype(np.int64), 0, self.myh.GetNbinsX())
+        return dict((name, table[idx]) for name, table in self.weights.items())
 
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
+        if self.chunks:
+            chunk, i = self.chunks.get(event)
+            if chunk is not None:
+                if not chunk.results:
+                    chunk.results = self.getWeights(chunk[self.nvtxVar])
+                for name, weights in chunk.results.items():
+                    self.out.fillBranch(name, weights[i])
+                return True
         if hasattr(event, self.nvtxVar):
-            nvtx = int(getattr(event, self.nvtxVar))
-            weight = self._worker.getWeight(
-                nvtx) if nvtx < self.myh.GetNbinsX() else 1
-            if self.doSysVar:
-                weight_plus = self._worker_plus.getWeight(
-                    nvtx) if nvtx < self.myh.GetNbinsX() else 1
-                weight_minus = self._worker_minus.getWeight(
-                    nvtx) if nvtx < self.myh.GetNbinsX() else 1
+            idx = min(max(int(getattr(event, self.nvtxVar)), 0), self.myh.GetNbinsX())
+            for name, table in self.weights.items():
+                self.out.fillBranch(name, table[idx])
         else:
-            weight = 1
-        self.out.fillBranch(self.name, weight)
-        if self.doSysVar:
-            self.out.fillBranch(self.name + "Up", weight_plus)
-            self.out.fillBranch(self.name + "Down", weight_minus)
+            for name in self.weights:
+                self.out.fillBranch(name, 1)
         return True
 
 
-class puWeightProducer3Files(Module): # used when 3 files provided for data up and down
+class puWeightProducer3Files(puWeightProducer): # used when 3 files provided for data up and down
     def __init__(self,
                  myfile,
                  targetfile,
@@ -133,6 +199,9 @@ class puWeightProducer3Files(Module): # used when 3 files provided for data up a
                  doSysVar=True,
                  varfile_up="",
                  varfile_dn="",
+                 batchSize=0,
+                 profileFiles=None,
+                 profileCache=None
      ):
         self.targeth = self.loadHisto(targetfile, targethist)
         if doSysVar:
@@ -163,6 +232,10 @@ class puWeightProducer3Files(Module): # used when 3 files provided for data up a
         self.verbose = verbose
         self.nvtxVar = nvtx_var
         self.doSysVar = doSysVar
+        self.batchSize = batchSize
+        self.profileFiles = profileFiles
+        self.profileCache = profileCache
+        self._datasetProfile = None
 
         # Try to load module via python dictionaries
         try:
@@ -180,64 +253,6 @@ class puWeightProducer3Files(Module): # used when 3 files provided for data up a
                     ".L %s/src/PhysicsTools/NanoAODTools/src/WeightCalculatorFromHistogram.cc++"
                     % os.environ['CMSSW_BASE'])
             dummy = ROOT.WeightCalculatorFromHistogram
-    def loadHisto(self, filename, hname):
-        tf = ROOT.TFile.Open(filename)
-        hist = tf.Get(hname)
-        hist.SetDirectory(0)
-        tf.Close()
-        return hist
-
-    def beginJob(self):
-        pass
-
-    def endJob(self):
-        pass
-
-    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        if self.autoPU:
-            self.myh.Reset()
-            print("Computing PU profile for this file")
-            ROOT.gROOT.cd()
-            inputFile.Get("Events").Project("autoPU",
-                                            self.nvtxVar)  # doitfrom inputFile
-            if outputFile:
-                outputFile.cd()
-                self.myh.Write()
-        self._worker = ROOT.WeightCalculatorFromHistogram(
-            self.myh, self.targeth, self.norm, self.fixLargeWeights,
-            self.verbose)
-        self.out = wrappedOutputTree
-        self.out.branch(self.name, "F")
-        if self.doSysVar:
-            self._worker_plus = ROOT.WeightCalculatorFromHistogram(
-                self.myh, self.targeth_plus, self.norm, self.fixLargeWeights,
-                self.verbose)
-            self._worker_minus = ROOT.WeightCalculatorFromHistogram(
-                self.myh, self.targeth_minus, self.norm, self.fixLargeWeights,
-                self.verbose)
-            self.out.branch(self.name + "Up", "F")
-            self.out.branch(self.name + "Down", "F")
-    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        pass
-
-    def analyze(self, event):
-        """process event, return True (go to next module) or False (fail, go to next event)"""
-        if hasattr(event, self.nvtxVar):
-            nvtx = int(getattr(event, self.nvtxVar))
-            weight = self._worker.getWeight(
-                nvtx) if nvtx < self.myh.GetNbinsX() else 1
-            if self.doSysVar:
-                weight_plus = self._worker_plus.getWeight(
-                    nvtx) if nvtx < self.myh.GetNbinsX() else 1
-                weight_minus = self._worker_minus.getWeight(
-                    nvtx) if nvtx < self.myh.GetNbinsX() else 1
-        else:
-            weight = 1
-        self.out.fillBranch(self.name, weight)
-        if self.doSysVar:
-            self.out.fillBranch(self.name + "Up", weight_plus)
-            self.out.fillBranch(self.name + "Down", weight_minus)
-        return True
 
 
 # define modules using the syntax 'name = lambda : constructor' to avoid having them loaded when not needed
@@ -2,6 +2,7 @@ import os
 import ROOT
 import numpy as np
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection 
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.helpers.TauIDSFTool import TauIDSFTool, TauESTool, TauFESTool
 from PhysicsTools.NanoAODTools.postprocessing.tools import ensureTFile, extractTH1
@@ -15,9 +16,11 @@ class TauCorrectionsProducer(Module):
                              antiEleID='DeepTau2017v2p1VSe',   antiEleWPs=['VVLoose','Tight'],
                              antiMuID='DeepTau2017v2p1VSmu',   antiMuWPs=['VLoose','Tight'],
                              antiJetPerDM=False, sys=True,
-                             tes=True, fes=True, tesSys=True, path=datapath, verbose=False):
+                             tes=True, fes=True, tesSys=True, path=datapath, batchSize=0, verbose=False):
         """Choose the IDs and WPs for SFs. For available tau IDs, WPs and corrections, check
-        https://cms-nanoaod-integration.web.cern.ch/integration/master-102X/mc102X_doc.html#Tau"""
+        https://cms-nanoaod-integration.web.cern.ch/integration/master-102X/mc102X_doc.html#Tau
+        The SFs and corrections of all taus are computed at once with the array methods of the tools,
+        for each event, or for batchSize events at a time if batchSize > 0."""
         
         if isinstance(antiJetWPs,str): WPs        = [WPs]
         if isinstance(antiEleWPs,str): antiEleWPs = [antiEleWPs]
@@ -53,7 +56,9 @@ class TauCorrectionsProducer(Module):
         self.doTESSys   = (tes or fes) and tesSys # include tau energy-scale variations (incl. e and mu -> tau fake)
         self.testool    = testool     # tau energy-scale correction tool
         self.festool    = festool     # e -> tau fake energy-scale correction tool
+        self.batchSize  = batchSize   # number of events for which the corrections are computed at once
         self.verbose    = verbose     # verbose print-out
+        self.tauVars    = ['pt','eta','mass','decayMode','genPartFlav']
     
     def beginJob(self):
         pass
@@ -81,134 +86,76 @@ class TauCorrectionsProducer(Module):
             self.out.branch("Tau_mass_corrUp",   'F', lenVar='nTau', title="tau mass, corrected with the tau energy scale, up variation")
             self.out.branch("Tau_pt_corrDown",   'F', lenVar='nTau', title="tau pT, corrected with the tau energy scale, down variation")
             self.out.branch("Tau_mass_corrDown", 'F', lenVar='nTau', title="tau mass, corrected with the tau energy scale, down variation")
+        
+        self.chunks = None
+        if self.batchSize:
+          self.chunks = ChunkReader(inputTree,['Tau_'+v for v in self.tauVars],self.batchSize)
     
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        pass
+        if self.chunks:
+          self.chunks.close()
     
     def analyze(self, event):
         """Process event, return True (pass, go to next module) or False (fail, go to next event)."""
         
-        # BRANCH VALUES
-        if self.doSys:
-          tau_sfs = { # dictionary: ID type -> tool -> ([SFDown],[SF],[SFUp])
-            'antiJet': { t: ([1.]*event.nTau,[1.]*event.nTau,[1.]*event.nTau) for t in self.antiJetSFs },
-            'antiEle': { t: ([1.]*event.nTau,[1.]*event.nTau,[1.]*event.nTau) for t in self.antiEleSFs },
-            'antiMu':  { t: ([1.]*event.nTau,[1.]*event.nTau,[1.]*event.nTau) for t in self.antiMuSFs  },
-          }      
-        else:
-          tau_sfs = { # dictionary: ID type -> tool -> [SF]
-            'antiJet': { t: [1.]*event.nTau for t in self.antiJetSFs },
-            'antiEle': { t: [1.]*event.nTau for t in self.antiEleSFs },
-            'antiMu':  { t: [1.]*event.nTau for t in self.antiMuSFs  },
-          }
-        if self.doTES:
-          taus_pt_corr         = [ ]
-          taus_mass_corr       = [ ]
-          if self.doTESSys:
-            taus_pt_corrUp     = [ ]
-            taus_pt_corrDown   = [ ]
-            taus_mass_corrUp   = [ ]
-            taus_mass_corrDown = [ ]
+        # CHUNK of events
+        if self.chunks:
+          chunk, i = self.chunks.get(event)
+          if chunk is not None:
+            if not chunk.results:
+              chunk.results = self.getCorrections(*[chunk['Tau_'+v] for v in self.tauVars])
+            off = chunk.offsets['nTau']
+            for branch, values in chunk.results.items():
+              self.out.fillBranch(branch,values[off[i]:off[i+1]])
+            return True
         
-        # LOOP over TAUS
+        # SINGLE event
         taus = Collection(event,'Tau')
-        for i, tau in enumerate(taus):
-          
-          # UNCORRECTED PT / MASS
-          if self.doTES:
-            taus_pt_corr.append(tau.pt)
-            taus_mass_corr.append(tau.mass)
-            if self.doTESSys:
-              taus_pt_corrUp.append(tau.pt)
-              taus_pt_corrDown.append(tau.pt)
-              taus_mass_corrUp.append(tau.mass)
-              taus_mass_corrDown.append(tau.mass)
-          
-          # REAL TAU
-          if tau.genPartFlav==5:
-            for tool in tau_sfs['antiJet']:
-              if self.doSys:
-                tau_sfs['antiJet'][tool][0][i], tau_sfs['antiJet'][tool][1][i], tau_sfs['antiJet'][tool][2][i] \
-                                            = tool.getSFvsPT(tau.pt,unc='All')
-              else:
-                tau_sfs['antiJet'][tool][i] = tool.getSFvsPT(tau.pt)
-            if self.doTES:
-              if self.doTESSys:
-                tesDown, tes, tesUp    = self.testool.getTES(tau.pt,tau.decayMode,unc='All')
-                taus_pt_corr[i]       *= tes
-                taus_pt_corrUp[i]     *= tesUp
-                taus_pt_corrDown[i]   *= tesDown
-                taus_mass_corr[i]     *= tes
-                taus_mass_corrUp[i]   *= tesUp
-                taus_mass_corrDown[i] *= tesDown
-              else:
-                tes                    = self.testool.getTES(tau.pt,tau.decayMode)
-                taus_pt_corr[i]       *= tes
-                taus_mass_corr[i]     *= tes
-          
-          # ELECTRON -> TAU
-          elif tau.genPartFlav in [1,3]:
-            for tool in tau_sfs['antiEle']:
-              if self.doSys:
-                tau_sfs['antiEle'][tool][0][i], tau_sfs['antiEle'][tool][1][i], tau_sfs['antiEle'][tool][2][i] \
-                                            = tool.getSFvsEta(tau.eta,tau.genPartFlav,unc='All')
-              else:
-                tau_sfs['antiEle'][tool][i] = tool.getSFvsEta(tau.eta,tau.genPartFlav)
-            if self.doFES:
-              if self.doTESSys:
-                fesDown, fes, fesUp    = self.festool.getFES(tau.eta,tau.decayMode,unc='All')
-                taus_pt_corr[i]       *= fes
-                taus_pt_corrUp[i]     *= fesUp
-                taus_pt_corrDown[i]   *= fesDown
-                taus_mass_corr[i]     *= fes
-                taus_mass_corrUp[i]   *= fesUp
-                taus_mass_corrDown[i] *= fesDown
-              else:
-                fes                    = self.festool.getFES(tau.eta,tau.decayMode)
-                taus_pt_corr[i]       *= fes
-                taus_mass_corr[i]     *= fes
-          
-          # MUON -> TAU
-          elif tau.genPartFlav in [2,4]:
-            for tool in tau_sfs['antiMu']:
-              if self.doSys:
-                tau_sfs['antiMu'][tool][0][i], tau_sfs['antiMu'][tool][1][i], tau_sfs['antiMu'][tool][2][i] \
-                                           = tool.getSFvsEta(tau.eta,tau.genPartFlav,unc='All')
-              else:
-                tau_sfs['antiMu'][tool][i] = tool.getSFvsEta(tau.eta,tau.genPartFlav)
-            if self.doTESSys:
-              taus_pt_corrUp[i]     *= 1.01 # +1%
-              taus_pt_corrDown[i]   *= 0.99 # -1%
-              taus_mass_corrUp[i]   *= 1.01 # +1%
-              taus_mass_corrDown[i] *= 0.99 # -1%
+        for branch, values in self.getCorrections(*[np.array([getattr(t,v) for t in taus],dtype=np.float64) for v in self.tauVars]).items():
+          self.out.fillBranch(branch,values)
+        return True
+    
+    def getCorrections(self, pt, eta, mass, dm, genmatch):
+        """Compute all output branches for arrays of taus: branch name -> array."""
+        branches = { }
+        unc      = 'All' if self.doSys else None
         
-        # FILL BRANCHES
-        if self.doSys:
-          for key, toolSFs in tau_sfs.items():
-            for tool, sfs in toolSFs.items():
-              #for tau, sfdown, sf, sfup in zip(taus,sfs[0],sfs[1],sfs[2]):
-              #  if tau.genPartFlav>0: print ">>> %-38s %3d %5d %6.2f %6.2f %6.2f +%6.2f -%6.2f"%(tool.branchname,tau.genPartFlav,tau.decayMode,tau.pt,tau.eta,sf,sfup,sfdown)
-              self.out.fillBranch(tool.branchname+'Down',sfs[0])
-              self.out.fillBranch(tool.branchname,       sfs[1])
-              self.out.fillBranch(tool.branchname+'Up',  sfs[2])
-        else:
-          for key, toolSFs in tau_sfs.items():
-            for tool, sfs in toolSFs.items():
-              self.out.fillBranch(tool.branchname,sfs)
-        if self.doTES:
-          self.out.fillBranch("Tau_pt_corr",         taus_pt_corr)
-          self.out.fillBranch("Tau_mass_corr",       taus_mass_corr)
+        # TAU DISCRIMINATOR SFs; the tools give SF = 1 to taus of other gen. matches
+        for tool in self.antiJetSFs:
+          if hasattr(tool,'DMs'): # DM-dependent SFs
+            sfs = tool.getSFvsDMArray(pt,dm,genmatch,unc=unc)
+          else:
+            sfs = tool.getSFvsPTArray(pt,genmatch,unc=unc)
+          self.addSFs(branches,tool,sfs)
+        for tool in self.antiEleSFs+self.antiMuSFs:
+          self.addSFs(branches,tool,tool.getSFvsEtaArray(eta,genmatch,unc=unc))
+        
+        # ENERGY SCALES
+        if self.doTES or self.doFES:
+          scale = np.ones((3,len(pt))) # down, central, up
+          if self.doTES: # real tau
+            scale *= self.testool.getTESArray(pt,dm,genmatch,unc='All')
+          if self.doFES: # electron -> tau
+            scale *= self.festool.getFESArray(eta,dm,genmatch,unc='All')
+          muon = (genmatch==2) | (genmatch==4) # muon -> tau
+          scale[0][muon] *= 0.99 # -1%
+          scale[2][muon] *= 1.01 # +1%
+          branches["Tau_pt_corr"]   = pt*scale[1]
+          branches["Tau_mass_corr"] = mass*scale[1]
           if self.doTESSys:
-            #for tau, pt, ptup, ptdown in zip(taus,taus_pt_corr,taus_pt_corrUp,taus_pt_corrDown):
-            #  if tau.genPartFlav>0: print ">>> %5d %5d %6.2f %6.2f +%6.2f -%6.2f"%(tau.genPartFlav,tau.decayMode,tau.pt,pt,ptup,ptdown)
-            self.out.fillBranch("Tau_pt_corrUp",     taus_pt_corrUp)
-            self.out.fillBranch("Tau_pt_corrDown",   taus_pt_corrDown)
-            self.out.fillBranch("Tau_mass_corrUp",   taus_mass_corrUp)
-            self.out.fillBranch("Tau_mass_corrDown", taus_mass_corrDown)
+            branches["Tau_pt_corrUp"]     = pt*scale[2]
+            branches["Tau_pt_corrDown"]   = pt*scale[0]
+            branches["Tau_mass_corrUp"]   = mass*scale[2]
+            branches["Tau_mass_corrDown"] = mass*scale[0]
         
-        return True
+        return branches
+    
+    def addSFs(self, branches, tool, sfs):
+        if self.doSys:
+          branches[tool.branchname+'Down'], branches[tool.branchname], branches[tool.branchname+'Up'] = sfs
+        else:
+          branches[tool.branchname] = sfs
     
-
 
 # DEFINE modules to avoid having them loaded when not needed
 tauCorrs2016Legacy = lambda: TauCorrectionsProducer('2016Legacy')
@@ -29,7 +29,8 @@ class fatJetUncertaintiesProducer(Module):
             isData=False,
             applySmearing=True,
             applyHEMfix=False,
-            splitJER=False
+            splitJER=False,
+            counterRNG=False
     ):
         self.era = era
         self.noGroom = noGroom
@@ -85,7 +86,7 @@ class fatJetUncertaintiesProducer(Module):
 
         self.jetSmearer = jetSmearer(globalTag, jetType, self.jerInputFileName,
                                      self.jerUncertaintyInputFileName,
-                                     self.jmrVals)
+                                     self.jmrVals, counterRNG)
 
         if "AK4" in jetType:
             self.jetBranchName = "Jet"
@@ -435,7 +436,7 @@ class fatJetUncertaintiesProducer(Module):
         if not self.isData:
             pairs = matchObjectCollection(jets, genJets)
 
-        for jet in jets:
+        for iJet, jet in enumerate(jets):
             # jet pt and mass corrections
             jet_pt = jet.pt
             jet_mass = jet.mass
@@ -461,7 +462,7 @@ class fatJetUncertaintiesProducer(Module):
             if not self.isData:
                 (jet_pt_jerNomVal, jet_pt_jerUpVal,
                  jet_pt_jerDownVal) = self.jetSmearer.getSmearValsPt(
-                     jet, genJet, rho)
+                     jet, genJet, rho, iJet)
             else:
                 # set values to 1 for data so that jet_pt_nom is not smeared
                 (jet_pt_jerNomVal, jet_pt_jerUpVal, jet_pt_jerDownVal) = (1, 1,
@@ -479,7 +480,7 @@ class fatJetUncertaintiesProducer(Module):
             if not self.isData:
                 (jet_mass_jmrNomVal, jet_mass_jmrUpVal,
                  jet_mass_jmrDownVal) = self.jetSmearer.getSmearValsM(
-                     jet, genJet)
+                     jet, genJet, iJet)
             else:
                 # set values to 1 for data so that jet_mass_nom is not smeared
                 (jet_mass_jmrNomVal, jet_mass_jmrUpVal,
@@ -579,7 +580,7 @@ class fatJetUncertaintiesProducer(Module):
                     (jet_msdcorr_jmrNomVal, jet_msdcorr_jmrUpVal,
                      jet_msdcorr_jmrDownVal) = \
                         (self.jetSmearer.getSmearValsM(groomedP4,
-                         genGroomedJet) if groomedP4 is not None
+                         genGroomedJet, iJet, "msdcorr") if groomedP4 is not None
                          and genGroomedJet is not None else (0., 0., 0.))
                 else:
                     (jet_msdcorr_jmrNomVal, jet_msdcorr_jmrUpVal,
@@ -647,7 +648,7 @@ class fatJetUncertaintiesProducer(Module):
                      jet_msdcorr_tau21DDT_jmrUpVal,
                      jet_msdcorr_tau21DDT_jmrDownVal
                      ) = self.jetSmearer.getSmearValsM(
-                         groomedP4, genGroomedJet
+                         groomedP4, genGroomedJet, iJet, "msdcorr_tau21DDT"
                      ) if groomedP4 is not None and genGroomedJet is not None else (0., 0., 0.)
 
                     jet_msdcorr_tau21DDT_nom = jet_pt_jerNomVal * \
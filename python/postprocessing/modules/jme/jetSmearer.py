@@ -1,4 +1,5 @@
-from PhysicsTools.NanoAODTools.postprocessing.tools import matchObjectCollection, matchObjectCollectionMultiple
+from PhysicsTools.NanoAODTools.postprocessing.tools import matchObjectCollection, matchObjectCollectionMultiple, counterGaus, \
+    rngStream, RNG_DOMAIN_JETSMEARER
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 import ROOT
@@ -18,7 +19,8 @@ class jetSmearer(Module):
             jetType="AK4PFchs",
             jerInputFileName="Spring16_25nsV10_MC_PtResolution_AK4PFchs.txt",
             jerUncertaintyInputFileName="Spring16_25nsV10_MC_SF_AK4PFchs.txt",
-            jmr_vals=[1.09, 1.14, 1.04]):
+            jmr_vals=[1.09, 1.14, 1.04],
+            counterRNG=False):
 
         # -------------------------------------------------------------------
         # CV: globalTag and jetType not yet used, as there is no consistent
@@ -48,6 +50,14 @@ class jetSmearer(Module):
         # initialize random number generator
         # (needed for jet pT smearing)
         self.rnd = ROOT.TRandom3(12345)
+        # with counterRNG, the random numbers are instead drawn from a
+        # counter-based generator keyed by (run, lumi, event), the jet index
+        # and the variation (see getRandomGaus), so they don't depend on the
+        # order of the calls
+        self.counterRNG = counterRNG
+        self.eventId = (0, 0, 0)
+        self.nCalls = {}
+        self.eventGaus = {}
 
         # load libraries for accessing JER scale factors and uncertainties from txt files
         for library in [
@@ -82,8 +92,17 @@ class jetSmearer(Module):
     def endJob(self):
         shutil.rmtree(self.jerInputFilePath)
 
+    # stream of the counter-based generator for each smeared quantity
+    rngStreams = dict((name, rngStream(RNG_DOMAIN_JETSMEARER, i)) for i, name in
+                      enumerate(("pt", "mass", "msdcorr", "msdcorr_tau21DDT"), 1))
+
     def setSeed(self, event):
         """Set seed deterministically."""
+        if self.counterRNG:
+            self.eventId = (int(event.run), int(event.luminosityBlock), int(event.event))
+            self.nCalls = {}
+            self.eventGaus = {}
+            return
         # (cf. https://github.com/cms-sw/cmssw/blob/master/PhysicsTools/PatUtils/interface/SmearedJetProducerT.h)
         runnum = int(event.run) << 20
         luminum = int(event.luminosityBlock) << 10
@@ -92,13 +111,35 @@ class jetSmearer(Module):
         seed = 1 + runnum + evtnum + luminum + jet0eta
         self.rnd.SetSeed(seed)
 
-    def getSmearedJetPt(self, jet, genJet, rho):
+    def getRandomGaus(self, sigma, index, variation):
+        """Gaussian random number for the jet index of the current event.
+
+        Without counterRNG, this is the next number of the TRandom3 sequence.
+        With counterRNG, it only depends on the event, index and variation
+        (one of rngStreams); if index is None, the calls for the variation are
+        numbered in the order they are made in the event. The unit Gaussian
+        numbers of the event are drawn at once for the first indices of each
+        variation, so a call is a lookup.
+        """
+        if not self.counterRNG:
+            return self.rnd.Gaus(0, sigma)
+        if index is None:
+            index = self.nCalls.get(variation, 0)
+            self.nCalls[variation] = index + 1
+        numbers = self.eventGaus.get(variation)
+        if numbers is None or index >= len(numbers):
+            n = max(index + 1, 2 * len(numbers) if numbers is not None else 16)
+            numbers = counterGaus(*(self.eventId + (np.arange(n), self.rngStreams[variation]))).tolist()
+            self.eventGaus[variation] = numbers
+        return sigma * numbers[index]
+
+    def getSmearedJetPt(self, jet, genJet, rho, index=None):
         (jet_pt_nomVal, jet_pt_jerUpVal,
-         jet_pt_jerDownVal) = self.getSmearValsPt(jet, genJet, rho)
+         jet_pt_jerDownVal) = self.getSmearValsPt(jet, genJet, rho, index)
         return (jet_pt_nomVal * jet.pt, jet_pt_jerUpVal * jet.pt,
                 jet_pt_jerDownVal * jet.pt)
 
-    def getSmearValsPt(self, jetIn, genJetIn, rho):
+    def getSmearValsPt(self, jetIn, genJetIn, rho, index=None):
 
         if hasattr(jetIn, "p4"):
             jet = jetIn.p4()
@@ -160,7 +201,7 @@ class jetSmearer(Module):
             self.params_resolution.setRho(rho)
             jet_pt_resolution = self.jer.getResolution(self.params_resolution)
 
-            rand = self.rnd.Gaus(0, jet_pt_resolution)
+            rand = self.getRandomGaus(jet_pt_resolution, index, "pt")
             for central_or_shift in [
                     enum_nominal, enum_shift_up, enum_shift_down
             ]:
@@ -192,7 +233,7 @@ class jetSmearer(Module):
         return (smear_vals[enum_nominal], smear_vals[enum_shift_up],
                 smear_vals[enum_shift_down])
 
-    def getSmearValsM(self, jetIn, genJetIn):
+    def getSmearValsM(self, jetIn, genJetIn, index=None, variation="mass"):
 
         # ---------------------------------------------------------------------
         # LC: Procedure outline in: https://twiki.cern.ch/twiki/bin/view/Sandbox/PUPPIJetMassScaleAndResolution
@@ -260,7 +301,7 @@ class jetSmearer(Module):
                 jet_m_resolution = self.puppisd_resolution_cen.Eval(jet.Pt())
             else:
                 jet_m_resolution = self.puppisd_resolution_for.Eval(jet.Pt())
-            rand = self.rnd.Gaus(0, jet_m_resolution)
+            rand = self.getRandomGaus(jet_m_resolution, index, variation)
             for central_or_shift in [
                     enum_nominal, enum_shift_up, enum_shift_down
             ]:
@@ -29,7 +29,8 @@ class jetmetUncertaintiesProducer(Module):
                  applySmearing=True,
                  applyHEMfix=False,
                  splitJER=False,
-                 saveMETUncs=['T1', 'T1Smear']
+                 saveMETUncs=['T1', 'T1Smear'],
+                 counterRNG=False
      ):
 
         # globalTagProd only needs to be defined if METFixEE2017 is to be
@@ -80,7 +81,8 @@ class jetmetUncertaintiesProducer(Module):
                 self.jerUncertaintyInputFileName = "Autumn18_V7_MC_SF_" + jetType + ".txt"
 
         self.jetSmearer = jetSmearer(globalTag, jetType, self.jerInputFileName,
-                                     self.jerUncertaintyInputFileName)
+                                     self.jerUncertaintyInputFileName,
+                                     counterRNG=counterRNG)
 
         if "AK4" in jetType:
             self.jetBranchName = "Jet"
@@ -547,7 +549,7 @@ class jetmetUncertaintiesProducer(Module):
                 # Get the smearing factors for MET correction
                 (jet_pt_jerNomVal, jet_pt_jerUpVal,
                  jet_pt_jerDownVal) = self.jetSmearer.getSmearValsPt(
-                     jet, genJet, rho)
+                     jet, genJet, rho, iJet)
             else:
                 # if you want to do something with JER in data, please add it here.
                 (jet_pt_jerNomVal, jet_pt_jerUpVal, jet_pt_jerDownVal) = (1, 1,
@@ -1,4 +1,5 @@
 import os, ROOT
+import numpy as np
 from math import hypot, pi
 
 # ========= UTILITIES =======================
@@ -105,3 +106,115 @@ def extractTH1(file,histname,setdir=True):
     if close:
       file.Close()
   return hist
+
+
+# ========= ARRAY LOOKUPS =======================
+
+
+def findAxisBins(axis, x):
+  """Same as TAxis::FindBin for an array of values (0: underflow, nbins+1: overflow)."""
+  n, xmin, xmax = axis.GetNbins(), axis.GetXmin(), axis.GetXmax()
+  x = np.asarray(x,dtype=np.float64)
+  if axis.GetXbins().GetSize():
+    edges = np.array([axis.GetBinLowEdge(i) for i in range(1,n+2)])
+    bins  = np.searchsorted(edges,x,side='right')
+  else:
+    bins  = 1 + np.floor(n*(x-xmin)/(xmax-xmin)).astype(np.int64)
+  return np.where(x<xmin,0,np.where(x<xmax,bins,n+1))
+
+
+class HistArrays:
+  """Bin contents and errors of a TH1 or TH2 as arrays, to look up many values at once."""
+
+  def __init__(self, hist):
+    self.hist    = hist
+    self.is2D    = hist.InheritsFrom('TH2')
+    self.nx      = hist.GetNbinsX()
+    self.ny      = hist.GetNbinsY()
+    self.content = np.array([hist.GetBinContent(i) for i in range(hist.GetNcells())])
+    self.error   = np.array([hist.GetBinError(i) for i in range(hist.GetNcells())])
+
+  def findBin(self, x, y=None):
+    """Global bin numbers, same as TH1::FindBin."""
+    bins = findAxisBins(self.hist.GetXaxis(),x)
+    if self.is2D:
+      bins = bins + (self.nx+2)*findAxisBins(self.hist.GetYaxis(),y)
+    return bins
+
+  def getBinContent(self, x, y=None):
+    return self.content[self.findBin(x,y)]
+
+  def getBinError(self, x, y=None):
+    return self.error[self.findBin(x,y)]
+
+
+_evalTF1Declared = False
+
+def evalTF1(func, x):
+  """Evaluate a TF1 for an array of values, in a single C++ loop."""
+  global _evalTF1Declared
+  if not _evalTF1Declared:
+    ROOT.gInterpreter.Declare("""
+    #include <TF1.h>
+    void nanoAODTools_evalTF1(const TF1 &f, const double *x, double *out, size_t n) {
+      for (size_t i = 0; i < n; ++i) out[i] = f.Eval(x[i]);
+    }""")
+    _evalTF1Declared = True
+  x   = np.ascontiguousarray(x,dtype=np.float64)
+  out = np.empty_like(x)
+  if len(x):
+    ROOT.nanoAODTools_evalTF1(func,x,out,len(x))
+  return out
+
+
+# ========= RANDOM NUMBERS =======================
+
+
+_philoxM = (0xD2511F53, 0xCD9E8D57)
+_philoxW = (0x9E3779B9, 0xBB67AE85)
+_mask32  = np.uint64(0xFFFFFFFF)
+
+def philox4x32(counter, key, rounds=10):
+  """Philox4x32 counter-based generator (Salmon et al., SC'11) for arrays of counters.
+     counter is a list of 4 arrays and key a list of 2 arrays of 32-bit words, the
+     result is 4 arrays of random 32-bit words depending only on (counter, key)."""
+  c0, c1, c2, c3 = [np.asarray(c).astype(np.uint64) & _mask32 for c in counter]
+  k0, k1 = [np.asarray(k).astype(np.uint64) & _mask32 for k in key]
+  for i in range(rounds):
+    p0 = np.uint64(_philoxM[0])*c0
+    p1 = np.uint64(_philoxM[1])*c2
+    c0, c1, c2, c3 = (p1 >> np.uint64(32)) ^ c1 ^ k0, p1 & _mask32, (p0 >> np.uint64(32)) ^ c3 ^ k1, p0 & _mask32
+    k0 = (k0 + np.uint64(_philoxW[0])) & _mask32
+    k1 = (k1 + np.uint64(_philoxW[1])) & _mask32
+  return c0, c1, c2, c3
+
+# the stream word of the key is shared by the modules drawing random numbers:
+# the high 16 bits are the domain of the module, the low 16 bits its own streams,
+# so that two modules never draw the same numbers for the same object index
+RNG_DOMAIN_JETSMEARER = 0
+RNG_DOMAIN_MUONSCALERES = 1
+
+def rngStream(domain, stream=0):
+  """Stream word for stream of a module domain (RNG_DOMAIN_*)."""
+  if not 0 <= stream < 1<<16:
+    raise ValueError("Random number stream %r out of range [0, 65536)" % stream)
+  return (domain << 16) | stream
+
+def eventCounter(run, lumi, event, index, stream=0):
+  """Philox words for (run, lumi, event, index): the same random numbers for an
+     object whatever the order, batching or process in which the events are processed."""
+  event = np.asarray(event).astype(np.uint64)
+  return philox4x32([event & _mask32, event >> np.uint64(32), lumi, index], [run, stream])
+
+def counterUniform(run, lumi, event, index, stream=0):
+  """Uniform random numbers in the open interval (0,1), see eventCounter."""
+  words = eventCounter(run,lumi,event,index,stream)
+  return (words[0].astype(np.float64) + 0.5)/4294967296.
+
+def counterGaus(run, lumi, event, index, stream=0, sigma=1.):
+  """Gaussian random numbers of mean 0 and width sigma (Box-Muller), see eventCounter."""
+  words = eventCounter(run,lumi,event,index,stream)
+  u1 = (words[0].astype(np.float64) + 0.5)/4294967296.
+  u2 = (words[1].astype(np.float64) + 0.5)/4294967296.
+  # sigma times the unit numbers, so that those can be drawn once and scaled
+  return sigma*(np.sqrt(-2.*np.log(u1))*np.cos(2.*np.pi*u2))
@@ -2,15 +2,28 @@
 import ROOT
 import numpy
 import sys
+from PhysicsTools.NanoAODTools.postprocessing.framework.friends import CHECKSUM_KEY, EventChecksum
 
-if len(sys.argv) < 3:
-    print("Syntax: haddnano.py out.root input1.root input2.root ...")
-ofname = sys.argv[1]
+# --const-branch=NAME=VALUE or --const-branch=NAME[lenVar]=VALUE1,VALUE2,... adds a Float_t
+# branch with the same value(s) for all the events of the merged Events tree (e.g. xsecWeight)
+constBranches = []
+argv = []
+for arg in sys.argv:
+    if arg.startswith('--const-branch='):
+        spec, values = arg[len('--const-branch='):].split('=')
+        lenVar = spec[spec.index('[') + 1:-1] if '[' in spec else None
+        constBranches.append((spec.split('[')[0], lenVar, [float(v) for v in values.split(',')]))
+    else:
+        argv.append(arg)
+
+if len(argv) < 3:
+    print("Syntax: haddnano.py [--const-branch=NAME[[lenVar]]=VALUE[,VALUE...]] out.root input1.root input2.root ...")
+ofname = argv[1]
 
-if '.root' in sys.argv[2]:
-    files = sys.argv[2:]
-elif '.txt' in sys.argv[2]:
-    with open(sys.argv[2], 'r') as text_file:
+if '.root' in argv[2]:
+    files = argv[2:]
+elif '.txt' in argv[2]:
+    with open(argv[2], 'r') as text_file:
         files = list(text_file.read().splitlines())
 
 
@@ -34,6 +47,29 @@ def zeroFill(tree, brName, brObj, allowNonBool=False):
         b.ResetAddress()
 
 
+def constFill(tree, brName, values, lenVar=None):
+    buff = numpy.array(values, dtype='f4')
+    if lenVar is not None:
+        if not tree.GetBranch(lenVar):
+            print("No branch %s, not adding %s" % (lenVar, brName))
+            return
+        b = tree.Branch(brName, buff, "%s[%s]/F" % (brName, lenVar))
+        bLenVar = tree.GetBranch(lenVar)
+        buffLenVar = numpy.zeros(1, dtype='u4')
+        bLenVar.SetAddress(buffLenVar)
+    else:
+        b = tree.Branch(brName, buff, brName + "/F")
+    # be sure we do not trigger flushing
+    b.SetBasketSize(tree.GetEntries() * 2)
+    for x in range(0, tree.GetEntries()):
+        if lenVar is not None:
+            bLenVar.GetEntry(x)
+        b.Fill()
+    b.ResetAddress()
+    if lenVar is not None:
+        bLenVar.ResetAddress()
+
+
 fileHandles = []
 goFast = True
 for fn in files:
@@ -53,6 +89,18 @@ of.cd()
 for e in fileHandles[0].GetListOfKeys():
     name = e.GetName()
     print("Merging " + str(name))
+    if name == CHECKSUM_KEY:
+        # friend tree checksums are combined in the same order as the trees
+        checksum = EventChecksum()
+        for fh in fileHandles:
+            if not fh.GetListOfKeys().Contains(name):
+                print(fh.GetName() + " has no " + name + ", the merged friend can not be verified")
+                checksum = None
+                break
+            checksum.extend(EventChecksum.fromString(str(fh.Get(name).GetString())))
+        if checksum is not None:
+            checksum.write(of)
+        continue
     obj = e.ReadObj()
     cl = ROOT.TClass.GetClass(e.GetClassName())
     inputs = ROOT.TList()
@@ -61,10 +109,10 @@ for e in fileHandles[0].GetListOfKeys():
         obj = obj.CloneTree(-1, "fast" if goFast else "")
         branchNames = set([x.GetName() for x in obj.GetListOfBranches()])
     for fh in fileHandles[1:]:
-        if not fh.GetListOfKeys().Contains(name) and str(obj.GetName()).startswith('Events'): continue
+        if not fh.GetListOfKeys().Contains(name) and str(obj.GetName()).startswith(('Events', 'Friends')): continue
         otherObj = fh.GetListOfKeys().FindObject(name).ReadObj()
         inputs.Add(otherObj)
-        if isTree and obj.GetName() == 'Events':
+        if isTree and obj.GetName() in ('Events', 'Friends'):
             otherObj.SetAutoFlush(0)
             otherBranches = set([x.GetName()
                                  for x in otherObj.GetListOfBranches()])
@@ -108,6 +156,10 @@ for e in fileHandles[0].GetListOfKeys():
             inputs.Clear()
 
     if isTree:
+        if name == 'Events':
+            for brName, lenVar, values in constBranches:
+                print("Adding branch %s = %s" % (brName, values))
+                constFill(obj, brName, values, lenVar)
         obj.Write()
     elif obj.IsA().InheritsFrom(ROOT.TH1.Class()):
         obj.Merge(inputs)
@@ -25,10 +25,18 @@ if __name__ == "__main__":
                       help="Produce friend trees in output (current default is to produce full trees)")
     parser.add_option("--full", dest="friend", action="store_false", default=False,
                       help="Produce full trees in output (this is the current default)")
+    parser.add_option("--friend-index", dest="friendIndex", action="store_true", default=False,
+                      help="Match the friends given as 'file,friendfile' by (run, luminosityBlock, event) instead of entry number, skipping unmatched events")
     parser.add_option("--noout", dest="noOut", action="store_true",
                       default=False, help="Do not produce output, just run modules")
     parser.add_option("-P", "--prefetch", dest="prefetch", action="store_true", default=False,
                       help="Prefetch input files locally instead of accessing them via xrootd")
+    parser.add_option("--cache-size", dest="cacheSize", type="int", default=50,
+                      help="Size in MB of the TTreeCache holding the active input branches (0 to disable)")
+    parser.add_option("--async-prefetch", dest="asyncPrefetch", action="store_true", default=False,
+                      help="Prefetch the next TTreeCache block asynchronously while processing")
+    parser.add_option("--perf-stats", dest="perfStats", type="string", default=None,
+                      help="Profile the input I/O per branch and write the report to this ROOT file (and a .txt next to it)")
     parser.add_option("--long-term-cache", dest="longTermCache", action="store_true", default=False,
                       help="Keep prefetched files across runs instead of deleting them at the end")
     parser.add_option("-N", "--max-entries", dest="maxEntries", type="long", default=None,
@@ -88,6 +96,10 @@ if __name__ == "__main__":
                       justcount=options.justcount,
                       prefetch=options.prefetch,
                       longTermCache=options.longTermCache,
+                      friendIndex=options.friendIndex,
+                      cacheSize=options.cacheSize,
+                      asyncPrefetch=options.asyncPrefetch,
+                      perfStats=options.perfStats,
                       maxEntries=options.maxEntries,
                       firstEntry=options.firstEntry,
                       outputbranchsel=options.branchsel_out)
@@ -0,0 +1,223 @@
+import bisect
+import os
+import random
+import sys
+import types
+
+import pytest
+
+BASE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the condor scripts import each other as top level modules
+sys.path.insert(0, os.path.join(BASE, 'condor'))
+
+# python/ is the PhysicsTools.NanoAODTools package, as in CMSSW or with standalone/env_standalone.sh
+try:
+    import PhysicsTools.NanoAODTools  # noqa: F401
+except ImportError:
+    _top = types.ModuleType('PhysicsTools')
+    _top.__path__ = []
+    _pkg = types.ModuleType('PhysicsTools.NanoAODTools')
+    _pkg.__path__ = [os.path.join(BASE, 'python')]
+    _top.NanoAODTools = _pkg
+    sys.modules['PhysicsTools'] = _top
+    sys.modules['PhysicsTools.NanoAODTools'] = _pkg
+
+
+class FakeEvent(object):
+    '''Event with the given branch values as attributes'''
+
+    def __init__(self, **branches):
+        self.__dict__.update(branches)
+
+
+@pytest.fixture
+def make_event():
+    '''Factory of events, by default run 315252, lumi 42 and event 123456789012'''
+    def make(**branches):
+        branches.setdefault('run', 315252)
+        branches.setdefault('luminosityBlock', 42)
+        branches.setdefault('event', 123456789012)
+        return FakeEvent(**branches)
+    return make
+
+
+class FakeTree(object):
+    '''Input tree that only knows the names of its branches'''
+
+    def __init__(self, branches):
+        self.branches = list(branches)
+
+    def GetBranch(self, name):
+        return name in self.branches
+
+
+@pytest.fixture
+def make_tree():
+    return FakeTree
+
+class FakeOutput(object):
+    '''wrappedOutputTree keeping the last value filled in each branch'''
+
+    def __init__(self):
+        self.values = {}
+
+    def branch(self, name, rootBranchType, lenVar=None, **kwargs):
+        pass
+
+    def fillBranch(self, name, value):
+        self.values[name] = value
+
+
+@pytest.fixture
+def output():
+    return FakeOutput()
+
+
+class FakeAxis(object):
+    '''TAxis with uniform bins (edges None) or variable bins'''
+
+    def __init__(self, nbins, xmin, xmax, edges=None):
+        self.nbins, self.xmin, self.xmax, self.edges = nbins, xmin, xmax, edges
+
+    def GetNbins(self):
+        return self.nbins
+
+    def GetXmin(self):
+        return self.xmin
+
+    def GetXmax(self):
+        return self.xmax
+
+    def GetXbins(self):
+        return FakeBins(self.edges or [])
+
+    def GetBinLowEdge(self, i):
+        if self.edges:
+            return self.edges[i - 1]
+        return self.xmin + (i - 1) * (self.xmax - self.xmin) / float(self.nbins)
+
+    def FindBin(self, x):
+        if x < self.xmin:
+            return 0
+        if x >= self.xmax:
+            return self.nbins + 1
+        if self.edges:
+            return bisect.bisect_right(self.edges, x)
+        return 1 + int(self.nbins * (x - self.xmin) / (self.xmax - self.xmin))
+
+
+class FakeBins(object):
+    def __init__(self, edges):
+        self.edges = edges
+
+    def GetSize(self):
+        return len(self.edges)
+
+
+class FakeHist(object):
+    '''TH1 or TH2 (yaxis given) with the global bin numbering of ROOT'''
+
+    def __init__(self, xaxis, yaxis=None, content=None, error=None):
+        self.xaxis, self.yaxis = xaxis, yaxis
+        self.ncells = (xaxis.nbins + 2) * (yaxis.nbins + 2 if yaxis else 1)
+        self.content = content if content is not None else [0.] * self.ncells
+        self.error = error if error is not None else [0.] * self.ncells
+
+    def InheritsFrom(self, name):
+        return name == ('TH2' if self.yaxis else 'TH1')
+
+    def GetXaxis(self):
+        return self.xaxis
+
+    def GetYaxis(self):
+        return self.yaxis
+
+    def GetNbinsX(self):
+        return self.xaxis.nbins
+
+    def GetNbinsY(self):
+        return self.yaxis.nbins if self.yaxis else 1
+
+    def GetNcells(self):
+        return self.ncells
+
+    def GetBinContent(self, i):
+        return self.content[i]
+
+    def GetBinError(self, i):
+        return self.error[i]
+
+    def FindBin(self, x, y=None):
+        b = self.xaxis.FindBin(x)
+        if self.yaxis:
+            b += (self.xaxis.nbins + 2) * self.yaxis.FindBin(y)
+        return b
+
+
+def _axis(spec):
+    if isinstance(spec, tuple):
+        return FakeAxis(*spec)
+    return FakeAxis(len(spec) - 1, spec[0], spec[-1], list(spec))
+
+
+@pytest.fixture
+def make_hist():
+    '''Factory of stand-ins for TH1/TH2 with random contents and errors.
+
+       An axis is given as (nbins, xmin, xmax), or as the list of its bin edges.
+    '''
+    def make(xaxis, yaxis=None, content=(0., 1.), error=(0., 0.1), seed=0):
+        rng = random.Random(seed)
+        hist = FakeHist(_axis(xaxis), _axis(yaxis) if yaxis is not None else None)
+        hist.content = [rng.uniform(*content) for _ in range(hist.ncells)]
+        hist.error = [rng.uniform(*error) for _ in range(hist.ncells)]
+        return hist
+    return make
+
+
+@pytest.fixture
+def make_catalog():
+    '''Factory of FileCatalogs (not saved) with the given {filename: info}'''
+    from filecatalog import FileCatalog
+
+    def make(files):
+        catalog = FileCatalog(None)
+        for name, info in files.items():
+            catalog.update(name, info)
+        return catalog
+    return make
+
+
+@pytest.fixture
+def write_file(tmp_path):
+    '''Write the given lines to a file of tmp_path, return its path'''
+    def write(name, *lines):
+        path = os.path.join(str(tmp_path), name)
+        with open(path, 'w') as f:
+            f.write(''.join(lines))
+        return path
+    return write
+
+
+@pytest.fixture
+def make_pieces(tmp_path):
+    '''Factory of n job outputs of 10 bytes in tmp_path, returns their paths'''
+    def make(n, prefix='piece'):
+        pieces = []
+        for i in range(n):
+            path = str(tmp_path / ('%s_%d.root' % (prefix, i)))
+            with open(path, 'w') as f:
+                f.write('x' * 10)
+            pieces.append(path)
+        return pieces
+    return make
+
+
+@pytest.fixture
+def make_sums():
+    '''Factory of the sums of weights of a file or sample, as read by mergeplan'''
+    def make(sumw, count=0., scale=(), pdf=(), nevents=None, lhe=()):
+        return {'genEventSumw': sumw, 'genEventCount': count, 'LHEScaleSumw': list(scale),
+                'LHEPdfSumw': list(pdf), 'nEvents': nevents, 'sumLHE': list(lhe)}
+    return make
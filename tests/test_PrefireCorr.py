@@ -0,0 +1,101 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.modules.common.PrefireCorr import PrefCorr
+from PhysicsTools.NanoAODTools.postprocessing.tools import HistArrays
+
+
+ETA_EDGES = [-3., -2.5, -2.25, 0., 2.25, 2.5, 3.]
+
+
+def _prefCorr(make_hist):
+    module = PrefCorr.__new__(PrefCorr)
+    module.jet_map, module.photon_map = [make_hist(ETA_EDGES, (8, 20., 500.), (0., 0.3), (0., 0.05), seed=seed)
+                                         for seed in (1, 2)]
+    module.jet_map_arrays, module.photon_map_arrays = HistArrays(module.jet_map), HistArrays(module.photon_map)
+    module.UseEMpT = False
+    module.branchnames = ["PrefireWeight", "PrefireWeight_Up", "PrefireWeight_Down"]
+    module.JetMinPt, module.JetMaxPt, module.JetMinEta, module.JetMaxEta = 20, 500, 2.0, 3.0
+    module.PhotonMinPt, module.PhotonMaxPt, module.PhotonMinEta, module.PhotonMaxEta = 20, 500, 2.0, 3.0
+    return module
+
+
+def _probability(Map, eta, pt, maxpt, variation):
+    b = Map.FindBin(eta, min(pt, maxpt - 0.01))
+    prob, stat = Map.GetBinContent(b), Map.GetBinError(b)
+    syst = 0.2 * prob
+    unc = math.sqrt(stat * stat + syst * syst)
+    return {0: prob, 1: min(prob + unc, 1.0), -1: max(prob - unc, 0.0)}[variation]
+
+
+def _reference(module, ev, variation):
+    '''The loops over the jets and photons/electrons of one event before the array version'''
+    def accepted(pt, eta):
+        return pt >= module.PhotonMinPt and module.PhotonMinEta <= abs(eta) <= module.PhotonMaxEta
+
+    def egValue(jid):
+        phopf, photonInJet = 1.0, []
+        for pid, (pt, eta, jetIdx, eleIdx) in enumerate(ev['photons']):
+            if jetIdx == jid and accepted(pt, eta):
+                phopf_temp = 1 - _probability(module.photon_map, eta, pt, module.PhotonMaxPt, variation)
+                elepf_temp = 1.0
+                if eleIdx > -1:
+                    ept, eeta = ev['electrons'][eleIdx][:2]
+                    if accepted(ept, eeta):
+                        elepf_temp = 1 - _probability(module.photon_map, eeta, ept, module.PhotonMaxPt, variation)
+                phopf *= min(phopf_temp, elepf_temp)
+                photonInJet.append(pid)
+        for pt, eta, jetIdx, phoIdx in ev['electrons']:
+            if jetIdx == jid and phoIdx not in photonInJet and accepted(pt, eta):
+                phopf *= 1 - _probability(module.photon_map, eta, pt, module.PhotonMaxPt, variation)
+        return phopf
+
+    prefw = 1.0
+    for jid, (pt, eta) in enumerate(ev['jets']):
+        jetpf = 1.0
+        if pt >= module.JetMinPt and module.JetMinEta <= abs(eta) <= module.JetMaxEta:
+            jetpf *= 1 - _probability(module.jet_map, eta, pt, module.JetMaxPt, variation)
+        prefw *= min(jetpf, egValue(jid))
+    return prefw * egValue(-1)
+
+
+def _events(rng, n):
+    events = []
+    for _ in range(n):
+        nj, npho, nele = rng.randint(0, 5), rng.randint(0, 3), rng.randint(0, 3)
+        events.append({
+            'jets': [(rng.uniform(10, 600), rng.uniform(-3.5, 3.5)) for _ in range(nj)],
+            'photons': [(rng.uniform(10, 600), rng.uniform(-3.5, 3.5), rng.randint(-1, nj - 1), rng.randint(-1, nele - 1))
+                        for _ in range(npho)],
+            'electrons': [(rng.uniform(10, 600), rng.uniform(-3.5, 3.5), rng.randint(-1, nj - 1), rng.randint(-1, npho - 1))
+                          for _ in range(nele)],
+        })
+    return events
+
+
+def _columns(events):
+    names = {'jets': ('Jet_pt', 'Jet_eta'),
+             'photons': ('Photon_pt', 'Photon_eta', 'Photon_jetIdx', 'Photon_electronIdx'),
+             'electrons': ('Electron_pt', 'Electron_eta', 'Electron_jetIdx', 'Electron_photonIdx')}
+    columns, offsets = {}, []
+    for coll in ('jets', 'photons', 'electrons'):
+        objects = [obj for ev in events for obj in ev[coll]]
+        for i, name in enumerate(names[coll]):
+            columns[name] = np.array([obj[i] for obj in objects], dtype=np.float64)
+        offsets.append(np.concatenate([[0], np.cumsum([len(ev[coll]) for ev in events])]).astype(np.int64))
+    return columns, offsets
+
+
+def test_weights_as_per_event_loops(make_hist):
+    rng = random.Random(8)
+    module = _prefCorr(make_hist)
+    events = _events(rng, 2000)
+    columns, offsets = _columns(events)
+    weights = module.GetPrefireWeights(columns, *offsets)
+    for bname, variation in zip(module.branchnames, (0, 1, -1)):
+        assert weights[bname].tolist() == [_reference(module, ev, variation) for ev in events]
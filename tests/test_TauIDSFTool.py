@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.helpers.TauIDSFTool import TauESTool, TauFESTool, TauIDSFTool
+from PhysicsTools.NanoAODTools.postprocessing.tools import HistArrays
+
+UNCS = [None, 'Up', 'Down', 'All']
+
+
+@pytest.fixture
+def taus():
+    rng = np.random.RandomState(9)
+    n = 500
+    return {'pt': rng.uniform(20, 300, n), 'eta': rng.uniform(-2.5, 2.5, n),
+            'dm': rng.choice([0, 1, 2, 5, 10, 11], n), 'genmatch': rng.choice([0, 1, 2, 3, 4, 5, 6], n)}
+
+
+def _compare(array, scalars, unc):
+    if unc == 'All':
+        assert np.array(array).T.tolist() == [list(s) for s in scalars]
+    else:
+        assert np.asarray(array).tolist() == scalars
+
+
+def _idTool(hist, **attrs):
+    tool = TauIDSFTool.__new__(TauIDSFTool)
+    tool.hist, tool.histArrays, tool.extraUnc = hist, HistArrays(hist), None
+    tool.__dict__.update(attrs)
+    return tool
+
+
+@pytest.mark.parametrize('unc', UNCS)
+@pytest.mark.parametrize('extraUnc', [None, 0.03])
+def test_sf_vs_dm(make_hist, taus, unc, extraUnc):
+    tool = _idTool(make_hist((12, -0.5, 11.5), content=(0.8, 1.1)), DMs=[0, 1, 10, 11], extraUnc=extraUnc)
+    array = tool.getSFvsDMArray(taus['pt'], taus['dm'], taus['genmatch'], unc=unc)
+    _compare(array, [tool.getSFvsDM(pt, dm, g, unc=unc) for pt, dm, g in zip(taus['pt'], taus['dm'], taus['genmatch'])], unc)
+
+
+@pytest.mark.parametrize('unc', UNCS)
+def test_sf_vs_eta(make_hist, taus, unc):
+    tool = _idTool(make_hist([0., 0.4, 0.8, 1.2, 1.7, 2.3], content=(0.8, 1.5)), genmatches=[1, 3])
+    array = tool.getSFvsEtaArray(taus['eta'], taus['genmatch'], unc=unc)
+    _compare(array, [tool.getSFvsEta(eta, g, unc=unc) for eta, g in zip(taus['eta'], taus['genmatch'])], unc)
+
+
+@pytest.mark.parametrize('unc', UNCS)
+def test_tes(make_hist, taus, unc):
+    tool = TauESTool.__new__(TauESTool)
+    tool.hist_lowpt = make_hist((12, -0.5, 11.5), content=(0.97, 1.03), error=(0., 0.01), seed=1)
+    tool.hist_highpt = make_hist((12, -0.5, 11.5), content=(0.97, 1.03), error=(0., 0.03), seed=2)
+    tool.arrays_lowpt, tool.arrays_highpt = HistArrays(tool.hist_lowpt), HistArrays(tool.hist_highpt)
+    tool.pt_low, tool.pt_high, tool.DMs = 34, 170, [0, 1, 10, 11]
+    array = tool.getTESArray(taus['pt'], taus['dm'], taus['genmatch'], unc=unc)
+    _compare(array, [tool.getTES(pt, dm, g, unc=unc) for pt, dm, g in zip(taus['pt'], taus['dm'], taus['genmatch'])], unc)
+
+
+@pytest.mark.parametrize('unc', UNCS)
+def test_fes(taus, unc):
+    tool = TauFESTool.__new__(TauFESTool)
+    tool.FESs = {'barrel': {0: (0.99, 1.0, 1.01), 1: (1.0, 1.02, 1.04)},
+                 'endcap': {0: (0.97, 1.0, 1.03), 1: (1.01, 1.05, 1.09)}}
+    tool.DMs, tool.genmatches = [0, 1], [1, 3]
+    tool.FESArray = np.array([[tool.FESs[region][dm] for dm in tool.DMs] for region in ['barrel', 'endcap']])
+    array = tool.getFESArray(taus['eta'], taus['dm'], taus['genmatch'], unc=unc)
+    _compare(array, [tool.getFES(eta, dm, g, unc=unc) for eta, dm, g in zip(taus['eta'], taus['dm'], taus['genmatch'])], unc)
@@ -0,0 +1,67 @@
+import math
+
+import numpy as np
+import pytest
+
+from PhysicsTools.NanoAODTools.postprocessing.modules.btv.btagCalibrationTables import BTagCalibrationTables, compileFormula
+
+CSV = '''CSVv2;OperatingPoint, measurementType, sysType, jetFlavor, etaMin, etaMax, ptMin, ptMax, discrMin, discrMax, formula
+1, comb, central, 0, 0, 2.4, 20, 100, 0, 1, "0.9+0.001*x"
+1, comb, central, 0, 0, 2.4, 100, 1000, 0, 1, "1.0"
+1, comb, up, 0, 0, 2.4, 20, 100, 0, 1, "1.0+0.001*x"
+1, comb, up, 0, 0, 2.4, 100, 1000, 0, 1, "1.1"
+1, incl, central, 2, -2.4, 0, 20, 1000, 0, 1, "log(x)"
+1, incl, central, 2, 0, 2.4, 20, 1000, 0, 1, "2*sqrt(x)"
+0, comb, central, 0, 0, 2.4, 20, 1000, 0, 1, "0.5"
+3, iterativefit, central, 0, 0, 2.4, 20, 1000, 0, 0.5, "x+1"
+3, iterativefit, central, 0, 0, 2.4, 20, 1000, 0.5, 1.01, "x+2"
+'''
+
+
+@pytest.fixture
+def csvFile(tmp_path):
+    path = str(tmp_path / 'sf.csv')
+    with open(path, 'w') as f:
+        f.write(CSV)
+    return path
+
+
+def test_eval_bins(csvFile):
+    tables = BTagCalibrationTables(csvFile, 'M', {0: 'comb', 2: 'incl'}, ['up'])
+    sf = tables.evalAutoBounds('central', 0, [-1., 1., 2.], [50., 150., 50.])
+    assert sf == pytest.approx([0.95, 1.0, 0.95])
+    # bins with a negative lower eta edge: eta is not folded
+    assert tables.evalAutoBounds('central', 2, [-1., 1.], [100., 100.]) == pytest.approx([math.log(100.), 20.])
+    # outside of all the bins
+    assert tables.evalAutoBounds('central', 0, [2.6], [50.]).tolist() == [0.]
+
+
+def test_eval_auto_bounds(csvFile):
+    tables = BTagCalibrationTables(csvFile, 'M', {0: 'comb'}, ['up'])
+    # clamped to the pt range, the uncertainty is doubled outside of it
+    assert tables.evalAutoBounds('central', 0, [1., 1.], [10., 2000.]) == pytest.approx([0.92, 1.0], abs=1e-6)
+    assert tables.evalAutoBounds('up', 0, [1., 1., 1.], [50., 10., 2000.]) == pytest.approx([1.05, 1.12, 1.2], abs=1e-6)
+    with pytest.raises(ValueError):
+        tables.evalAutoBounds('down', 0, [1.], [50.])
+
+
+def test_operating_points(csvFile):
+    assert BTagCalibrationTables(csvFile, 'L', {0: 'comb'}, []).evalAutoBounds('central', 0, [1.], [50.]).tolist() == [0.5]
+    shape = BTagCalibrationTables(csvFile, 'shape_corr', {0: 'iterativefit'}, [])
+    assert shape.evalAutoBounds('central', 0, [1., 1.], [50., 50.], [0.3, 0.7]) == pytest.approx([1.3, 2.7])
+
+
+def test_hadron_flavour_convention(tmp_path):
+    path = str(tmp_path / 'sf.csv')
+    with open(path, 'w') as f:
+        f.write(CSV.replace('comb, central, 0,', 'comb, central, 5,'))
+    tables = BTagCalibrationTables(path, 1, {0: 'comb'}, [])
+    assert tables.evalAutoBounds('central', 0, [1.], [150.]).tolist() == [1.0]
+
+
+def test_compile_formula():
+    x = np.array([1., 4.])
+    assert compileFormula('TMath::Sqrt(x)*max(x,2.)')(x).tolist() == [2., 8.]
+    assert compileFormula('x^2')(x).tolist() == [1., 16.]
+    # constant formulas give one value per jet
+    assert compileFormula('1.5')(x).tolist() == [1.5, 1.5]
@@ -0,0 +1,119 @@
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import Chunk  # noqa: E402
+from PhysicsTools.NanoAODTools.postprocessing.modules.common.collectionMerger import collectionMerger  # noqa: E402
+
+BRANCHES = {
+    'Electron': {'pt': 'Float_t', 'eta': 'Float_t', 'charge': 'Int_t', 'lostHits': 'UChar_t', 'seedGain': 'Char_t'},
+    'Muon': {'pt': 'Float_t', 'eta': 'Float_t', 'charge': 'Int_t', 'nStations': 'Int_t', 'seedGain': 'Char_t'},
+}
+# numpy types of the columns read by ChunkReader
+DTYPES = {'Float_t': np.float64, 'Int_t': np.int32, 'UChar_t': np.uint8, 'Char_t': np.int8}
+
+
+def _merger(output, **kwargs):
+    '''collectionMerger of electrons and muons, set up as beginFile would'''
+    merger = collectionMerger(input=['Electron', 'Muon'], output='Lepton', **kwargs)
+    merger.brlist_sep = [sorted(BRANCHES[coll]) for coll in merger.input]
+    merger.brlist_all = sorted(set(BRANCHES['Electron']) | set(BRANCHES['Muon']))
+    merger.is_there = np.array([[br in BRANCHES[coll] for coll in merger.input] for br in merger.brlist_all])
+    for coll in merger.input:
+        merger.branchType.update(BRANCHES[coll])
+    merger.out = output
+    merger.chunks = None
+    return merger
+
+
+def _events(make_event, n=300, seed=1):
+    rng = random.Random(seed)
+    events = []
+    for _ in range(n):
+        branches = {}
+        for coll, types in BRANCHES.items():
+            size = rng.randint(0, 4)
+            branches['n' + coll] = size
+            for br, typ in types.items():
+                # few distinct pt values, to have ties in the sort
+                # chars are read as str, also the negative Char_t (255 once converted with ord)
+                values = [rng.choice([10., 25., 30., 45.]) if br == 'pt' else
+                          rng.uniform(-2.5, 2.5) if typ == 'Float_t' else
+                          chr(rng.choice([0, 1, 2, 255])) if typ in ('UChar_t', 'Char_t') else
+                          rng.randint(-1, 3) for _ in range(size)]
+                branches['%s_%s' % (coll, br)] = values
+        events.append(make_event(**branches))
+    return events
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'reverse': False},
+    {'maxObjects': 2},
+    {'sortkey': lambda x: x.eta, 'reverse': False, 'maxObjects': 3},
+    {'selector': {'Electron': lambda x: x.pt > 20, 'Muon': lambda x: x.pt > 40}, 'maxObjects': 2},
+    {'selector': {'Muon': lambda x: abs(x.eta) < 1.5}, 'reverse': False},
+    {'sortkey': lambda x: x.seedGain, 'selector': {'Electron': lambda x: x.lostHits < 2}},
+    {'sortkey': lambda x: x.seedGain, 'reverse': False, 'selector': {'Muon': lambda x: x.seedGain > 1}},
+])
+def test_array_merge_as_per_object(make_event, output, kwargs):
+    arrays, objects = _merger(output, **kwargs), _merger(output, **kwargs)
+    objects.useArrays = False
+    for event in _events(make_event):
+        arrays.analyze(event)
+        merged = dict(output.values)
+        objects.analyze(event)
+        assert merged == output.values
+    assert arrays.useArrays
+
+
+class _Chunks(object):
+    '''ChunkReader returning one chunk with all the events'''
+
+    def __init__(self, events, collections):
+        self.events = events
+        self.chunk = Chunk(0, len(events))
+        for coll in collections:
+            counts = [getattr(ev, 'n' + coll) for ev in events]
+            self.chunk.offsets['n' + coll] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            for br, typ in BRANCHES[coll].items():
+                values = [v for ev in events for v in getattr(ev, '%s_%s' % (coll, br))]
+                if typ in ('UChar_t', 'Char_t'):
+                    values = np.array([ord(v) for v in values], dtype=np.uint8)
+                self.chunk.columns['%s_%s' % (coll, br)] = np.asarray(values).astype(DTYPES[typ])
+
+    def get(self, event):
+        return self.chunk, self.events.index(event)
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'selector': {'Electron': lambda x: x.pt > 20}, 'maxObjects': 3},
+    {'sortkey': lambda x: x.seedGain, 'reverse': False, 'selector': {'Electron': lambda x: x.lostHits > 0}},
+])
+def test_chunk_merge_as_per_object(make_event, output, kwargs):
+    events = _events(make_event, 50, seed=2)
+    merger, reference = _merger(output, **kwargs), _merger(output, **kwargs)
+    merger.chunks = _Chunks(events, merger.input)
+    reference.useArrays = False
+    for event in events:
+        merger.analyze(event)
+        merged = dict(output.values)
+        reference.analyze(event)
+        assert merged == output.values
+    assert merger.chunks.chunk.results
+
+
+def test_fallback_to_objects(make_event, output):
+    # 'and' can't be evaluated on arrays
+    selector = {'Electron': lambda x: x.pt > 20 and abs(x.eta) < 2}
+    merger, reference = _merger(output, selector=selector), _merger(output, selector=selector)
+    reference.useArrays = False
+    for event in _events(make_event, 20, seed=3):
+        merger.analyze(event)
+        merged = dict(output.values)
+        reference.analyze(event)
+        assert merged == output.values
+    assert not merger.useArrays
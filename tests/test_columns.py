@@ -0,0 +1,173 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import Chunk, maskedOffsets, segmentProd, segmentSum
+
+
+def _chunk():
+    chunk = Chunk(100, 3)
+    chunk.columns['nJet'] = np.array([2, 0, 3])
+    chunk.columns['Jet_pt'] = np.array([50., 40., 70., 60., 30.])
+    chunk.columns['MET_pt'] = np.array([10., 20., 30.])
+    chunk.offsets['nJet'] = np.array([0, 2, 2, 5])
+    chunk.lenVars['Jet_pt'] = 'nJet'
+    return chunk
+
+
+def test_chunk_slices():
+    chunk = _chunk()
+    assert chunk.slice('Jet_pt', 0).tolist() == [50., 40.]
+    assert chunk.slice('Jet_pt', 1).tolist() == []
+    assert chunk.slice('Jet_pt', 2).tolist() == [70., 60., 30.]
+    assert chunk.slice('MET_pt', 2) == 30.
+    assert chunk.counts('nJet').tolist() == [2, 0, 3]
+    assert chunk.eventIndex('nJet').tolist() == [0, 0, 2, 2, 2]
+
+
+def test_chunk_contains():
+    chunk = _chunk()
+    assert 'Jet_pt' in chunk and 'Muon_pt' not in chunk
+    assert [chunk.contains(entry) for entry in (99, 100, 102, 103)] == [False, True, True, False]
+
+
+def test_segment_reductions():
+    offsets = np.array([0, 2, 2, 5])
+    values = np.array([2., 3., 4., 0.5, 10.])
+    assert segmentProd(values, offsets).tolist() == [6., 1., 20.]
+    assert segmentSum(values, offsets).tolist() == [5., 0., 14.5]
+    assert segmentProd(np.zeros(0), np.array([0, 0])).tolist() == [1.]
+
+
+def test_masked_offsets():
+    offsets = np.array([0, 2, 2, 5])
+    mask = np.array([True, False, True, True, False])
+    assert maskedOffsets(offsets, mask).tolist() == [0, 1, 1, 3]
+    assert maskedOffsets(offsets, np.zeros(5, dtype=bool)).tolist() == [0, 0, 0, 0]
+
+
+class _Leaf(object):
+    def __init__(self, name, typeName, leafCount=None):
+        self.name, self.typeName, self.leafCount = name, typeName, leafCount
+
+    def GetName(self):
+        return self.name
+
+    def GetTypeName(self):
+        return self.typeName
+
+    def GetLeafCount(self):
+        return self.leafCount
+
+
+class _Branch(object):
+    def __init__(self, tree, leaf):
+        self.tree, self.leaf = tree, leaf
+
+    def GetTree(self):
+        return self.tree
+
+    def GetLeaf(self, name):
+        return self.leaf
+
+
+class _Tree(object):
+    '''Input tree with its columns, one value (or list of values) per entry'''
+
+    def __init__(self, columns, types, friend=()):
+        self.columns = columns
+        self.types = types
+        self.friend = friend
+        self._extrabranches = {}
+        self._entrylist = None
+        self.entry = -1
+        self.reads = []
+
+    def GetEntries(self):
+        return len(self.columns['event'])
+
+    def GetBranch(self, name):
+        typeName = self.types[name]
+        leafCount = None
+        if '[' in typeName:
+            typeName, lenVar = typeName.rstrip(']').split('[')
+            leafCount = _Leaf(lenVar, self.types[lenVar])
+        return _Branch(object() if name in self.friend else self, _Leaf(name, typeName, leafCount))
+
+    def gotoEntry(self, entry, forceCall=False):
+        self.entry = entry
+
+
+class _RDataFrame(object):
+    def __init__(self, tree, first=0, last=None):
+        self.tree, self.first, self.last = tree, first, last
+
+    def Range(self, first, last):
+        return _RDataFrame(self.tree, first, last)
+
+    def AsNumpy(self, names):
+        self.tree.reads.append((self.first, self.last))
+        ret = {}
+        for name in names:
+            values = self.tree.columns[name][self.first:self.last]
+            if '[' in self.tree.types[name]:
+                ret[name] = np.empty(len(values), dtype=object)
+                ret[name][:] = [np.array(v, dtype=np.float32) for v in values]
+            else:
+                ret[name] = np.array(values, dtype=np.float32 if self.tree.types[name] == 'Float_t' else None)
+        return ret
+
+
+TYPES = {'nJet': 'Int_t', 'Jet_pt': 'Float_t[nJet]', 'MET_pt': 'Float_t', 'event': 'ULong64_t'}
+
+
+@pytest.fixture
+def chunkTree(monkeypatch):
+    from PhysicsTools.NanoAODTools.postprocessing.framework import columns
+    monkeypatch.setattr(columns.ROOT, 'RDataFrame', _RDataFrame, raising=False)
+    monkeypatch.setattr(columns.ROOT, 'addressof', id, raising=False)
+    monkeypatch.setattr(columns, '_remakeAllReaders', lambda tree: tree.reads.append('remake'))
+    return _Tree({'nJet': [2, 0, 3, 1, 1],
+                  'Jet_pt': [[50.5, 40.25], [], [70., 60., 30.], [25.], [20.]],
+                  'MET_pt': [10., 20., 30., 40., 50.],
+                  'event': [1, 2, (1 << 60) + 1, (1 << 62) + 3, 5]}, TYPES)
+
+
+def test_chunk_reader(chunkTree):
+    from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
+    reader = ChunkReader(chunkTree, ['Jet_pt', 'MET_pt', 'event'], chunkSize=3)
+    chunk = reader.read(2)
+    assert (chunk.first, chunk.n) == (2, 3)
+    assert chunk['event'].dtype == np.uint64 and chunk['event'].tolist() == [(1 << 60) + 1, (1 << 62) + 3, 5]
+    assert chunk['Jet_pt'].dtype == np.float64 and chunk['Jet_pt'].tolist() == [70., 60., 30., 25., 20.]
+    assert chunk.offsets['nJet'].tolist() == [0, 3, 4, 5]
+    assert chunk.slice('Jet_pt', 1).tolist() == [25.]
+    assert chunk['MET_pt'].tolist() == [30., 40., 50.]
+    assert reader.read(1).slice('Jet_pt', 0).tolist() == []
+
+
+def test_chunk_reader_get(chunkTree):
+    from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
+    reader = ChunkReader(chunkTree, ['Jet_pt', 'MET_pt'], chunkSize=3)
+    event = type('Event', (object,), {'_tree': chunkTree})()
+    found = []
+    for entry in range(5):
+        chunkTree.gotoEntry(entry)
+        chunk, i = reader.get(event)
+        found.append(chunk.slice('MET_pt', i))
+    assert found == chunkTree.columns['MET_pt']
+    # one read per chunk, after which the event loop readers are made again
+    assert chunkTree.reads == [(0, 3), 'remake', (3, 5), 'remake']
+    chunkTree._extrabranches['MET_pt'] = 1.
+    assert reader.get(event) == (None, -1)
+
+
+def test_chunk_reader_friend(chunkTree):
+    from PhysicsTools.NanoAODTools.postprocessing.framework.columns import ChunkReader
+    chunkTree.friend = ('MET_pt',)
+    reader = ChunkReader(chunkTree, ['Jet_pt', 'MET_pt'])
+    assert reader.friendBranches == ['MET_pt']
+    chunkTree.gotoEntry(0)
+    assert reader.get(type('Event', (object,), {'_tree': chunkTree})()) == (None, -1)
+    assert chunkTree.reads == []
@@ -0,0 +1,106 @@
+import math
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.framework.columns import Chunk  # noqa: E402
+from PhysicsTools.NanoAODTools.postprocessing.modules.common.countHistogramsModule import (  # noqa: E402
+    countHistogramsProducer, indexSums)
+
+
+@pytest.fixture
+def producer(make_tree):
+    def make(branches=('Generator_weight', 'LHEScaleWeight', 'PSWeight'), weights=('LHEScaleWeight', 'PSWeight'),
+             **kwargs):
+        module = countHistogramsProducer(weights=weights, **kwargs)
+        module.beginFile(None, None, make_tree(branches), None)
+        return module
+    return make
+
+
+@pytest.fixture
+def events(make_event):
+    rng = np.random.RandomState(5)
+    ret = []
+    for _ in range(200):
+        scale = rng.uniform(0.5, 1.5, size=rng.choice([8, 9])).tolist()
+        ps = rng.uniform(0.5, 1.5, size=4).tolist()
+        ret.append(make_event(Generator_weight=rng.choice([-1., 2.]), LHEScaleWeight=scale, nLHEScaleWeight=len(scale),
+                              PSWeight=ps, nPSWeight=len(ps)))
+    return ret
+
+
+def _expected(events, name):
+    signs = [-1. if event.Generator_weight < 0 else 1. for event in events]
+    n = max(len(getattr(event, name)) for event in events)
+    return [sum(s * getattr(e, name)[i] for s, e in zip(signs, events) if i < len(getattr(e, name))) for i in range(n)]
+
+
+def _totals(module, name='LHEScaleWeight'):
+    return (module.sums[name] + module.compensations[name]).tolist()
+
+
+def test_weights_in_input(producer):
+    assert producer().weightNames == ['LHEScaleWeight', 'PSWeight']
+    assert producer(branches=['LHEScaleWeight']).weightNames == ['LHEScaleWeight']
+    # only LHEScaleWeight by default
+    assert countHistogramsProducer().weights == ('LHEScaleWeight',)
+
+
+def test_index_sums():
+    rng = np.random.RandomState(4)
+    counts = rng.randint(0, 12, size=300)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    values = rng.normal(size=offsets[-1])
+    expected = [sum(values[offsets[k] + i] for k in range(len(counts)) if i < counts[k]) for i in range(counts.max())]
+    assert indexSums(values, offsets) == pytest.approx(expected, rel=1e-12)
+    assert len(indexSums(np.zeros(0), np.zeros(1, dtype=int))) == 0
+
+
+def test_accumulate_longer_vectors(producer):
+    module = producer()
+    module.accumulate('LHEScaleWeight', np.array([1., 2.]))
+    module.accumulate('LHEScaleWeight', np.array([1., 2., 3., 4.]))
+    module.accumulate('LHEScaleWeight', np.array([1.]))
+    assert _totals(module) == [3., 4., 3., 4.]
+
+
+def test_accumulate_compensated(producer):
+    module = producer()
+    module.accumulate('LHEScaleWeight', np.array([1e8, 1.]))
+    for _ in range(200000):
+        module.accumulate('LHEScaleWeight', np.array([0.1, 0.1]))
+    assert _totals(module) == [math.fsum([1e8] + [0.1] * 200000), math.fsum([1.] + [0.1] * 200000)]
+
+
+@pytest.mark.parametrize('bufferSize', [1, 64, 1000])
+def test_analyze(producer, events, bufferSize):
+    module = producer(bufferSize=bufferSize)
+    for event in events:
+        module.analyze(event)
+    module.flushRows()
+    assert module.nevents == sum(-1 if event.Generator_weight < 0 else 1 for event in events)
+    assert module.nevents_pos == len(events)
+    for name in ('LHEScaleWeight', 'PSWeight'):
+        assert _totals(module, name) == pytest.approx(_expected(events, name), rel=1e-13)
+
+
+def test_chunk_as_per_event(producer, events):
+    # the events of a chunk that went through analyze, every other one here
+    chunk = Chunk(0, len(events))
+    chunk.columns['Generator_weight'] = np.array([event.Generator_weight for event in events])
+    for name in ('LHEScaleWeight', 'PSWeight'):
+        chunk.columns[name] = np.concatenate([getattr(event, name) for event in events])
+        chunk.offsets['n' + name] = np.concatenate([[0], np.cumsum([len(getattr(event, name)) for event in events])])
+        chunk.lenVars[name] = 'n' + name
+    module, reference = producer(), producer()
+    module._chunk, module._selected = chunk, np.arange(len(events)) % 2 == 0
+    module.flush()
+    for event in events[::2]:
+        reference.analyze(event)
+    reference.flushRows()
+    assert (module.nevents, module.nevents_pos) == (reference.nevents, reference.nevents_pos)
+    for name in ('LHEScaleWeight', 'PSWeight'):
+        assert _totals(module, name) == pytest.approx(_totals(reference, name), rel=1e-13)
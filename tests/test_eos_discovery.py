@@ -0,0 +1,63 @@
+import os
+import time
+
+from eos_discovery import ListingCache, LocalBackend, rec_search
+
+
+def _touch(root, path):
+    full = os.path.join(root, path.lstrip('/'))
+    if not os.path.exists(os.path.dirname(full)):
+        os.makedirs(os.path.dirname(full))
+    open(full, 'w').close()
+
+
+def _tree(root):
+    for path in ['/store/A/0000/f_2.root', '/store/A/0000/f_10.root', '/store/A/0001/f_1.root',
+                 '/store/A/0000/log/f_1.root', '/store/A/0000/notes.txt', '/store/B/x.root']:
+        _touch(root, path)
+
+
+def test_rec_search(tmp_path):
+    root = str(tmp_path)
+    _tree(root)
+    found = rec_search(LocalBackend(root), ['/store/A', '/store/B'], nthreads=4)
+    # depth-first, directories and files sorted by name, log directories skipped
+    assert found == {'/store/A': ['/store/A/0000/f_10.root', '/store/A/0000/f_2.root', '/store/A/0001/f_1.root'],
+                     '/store/B': ['/store/B/x.root']}
+
+
+def test_rec_search_suffix(tmp_path):
+    root = str(tmp_path)
+    _tree(root)
+    found = rec_search(LocalBackend(root), ['/store/A'], suffix='.txt', skip=())
+    assert found == {'/store/A': ['/store/A/0000/notes.txt']}
+
+
+class _CountingBackend(LocalBackend):
+    def __init__(self, root):
+        LocalBackend.__init__(self, root)
+        self.listed = []
+
+    def listdir(self, path):
+        self.listed.append(path)
+        return LocalBackend.listdir(self, path)
+
+
+def test_listing_cache(tmp_path):
+    root = str(tmp_path / 'eos')
+    _tree(root)
+    cachefile = str(tmp_path / 'listings.json')
+    first = rec_search(LocalBackend(root), ['/store/A'], cache=ListingCache(cachefile))
+
+    backend = _CountingBackend(root)
+    assert rec_search(backend, ['/store/A'], cache=ListingCache(cachefile)) == first
+    assert backend.listed == []
+
+    # only the directory that changed is listed again
+    _touch(root, '/store/A/0001/f_0.root')
+    os.utime(os.path.join(root, 'store/A/0001'), (time.time() + 10, time.time() + 10))
+    backend = _CountingBackend(root)
+    found = rec_search(backend, ['/store/A'], cache=ListingCache(cachefile))
+    assert backend.listed == ['/store/A/0001']
+    assert found == {'/store/A': ['/store/A/0000/f_10.root', '/store/A/0000/f_2.root',
+                                  '/store/A/0001/f_0.root', '/store/A/0001/f_1.root']}
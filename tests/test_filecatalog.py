@@ -0,0 +1,106 @@
+import zlib
+
+import pytest
+
+from filecatalog import FileCatalog, adler32, lfn, plan_jobs, plan_merge, split_ranges
+
+
+def test_lfn():
+    assert lfn('root://cmsxrootd.fnal.gov//store/mc/x.root') == '/store/mc/x.root'
+    assert lfn('/eos/uscms/store/mc/x.root') == '/store/mc/x.root'
+    assert lfn('/tmp/x.root') == '/tmp/x.root'
+
+
+def test_split_ranges_cover():
+    for n, nsplit in ((10, 3), (100, 7), (5, 5), (1000, 1)):
+        ranges = split_ranges(n, nsplit)
+        assert len(ranges) == nsplit
+        assert ranges[0][0] == 0
+        assert sum(count for _, count in ranges) == n
+        for (first, count), (next_first, _) in zip(ranges[:-1], ranges[1:]):
+            assert first + count == next_first
+
+
+def test_split_ranges_clusters():
+    clusters = list(range(0, 1000, 100))
+    assert split_ranges(1000, 3, clusters) == [(0, 300), (300, 400), (700, 300)]
+    # never more ranges than clusters, and always starting on a cluster
+    ranges = split_ranges(1000, 30, clusters)
+    assert [first for first, _ in ranges] == clusters
+    assert sum(count for _, count in ranges) == 1000
+
+
+def test_plan_jobs(make_catalog):
+    catalog = make_catalog({
+        '/store/a.root': {'entries': 40},
+        '/store/b.root': {'entries': 50},
+        '/store/c.root': {'entries': 250, 'clusters': [0, 100, 200]},
+        '/store/d.root': {'entries': 30},
+        '/store/e.root': {'entries': 20},
+    })
+    files = ['root://xrootd/store/%s.root' % f for f in 'abcdef']
+    jobs = plan_jobs(files, catalog, 100)
+    assert jobs == [
+        {'inputfiles': files[:2]},
+        {'inputfiles': [files[2]], 'firstEntry': 0, 'maxEntries': 100},
+        {'inputfiles': [files[2]], 'firstEntry': 100, 'maxEntries': 100},
+        {'inputfiles': [files[2]], 'firstEntry': 200, 'maxEntries': 50},
+        {'inputfiles': files[3:5]},
+        # not in the catalogue: a job of its own
+        {'inputfiles': [files[5]]},
+    ]
+
+
+def test_plan_jobs_keeps_file_order(make_catalog):
+    catalog = make_catalog(dict(('/store/%d.root' % i, {'entries': 10 * (i % 4) + 5}) for i in range(50)))
+    files = ['/store/%d.root' % i for i in range(50)]
+    jobs = plan_jobs(files, catalog, 60)
+    assert [f for job in jobs for f in job['inputfiles']] == files
+    assert all(sum(catalog.entries(f) for f in job['inputfiles']) <= 60 for job in jobs)
+
+
+def test_catalog_lfn_and_save(tmp_path):
+    path = str(tmp_path / 'catalog.json')
+    catalog = FileCatalog(path)
+    catalog.update('root://cmsxrootd.fnal.gov//store/x.root', {'entries': 3})
+    catalog.update('/store/x.root', {'bytes': 10})
+    catalog.save()
+    catalog = FileCatalog(path)
+    assert '/eos/uscms/store/x.root' in catalog
+    assert catalog.get('root://other//store/x.root') == {'entries': 3, 'bytes': 10}
+    assert catalog.entries('/store/y.root') is None
+    # a rescanned file loses what was derived from its previous version
+    catalog.update('/store/x.root', {'sums': {}})
+    catalog.update('/store/x.root', {'entries': 4}, replace=True)
+    assert catalog.get('/store/x.root') == {'entries': 4}
+
+
+def test_plan_merge(make_catalog):
+    catalog = make_catalog({
+        '/a.root': {'bytes': 60, 'compression': 404},
+        '/b.root': {'bytes': 30, 'compression': 404},
+        '/c.root': {'bytes': 30, 'compression': 404},
+        '/d.root': {'bytes': 500, 'compression': 404},
+        '/e.root': {'bytes': 10, 'compression': 208},
+    })
+    groups = plan_merge(['/a.root', '/b.root', '/c.root', '/d.root', '/e.root'], catalog, 100)
+    assert groups == [['/a.root', '/b.root'], ['/c.root'], ['/d.root'], ['/e.root']]
+
+
+def test_is_current(tmp_path, make_catalog):
+    path = tmp_path / 'f.root'
+    path.write_bytes(b'x' * 10)
+    stat = path.stat()
+    catalog = make_catalog({str(path): {'entries': 5, 'clusters': [0], 'bytes': 10, 'mtime': int(stat.st_mtime)}})
+    assert catalog.is_current(str(path))
+    assert not catalog.is_current(str(path), checksum=True)
+    path.write_bytes(b'x' * 20)
+    assert not catalog.is_current(str(path))
+    assert not catalog.is_current('/store/missing.root')
+
+
+@pytest.mark.parametrize('data', [b'', b'abc', b'x' * 100000])
+def test_adler32_local(tmp_path, data):
+    path = tmp_path / 'f.root'
+    path.write_bytes(data)
+    assert adler32(str(path)) == '%08x' % (zlib.adler32(data) & 0xffffffff)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+pytest.importorskip('correctionlib')
+
+from PhysicsTools.NanoAODTools.postprocessing.modules.btv.flavTagSFProducer import FlavTagSFProducer, systematics, tag_dict
+
+TAGS = sorted(tag_dict.values())
+
+
+class _Correction(object):
+    '''Stands for the particleNetAK4_shape correction, with scalars or arrays of jets'''
+
+    def evaluate(self, syst, flavour, tag, abseta, pt):
+        shift = {'central': 0.}.get(syst, 0.01 * (1 + len(syst) % 7) * (1 if syst.startswith('up') else -1))
+        return 1. + shift + 0.001 * TAGS.index(tag) + 0.0001 * flavour + 0.01 * abseta - 0.0002 * pt
+
+
+class _Jet(object):
+    def __init__(self, hadronFlavour, tag, eta, pt):
+        self.hadronFlavour, self.tag, self.eta, self.pt = hadronFlavour, tag, eta, pt
+
+
+def _producer():
+    producer = FlavTagSFProducer.__new__(FlavTagSFProducer)
+    producer.corr = _Correction()
+    return producer
+
+
+def test_weights_per_jet():
+    rng = np.random.RandomState(6)
+    counts = rng.randint(0, 6, size=50)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    n = offsets[-1]
+    jets = [_Jet(int(f), int(t), e, p) for f, t, e, p in zip(
+        rng.choice([0, 4, 5], n), rng.choice(list(tag_dict), n), rng.uniform(-2.5, 2.5, n), rng.uniform(20, 500, n))]
+    producer = _producer()
+    wgts = producer.get_weights(*[[getattr(j, var) for j in jets] for var in ('hadronFlavour', 'tag', 'eta', 'pt')],
+                                offsets=offsets)
+    assert len(wgts) == 1 + 2 * len(systematics)
+    for name, syst in [('flavTagWeight', 'central'), ('flavTagWeight_%s_UP' % systematics[0], 'up_' + systematics[0]),
+                       ('flavTagWeight_%s_DOWN' % systematics[-1], 'down_' + systematics[-1])]:
+        expected = [np.prod([producer.get_sf(j, syst) for j in jets[offsets[k]:offsets[k + 1]]]) for k in range(50)]
+        assert wgts[name] == pytest.approx(expected, rel=1e-12)
+    assert wgts['flavTagWeight'][counts == 0].tolist() == [1.] * int((counts == 0).sum())
+
+
+def test_selected_jets():
+    assert _producer().selectedJets(np.array([-1, 0, 40, 45, 54])).tolist() == [False, True, True, False, True]
@@ -0,0 +1,112 @@
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.framework import friends
+from PhysicsTools.NanoAODTools.postprocessing.framework.friends import EventChecksum
+
+EVENTS = [(1, 10, 100 + i) for i in range(7)] + [(2, 3, 5), (2, 3, 4), (1 << 40, 1, 1 << 62)]
+
+
+def _checksum(events):
+    checksum = EventChecksum()
+    for key in events:
+        checksum.add(*key)
+    return checksum
+
+
+def test_checksum_pinned():
+    # stored next to the friend trees: must not change across versions
+    assert str(_checksum(EVENTS)) == '10:66d08456cfc0e0f'
+    assert str(_checksum(EVENTS[:3])) == '3:5b39db048636b2f'
+    assert str(EventChecksum()) == '0:0'
+
+
+def test_checksum_order_sensitive():
+    assert _checksum(EVENTS) != _checksum(EVENTS[::-1])
+    assert _checksum(EVENTS[:-1]) != _checksum(EVENTS)
+
+
+@pytest.mark.parametrize('split', [0, 1, 4, 9, 10])
+def test_checksum_extend(split):
+    # the checksum of merged trees from the checksums of the pieces
+    merged = _checksum(EVENTS[:split])
+    merged.extend(_checksum(EVENTS[split:]))
+    assert merged == _checksum(EVENTS)
+
+
+def test_checksum_string():
+    checksum = _checksum(EVENTS)
+    assert EventChecksum.fromString(str(checksum)) == checksum
+
+
+
+def _keys(events):
+    return tuple(np.array([e[i] for e in events], dtype=np.uint64) for i in range(3))
+
+
+def test_match_entries(monkeypatch):
+    # the "trees" are their (run, luminosityBlock, event) columns
+    monkeypatch.setattr(friends, 'eventIndex', lambda tree: tree)
+    rng = random.Random(1)
+    events = list(set((rng.randint(1, 3), rng.randint(1, 5), rng.randint(1, 1 << 40)) for _ in range(500)))
+    friendEvents = rng.sample(events, 300) + [(4, 1, 1)]
+    rng.shuffle(events)
+    matched = friends.matchEntries(_keys(events), _keys(friendEvents))
+    position = dict((key, i) for i, key in enumerate(friendEvents))
+    assert matched.tolist() == [position.get(key, -1) for key in events]
+    assert (matched >= 0).sum() == 300
+    assert matched.dtype == np.int64
+
+
+def test_match_entries_empty(monkeypatch):
+    monkeypatch.setattr(friends, 'eventIndex', lambda tree: tree)
+    assert friends.matchEntries(_keys([(1, 1, 1), (1, 1, 2)]), _keys([])).tolist() == [-1, -1]
+    assert friends.matchEntries(_keys([]), _keys([(1, 1, 1)])).tolist() == []
+
+
+class _Tree(object):
+    '''Tree given by its (run, luminosityBlock, event) keys, recording the index and friends'''
+
+    def __init__(self, events, branches=friends.EVENT_KEYS):
+        self.keys = _keys(events)
+        self.branches = branches
+        self.index = None
+        self.friends = []
+
+    def GetName(self):
+        return 'Friends'
+
+    def GetBranch(self, name):
+        return name in self.branches
+
+    def BuildIndex(self, major, minor):
+        self.index = (major, minor)
+
+    def AddFriend(self, tree):
+        self.friends.append(tree)
+
+
+def test_attach_indexed_friend(monkeypatch):
+    monkeypatch.setattr(friends, 'eventIndex', lambda tree: tree.keys)
+    tree, friendTree = _Tree([(1, 2, 3), (1, 3, 3), (2, 2, 3)]), _Tree([(2, 2, 3), (1, 2, 3)])
+    assert friends.attachIndexedFriend(tree, friendTree).tolist() == [1, -1, 0]
+    assert friendTree.index == ('run*4294967296+luminosityBlock', 'event')
+    assert tree.friends == [friendTree]
+
+
+def test_attach_indexed_friend_without_keys(monkeypatch):
+    monkeypatch.setattr(friends, 'eventIndex', lambda tree: tree.keys)
+    tree, friendTree = _Tree([(1, 2, 3)]), _Tree([(1, 2, 3)], branches=())
+    with pytest.raises(RuntimeError, match='no run/luminosityBlock/event branches'):
+        friends.attachIndexedFriend(tree, friendTree)
+    assert friendTree.index is None and tree.friends == []
+
+
+def test_attach_indexed_friend_large_run(monkeypatch):
+    monkeypatch.setattr(friends, 'eventIndex', lambda tree: tree.keys)
+    with pytest.raises(RuntimeError, match='major key'):
+        friends.attachIndexedFriend(_Tree([(1 << 31, 2, 3)]), _Tree([(1, 2, 3)]))
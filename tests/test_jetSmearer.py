@@ -0,0 +1,104 @@
+import math
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.tools import counterGaus, counterUniform
+from PhysicsTools.NanoAODTools.postprocessing.modules.jme.jetSmearer import jetSmearer
+
+# (run, lumi, event, index, stream) -> (counterGaus, counterUniform)
+PINNED = [
+    ((1, 1, 1, 0, 1), 0.07200820794505541, 0.7585126078920439),
+    ((315252, 42, 123456789012, 3, 1), 0.016591064728277302, 0.3928183565149084),
+    ((1, 2, 3, 4, 2), 0.6434633631033649, 0.7039786464301869),
+]
+
+
+@pytest.mark.parametrize('key,gaus,uniform', PINNED)
+def test_counter_numbers(key, gaus, uniform):
+    assert float(counterGaus(*key)) == gaus
+    assert float(counterUniform(*key)) == uniform
+
+
+def test_counter_numbers_arrays():
+    # the numbers of an object do not depend on the other objects drawn with it
+    run, lumi, event, stream = 315252, 42, 123456789012, 1
+    numbers = counterGaus(run, lumi, event, np.arange(20), stream, sigma=0.5)
+    for i in range(20):
+        assert numbers[i] == counterGaus(run, lumi, event, i, stream, sigma=0.5)
+
+
+class _Jet:
+    def __init__(self, pt, eta, energy):
+        self.pt, self.eta, self.energy = pt, eta, energy
+
+    def Perp(self):
+        return self.pt
+
+    def Pt(self):
+        return self.pt
+
+    def Eta(self):
+        return self.eta
+
+    def E(self):
+        return self.energy
+
+
+class _Params:
+    def setJetEta(self, eta):
+        pass
+
+    def setJetPt(self, pt):
+        pass
+
+    def setRho(self, rho):
+        pass
+
+
+class _ScaleFactors:
+    # nominal, down, up
+    values = {0: 1.1, 1: 1.0, 2: 1.2}
+
+    def getScaleFactor(self, params, shift):
+        return self.values[shift]
+
+
+class _Resolution:
+    def getResolution(self, params):
+        return 0.1
+
+
+def _smearer():
+    # jetSmearer without the JER text files: fixed scale factors and resolution
+    smearer = jetSmearer.__new__(jetSmearer)
+    smearer.counterRNG = True
+    smearer.params_sf_and_uncertainty = _Params()
+    smearer.params_resolution = _Params()
+    smearer.jerSF_and_Uncertainty = _ScaleFactors()
+    smearer.jer = _Resolution()
+    return smearer
+
+
+def test_smeared_pt(make_event):
+    smearer = _smearer()
+    smearer.setSeed(make_event())
+    jet = _Jet(50., 1.0, 60.)
+    nom, up, down = smearer.getSmearedJetPt(jet, None, 20., index=3)
+    rand = 0.1 * 0.016591064728277302
+    assert nom == pytest.approx(50. * (1. + rand * math.sqrt(1.1 ** 2 - 1.)), rel=1e-15)
+    assert up == pytest.approx(50. * (1. + rand * math.sqrt(1.2 ** 2 - 1.)), rel=1e-15)
+    assert down == 50.
+    assert (nom, up, down) == (50.03801490498863, 50.05502633657619, 50.)
+
+
+def test_smeared_pt_order_independent(make_event):
+    smearer = _smearer()
+    smearer.setSeed(make_event())
+    jets = [_Jet(30. + 10 * i, 0.5, 40. + 10 * i) for i in range(5)]
+    forward = [smearer.getSmearedJetPt(jet, None, 20., index=i) for i, jet in enumerate(jets)]
+    smearer.setSeed(make_event())
+    backward = [smearer.getSmearedJetPt(jets[i], None, 20., index=i) for i in reversed(range(5))]
+    assert forward == backward[::-1]
@@ -0,0 +1,103 @@
+from PhysicsTools.NanoAODTools.postprocessing.framework.jobreport import JobReport, branchHash, runsAndLumis
+
+
+class _LumiTree(object):
+    def __init__(self, lumis):
+        self.lumis = lumis
+
+    def GetEntries(self):
+        return len(self.lumis)
+
+    def GetEntry(self, i):
+        self.run, self.luminosityBlock = self.lumis[i]
+
+
+class _File(object):
+    def __init__(self, objects):
+        self.objects = objects
+
+    def Get(self, name):
+        return self.objects.get(name)
+
+
+class _JSONFilter(object):
+    def filterRunLumi(self, run, lumi):
+        return lumi % 2 == 1
+
+
+class _Leaf(object):
+    def __init__(self, typ):
+        self.typ = typ
+
+    def GetTypeName(self):
+        return self.typ
+
+
+class _Branch(object):
+    def __init__(self, name, typ):
+        self.name, self.typ = name, typ
+
+    def GetName(self):
+        return self.name
+
+    def GetLeaf(self, name):
+        return _Leaf(self.typ) if self.typ else None
+
+
+class _Tree(object):
+    def __init__(self, branches):
+        self.branches = [_Branch(name, typ) for name, typ in branches]
+
+    def GetListOfBranches(self):
+        return self.branches
+
+
+def _metrics(report, summary):
+    element = report.performancereport.find("PerformanceSummary[@Metric='%s']" % summary)
+    return dict((m.get('Name'), m.get('Value')) for m in element.findall('Metric'))
+
+
+def test_storage_statistics():
+    report = JobReport()
+    report.addStorageStatistics(readBytes=3 * 1024 ** 2, readCalls=10, writeBytes=1024 ** 2, readTime=0.5, unzipTime=0.25)
+    report.addStorageStatistics(readBytes=1024 ** 2, readCalls=5, readTime=0.5)
+    metrics = _metrics(report, 'StorageStatistics')
+    assert metrics['ROOT-tfile-read-totalMegabytes'] == '4.000'
+    assert metrics['ROOT-tfile-write-totalMegabytes'] == '1.000'
+    assert metrics['ROOT-tfile-read-numOperations'] == '15'
+    assert metrics['ROOT-tfile-read-totalMsecs'] == '1000.0'
+    assert metrics['ROOT-tfile-unzip-totalMsecs'] == '250.0'
+
+
+def test_timing():
+    report = JobReport()
+    report.setTiming(10., 5000, {'jetmetUncertainties': 2.5})
+    # set again at the end of the job: replaced, not added
+    report.setTiming(20., 5000, {'jetmetUncertainties': 4.})
+    assert _metrics(report, 'Timing') == {'TotalJobTime': '20.000', 'EventThroughput': '250.000',
+                                          'Module-jetmetUncertainties-totalMsecs': '4000.0'}
+    report.setTiming(20., 0)
+    assert _metrics(report, 'Timing') == {'TotalJobTime': '20.000', 'EventThroughput': '0.000'}
+
+
+def test_runs_and_lumis():
+    tfile = _File({'LuminosityBlocks': _LumiTree([(2, 3), (1, 2), (2, 1), (1, 1), (2, 3)])})
+    assert runsAndLumis(tfile) == {'1': [1, 2], '2': [1, 3]}
+    assert runsAndLumis(tfile, _JSONFilter()) == {'1': [1], '2': [1, 3]}
+    assert runsAndLumis(_File({})) == {}
+
+
+def test_output_file():
+    report = JobReport()
+    report.addOutputFile('tree.root', 42, {'1': [1, 2]}, 'abc')
+    element = report.fjr.find('File')
+    assert element.find('BranchHash').text == 'abc'
+    assert element.find('TotalEvents').text == '42'
+    assert [lumi.get('ID') for lumi in element.find('Runs').find('Run').findall('LumiSection')] == ['1', '2']
+
+
+def test_branch_hash():
+    branches = [('run', 'UInt_t'), ('Jet_pt', 'Float_t'), ('nJet', 'UInt_t')]
+    assert branchHash(_Tree(branches)) == branchHash(_Tree(branches[::-1]))
+    assert branchHash(_Tree(branches)) != branchHash(_Tree(branches[:2] + [('nJet', 'Int_t')]))
+    assert branchHash(_Tree(branches)) != branchHash(_Tree(branches[:2]))
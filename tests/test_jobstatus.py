@@ -0,0 +1,106 @@
+import os
+import random
+
+import jobstatus
+from jobstatus import JobStatusTracker, new_entry, parse_log_line, scan_file
+
+LINES = [
+    '000 (123.000.000) 10/19 12:00:00 Job submitted from host: <127.0.0.1:9618>\n',
+    '001 (123.000.000) 10/19 12:01:00 Job executing on host: <127.0.0.2:9618>\n',
+    '006 (123.000.000) 10/19 12:02:00 Image size of job updated: 1000\n',
+    '\t(1) Normal termination (return value 0)\n',
+    '\t(1) Normal termination (return value 1)\n',
+    '009 (123.000.000) 10/19 12:03:00 Job was aborted.\n',
+    '\tJob removed by SYSTEM_PERIODIC_REMOVE due to wall time exceeded.\n',
+    '...\n',
+]
+
+
+def backward_status(lines):
+    '''Reference: the log read backwards up to the last submission or return value'''
+    errormsg = None
+    finished = False
+    for line in reversed(lines):
+        if 'Job removed' in line or 'aborted' in line:
+            errormsg = line
+        if 'Job submitted from host' in line:
+            break
+        if 'return value' in line:
+            if 'return value 0' in line:
+                finished = True
+            else:
+                errormsg = line
+            break
+    return finished, errormsg
+
+
+def test_parse_log_line():
+    rng = random.Random(1)
+    for _ in range(2000):
+        lines = [rng.choice(LINES) for _ in range(rng.randint(0, 12))]
+        entry = new_entry()
+        for line in lines:
+            parse_log_line(entry, line)
+        assert (entry['finished'], entry['errormsg']) == backward_status(lines)
+
+
+def test_scan_file_incremental(tmp_path):
+    rng = random.Random(2)
+    path = str(tmp_path / '0.log')
+    data = ''.join(rng.choice(LINES) for _ in range(200))
+    open(path, 'w').close()
+    entry, pos = None, 0
+    while pos < len(data):
+        # appends ending in the middle of a line
+        step = rng.randint(1, 150)
+        with open(path, 'a') as f:
+            f.write(data[pos:pos + step])
+        pos += step
+        entry = scan_file(path, entry)
+    assert entry == scan_file(path, None)
+    assert entry['offset'] == len(data)
+    assert (entry['finished'], entry['errormsg']) == backward_status(data.splitlines(True))
+
+
+def test_scan_file_rewritten(tmp_path):
+    path = str(tmp_path / '0.log')
+    with open(path, 'w') as f:
+        f.write(LINES[0] + LINES[1] + LINES[4])
+    entry = scan_file(path, None)
+    assert entry['errormsg'] == LINES[4]
+    # same size or larger, different content: parsed again from the start
+    with open(path, 'w') as f:
+        f.write(LINES[0] + LINES[1] + LINES[3] + LINES[2])
+    entry = scan_file(path, entry)
+    assert entry == scan_file(path, None)
+    assert entry['finished'] and entry['errormsg'] is None
+    # truncated
+    with open(path, 'w') as f:
+        f.write(LINES[0])
+    entry = scan_file(path, entry)
+    assert entry == scan_file(path, None)
+    assert not entry['finished']
+    assert scan_file(str(tmp_path / 'missing.log'), entry) is None
+
+
+def test_tracker_update(tmp_path, write_file):
+    jobdir = str(tmp_path)
+
+    write_file('0.log', LINES[0], LINES[3])
+    write_file('1.log', LINES[0], LINES[1])
+    write_file('2.log', LINES[0], LINES[5])
+    # jobs 3 and 4 run in one condor job, their status is in its output
+    write_file('3+4.log', LINES[0], LINES[3])
+    write_file('3+4.out', 'Job 3 terminated: return value 0\n', 'Job 4 terminated: return value 2\n')
+    tracker = JobStatusTracker(jobdir)
+    jobids = tracker.update(6, nthreads=2)
+    assert jobids == {'running': ['1'], 'failed': ['2', '4', '5'], 'completed': ['0', '3']}
+    assert jobstatus.summary(jobdir) == {'njobs': 6, 'jobids': jobids}
+
+    # job 1 finishes: only its log is read again, from where the last scan stopped
+    offset = tracker.files['1.log']['offset']
+    with open(os.path.join(jobdir, '1.log'), 'a') as f:
+        f.write(LINES[3])
+    tracker = JobStatusTracker(jobdir)
+    assert tracker.files['1.log']['offset'] == offset
+    assert tracker.update(6)['completed'] == ['0', '1', '3']
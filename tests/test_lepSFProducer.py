@@ -0,0 +1,52 @@
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.modules.common.lepSFProducer import (  # noqa: E402
+    LeptonEfficiencyTables, lepSFProducer)
+
+
+@pytest.fixture
+def tables(make_hist):
+    '''two maps: muons binned in (pt, |eta|), electrons in (eta, pt)'''
+    tables = LeptonEfficiencyTables.__new__(LeptonEfficiencyTables)
+    tables.maps = []
+    for seed, xaxis, yaxis in ((1, [20., 25., 30., 40., 60., 120.], (4, 0., 2.4)),
+                               (2, (10, -2.5, 2.5), [10., 20., 35., 50., 100., 200.])):
+        hist = make_hist(xaxis, yaxis, content=(0.8, 1.1), seed=seed)
+        nx = hist.GetNbinsX() + 2
+        cells = np.array(hist.content, dtype=np.float32).reshape(-1, nx).T
+        tables.maps.append((hist.GetXaxis(), hist.GetYaxis(), cells))
+    return tables
+
+
+def _scalarSF(tables, pdgId, pt, eta):
+    '''WeightCalculatorFromHistogram::getWeight for one lepton, bins clamped to the range'''
+    x, y = (pt, abs(eta)) if abs(pdgId) == 13 else (eta, pt)
+    sf = np.float32(1.)
+    for xaxis, yaxis, cells in tables.maps:
+        binx = min(max(xaxis.FindBin(x), 1), xaxis.GetNbins())
+        biny = min(max(yaxis.FindBin(y), 1), yaxis.GetNbins())
+        sf *= cells[binx, biny]
+    return sf
+
+
+def test_tables_match_per_lepton(tables):
+    rng = random.Random(3)
+    leptons = [(rng.choice((11, -11, 13, -13)), np.float32(rng.uniform(5., 300.)),
+                np.float32(rng.uniform(-3., 3.))) for _ in range(500)]
+    pdgId, pt, eta = (np.array(col) for col in zip(*leptons))
+    sfs = tables.getSFs(pdgId, pt, eta)
+    assert sfs.dtype == np.float32
+    assert sfs.tolist() == [_scalarSF(tables, *lep) for lep in leptons]
+
+
+def test_producer_uses_tables(tables):
+    producer = lepSFProducer.__new__(lepSFProducer)
+    producer.useCpp = False
+    assert producer.getSFs(tables, [], [], []).tolist() == []
+    sfs = producer.getSFs(tables, [13, -11], [45., 30.], [-1.1, 0.7])
+    assert sfs.tolist() == [_scalarSF(tables, 13, 45., -1.1), _scalarSF(tables, -11, 30., 0.7)]
@@ -0,0 +1,150 @@
+import os
+import random
+from fractions import Fraction
+
+import pytest
+
+import mergeplan
+from mergeplan import (MergeState, friend_groups, load_groups, node_key, plan_sample, reduce_sums, sample_sums, save_groups,
+                       weight_branches)
+
+
+def _sizes(make_catalog, pieces, nbytes=10):
+    return make_catalog(dict((f, {'bytes': nbytes}) for f in pieces))
+
+
+def test_plan_sample_single_part(tmp_path, make_pieces, make_catalog):
+    pieces = make_pieces(25)
+    parts_dir = str(tmp_path / 'parts')
+    nodes = plan_sample('TT', pieces, _sizes(make_catalog, pieces), parts_dir, 1000, fan_in=4, xsec=831.76)
+    final = nodes['TT/part0']
+    assert final['final'] and final['weights'] and final['xsec'] == 831.76
+    assert final['output'] == os.path.join(parts_dir, 'TT_tree.root')
+    assert nodes['TT/sums']['inputs'] == pieces
+    assert 'TT/sums' in final['deps']
+    # 25 pieces, 4 at a time: 7 merges, then 2, then the final one
+    assert len([n for n in nodes if n.startswith('TT/part0/l0_')]) == 7
+    assert len([n for n in nodes if n.startswith('TT/part0/l1_')]) == 2
+    assert len(final['inputs']) == 2
+    assert sorted(final['deps']) == ['TT/part0/l1_0', 'TT/part0/l1_1', 'TT/sums']
+    assert nodes['TT/part0/l1_1']['deps'] == ['TT/part0/l0_4', 'TT/part0/l0_5', 'TT/part0/l0_6']
+    # every piece is merged once
+    merged = [f for node in nodes.values() if node['type'] == 'merge' for f in node['inputs'] if f in pieces]
+    assert merged == pieces
+
+
+def test_plan_sample_parts(tmp_path, make_pieces, make_catalog):
+    pieces = make_pieces(6)
+    parts_dir = str(tmp_path / 'parts')
+    nodes = plan_sample('DY', pieces, _sizes(make_catalog, pieces), parts_dir, 20)
+    assert 'DY/sums' not in nodes
+    assert [nodes['DY/part%d' % i]['output'] for i in range(3)] == \
+        [os.path.join(parts_dir, 'DY_tree_%d.root' % i) for i in range(3)]
+    assert [nodes['DY/part%d' % i]['inputs'] for i in range(3)] == [pieces[0:2], pieces[2:4], pieces[4:6]]
+    assert all(not nodes['DY/part%d' % i]['weights'] for i in range(3))
+    # given groups are used as they are
+    nodes = plan_sample('DY', pieces, _sizes(make_catalog, pieces), parts_dir, 20, groups=[pieces[:1], pieces[1:]])
+    assert [nodes['DY/part%d' % i]['inputs'] for i in range(2)] == [pieces[:1], pieces[1:]]
+
+
+def test_friend_groups(tmp_path):
+    nominal = [['/parts/pieces/a.root', '/parts/pieces/b.root'], ['/parts/pieces/c.root']]
+    save_groups(str(tmp_path), 'TT', nominal)
+    assert load_groups(str(tmp_path)) == {'TT': [['a.root', 'b.root'], ['c.root']]}
+    friends = ['/parts/jes/c.root', '/parts/jes/a.root', '/parts/jes/b.root']
+    assert friend_groups(friends, load_groups(str(tmp_path))['TT']) == \
+        [['/parts/jes/a.root', '/parts/jes/b.root'], ['/parts/jes/c.root']]
+    assert friend_groups(friends[:2], nominal) is None
+    assert friend_groups(friends + ['/parts/jes/d.root'], nominal) is None
+
+
+def test_merge_state(tmp_path, make_pieces, make_catalog):
+    pieces = make_pieces(5)
+    parts_dir = str(tmp_path / 'parts')
+    os.makedirs(os.path.join(parts_dir, '.merge_tmp'))
+    catalog = _sizes(make_catalog, pieces)
+    nodes = plan_sample('TT', pieces, catalog, parts_dir, 1000, fan_in=2, xsec=1.)
+    state = MergeState(parts_dir)
+    for node_id in sorted(nodes):
+        if nodes[node_id]['type'] == 'merge':
+            with open(nodes[node_id]['output'], 'w') as f:
+                f.write('merged')
+        state.set_done(nodes, node_id, {'genEventSumw': 1.} if node_id == 'TT/sums' else None)
+    state = MergeState(parts_dir)
+    assert all(state.is_done(nodes, node_id) for node_id in nodes)
+    assert state.result('TT/sums') == {'genEventSumw': 1.}
+
+    # the final merge stays done once the intermediate merges are removed
+    for node in nodes.values():
+        if node['type'] == 'merge' and not node.get('final'):
+            os.remove(node['output'])
+    assert state.is_done(nodes, 'TT/part0')
+    assert not state.is_done(nodes, 'TT/part0/l0_0')
+
+    # other cross section: only the final merge is redone
+    reweighted = plan_sample('TT', pieces, catalog, parts_dir, 1000, fan_in=2, xsec=2.)
+    assert node_key(reweighted, 'TT/part0') != node_key(nodes, 'TT/part0')
+    assert not state.is_done(reweighted, 'TT/part0')
+    assert state.is_done(reweighted, 'TT/sums')
+
+    # rewritten piece: the merges above it are redone
+    st = os.stat(pieces[4])
+    with open(pieces[4], 'w') as f:
+        f.write('y' * 20)
+    os.utime(pieces[4], (st.st_atime, st.st_mtime + 10))
+    assert not state.is_done(nodes, 'TT/part0')
+    assert not state.is_done(nodes, 'TT/sums')
+
+    # added piece
+    more = pieces + make_pieces(1, 'extra')
+    assert not state.is_done(plan_sample('TT', more, _sizes(make_catalog, more), parts_dir, 1000, fan_in=2, xsec=1.),
+                             'TT/part0')
+
+
+def test_reduce_sums_exact(make_sums):
+    rng = random.Random(3)
+    files = [make_sums(rng.choice([1e16, -1e16, 1.]) * rng.random(), 1., [rng.random() * 1e8, rng.random()])
+             for _ in range(500)]
+    total = reduce_sums(files)
+    # correctly rounded, so the same whatever the order of the files
+    assert total['genEventSumw'] == float(sum(Fraction(sums['genEventSumw']) for sums in files))
+    assert total['LHEScaleSumw'][0] == float(sum(Fraction(sums['LHEScaleSumw'][0]) for sums in files))
+    shuffled = files[:]
+    rng.shuffle(shuffled)
+    assert reduce_sums(shuffled) == total
+    assert total['genEventCount'] == 500.
+    assert reduce_sums([make_sums(1e16), make_sums(1.), make_sums(-1e16)])['genEventSumw'] == 1.
+
+
+def test_reduce_sums(make_sums):
+    total = reduce_sums([make_sums(1., 2., scale=[], nevents=None),
+                         make_sums(1., 2., scale=[1., 2., 3.], nevents=4., lhe=[1., 1.]),
+                         make_sums(1., 2., scale=[1., 2., 3., 4.], nevents=None, lhe=[2., 2., 2.])])
+    assert total['genEventSumw'] == 3. and total['genEventCount'] == 6.
+    # as many values as in the first file having them
+    assert total['LHEScaleSumw'] == [2., 4., 6.]
+    assert total['sumLHE'] == [3., 3.]
+    assert total['LHEPdfSumw'] == []
+    assert total['nEvents'] == 4.
+    assert reduce_sums([make_sums(1.), make_sums(2.)])['nEvents'] is None
+
+
+def test_sample_sums_cached(monkeypatch, make_sums):
+    read = []
+    monkeypatch.setattr(mergeplan, 'file_sums', lambda fname: read.append(fname) or make_sums(2.))
+    sums = sample_sums(['a.root', 'b.root'], {'a.root': make_sums(1.)})
+    assert read == ['b.root']
+    assert sums == {'a.root': make_sums(1.), 'b.root': make_sums(2.)}
+
+
+def test_weight_branches(make_sums):
+    sums = make_sums(200., 100., scale=[100., 400.], pdf=[50.], nevents=10., lhe=[5., 2., 1.])
+    branches = weight_branches(sums, 3., lumi=2.)
+    assert branches == [('xsecWeight', None, [0.03]),
+                        # as many values as LHEScaleWeight
+                        ('LHEScaleWeightNormNew', 'nLHEScaleWeight', [2., 5.]),
+                        ('LHEScaleWeightNorm', 'nLHEScaleWeight', [2., 0.5]),
+                        ('LHEPdfWeightNorm', 'nLHEPdfWeight', [4.])]
+    assert [name for name, _, _ in weight_branches(make_sums(200.), 3.)] == ['xsecWeight']
+    with pytest.raises(ZeroDivisionError):
+        weight_branches(make_sums(0.), 3.)
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+
+os.environ.setdefault('CMSSW_BASE', '/cmssw')
+
+from PhysicsTools.NanoAODTools.postprocessing.modules.common import muonScaleResProducer as msr  # noqa: E402
+
+
+def _kernelMC(rc, n, charge, pt, eta, phi, nLayers, genPt, u, corr, err):
+    '''stand-in for nanoAODTools_roccorMC: spread if matched, smear otherwise'''
+    corr[:] = np.where(genPt >= 0, 1. + 0.01 * charge, 1. + 0.1 * (u - 0.5))
+    err[:] = np.where(genPt >= 0, 0.02, 0.03)
+
+
+def _kernelDT(rc, n, charge, pt, eta, phi, corr, err):
+    corr[:] = 1. + 0.01 * charge
+    err[:] = np.where(pt > 1., 0.5, 2.)
+
+
+@pytest.fixture
+def producer(monkeypatch):
+    monkeypatch.setattr(msr.ROOT, 'nanoAODTools_roccorMC', _kernelMC, raising=False)
+    monkeypatch.setattr(msr.ROOT, 'nanoAODTools_roccorDT', _kernelDT, raising=False)
+    producer = msr.muonScaleResProducer.__new__(msr.muonScaleResProducer)
+    producer._roccor = None
+    return producer
+
+
+def test_corrections_data(producer):
+    producer.is_mc = False
+    ret = producer.getCorrections([1, -1], [40., 0.3], [0.1, -2.], [1., 2.])
+    assert ret['Muon_corrected_pt'].tolist() == pytest.approx([40.4, 0.297])
+    assert ret['Muon_correctedUp_pt'].tolist() == pytest.approx([40.4 + 20., 0.297 + 0.6])
+    # the down variation is clipped at 0
+    assert ret['Muon_correctedDown_pt'].tolist() == pytest.approx([40.4 - 20., 0.])
+    assert all(len(v) == 0 for v in producer.getCorrections([], [], [], []).values())
+
+
+def test_corrections_mc(producer):
+    producer.is_mc = True
+    ret = producer.getCorrections([1, 1], [50., 50.], [0., 0.], [0., 0.], [10, 12], [48., -1.], [0.2, 0.7])
+    assert ret['Muon_corrected_pt'].tolist() == pytest.approx([50.5, 51.])
+    assert ret['Muon_correctedUp_pt'].tolist() == pytest.approx([51.5, 52.5])
+
+
+def test_matched_gen_pt(producer):
+    genPt = np.array([10., 20., 30., 40., 50.])
+    genOffsets = np.array([0, 2, 2, 5])
+    muonEvent = np.array([0, 0, 1, 2, 2, 2])
+    genPartIdx = np.array([1, 2, 0, -1, 2, 0], dtype=np.int16)
+    assert producer.matchedGenPt(genPartIdx, genPt, genOffsets, muonEvent).tolist() == [20., -1., -1., -1., 50., 30.]
@@ -0,0 +1,79 @@
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.framework.postprocessor import PostProcessor
+
+
+class _Branch(object):
+    def __init__(self, name):
+        self.name = name
+
+    def GetName(self):
+        return self.name
+
+
+class _Tree(object):
+    '''Records the TTreeCache calls'''
+
+    def __init__(self, active, inactive=()):
+        self.branches = [_Branch(name) for name in list(active) + list(inactive)]
+        self.active = set(active)
+        self.calls = []
+
+    def GetListOfBranches(self):
+        return self.branches
+
+    def GetBranchStatus(self, name):
+        return name in self.active
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name,) + args)
+
+
+def test_read_cache_active_branches():
+    tree = _Tree(['nJet', 'Jet_pt'], ['Muon_pt'])
+    PostProcessor('out', [], cacheSize=20, firstEntry=100).setupReadCache(None, tree, 500)
+    assert tree.calls[:2] == [('SetCacheSize', 20 * 1024 * 1024), ('SetCacheEntryRange', 100, 600)]
+    assert [call[1].GetName() for call in tree.calls if call[0] == 'AddBranchToCache'] == ['nJet', 'Jet_pt']
+    assert tree.calls[-1] == ('StopCacheLearningPhase',)
+
+
+def test_read_cache_disabled():
+    tree = _Tree(['nJet'])
+    PostProcessor('out', [], cacheSize=0).setupReadCache(None, tree, 500)
+    assert tree.calls == []
+
+
+class _EntryList(object):
+    def __init__(self, *args):
+        self.entries = []
+
+    def Clone(self, name):
+        clone = _EntryList()
+        clone.entries = list(self.entries)
+        return clone
+
+    def Enter(self, entry):
+        self.entries.append(entry)
+
+    def Remove(self, entry):
+        if entry in self.entries:
+            self.entries.remove(entry)
+
+
+@pytest.mark.parametrize('preselected', [None, [101, 102, 105, 108]])
+def test_matched_entry_list(monkeypatch, preselected):
+    import numpy as np
+    from PhysicsTools.NanoAODTools.postprocessing.framework import postprocessor
+    monkeypatch.setattr(postprocessor.ROOT, 'TEntryList', _EntryList, raising=False)
+    matched = np.array([3, -1] * 55)
+    elist = None
+    if preselected:
+        elist = _EntryList()
+        elist.entries = list(preselected)
+    result = PostProcessor('out', [], firstEntry=100).matchedEntryList(matched, elist, 10)
+    expected = [entry for entry in (preselected or range(100, 110)) if matched[entry] >= 0]
+    assert result.entries == expected
+    if elist:
+        assert elist.entries == preselected
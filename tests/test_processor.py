@@ -0,0 +1,84 @@
+import os
+import zlib
+from argparse import Namespace
+
+import pytest
+
+pytest.importorskip('ROOT')
+
+import processor  # noqa: E402
+
+
+class _Popen(object):
+    '''subprocess.Popen running haddnano.py as a concatenation, and failing the first xrdcp calls'''
+    calls = []
+    failures = 0
+    # (name, size) of the inputs of each hadd
+    merges = []
+
+    def __init__(self, cmd, shell=False):
+        _Popen.calls.append(cmd)
+        self.returncode = 0
+        if not shell and cmd[0] == 'haddnano.py':
+            _Popen.merges.append([(name, os.path.getsize(name)) for name in cmd[2:]])
+            with open(cmd[1], 'wb') as out:
+                for name in cmd[2:]:
+                    with open(name, 'rb') as f:
+                        out.write(f.read())
+        elif _Popen.failures:
+            _Popen.failures -= 1
+            self.returncode = 1
+
+    def communicate(self):
+        return None, None
+
+
+@pytest.fixture
+def popen(monkeypatch):
+    _Popen.calls, _Popen.failures, _Popen.merges = [], 0, []
+    monkeypatch.setattr(processor.subprocess, 'Popen', _Popen)
+    return _Popen
+
+
+def test_incremental_merger(tmp_path, popen):
+    outputname = str(tmp_path / 'out.root')
+    merger = processor.IncrementalMerger(outputname)
+    for i in range(40):
+        path = tmp_path / ('in%02d.root' % i)
+        path.write_bytes(b'%02d' % i)
+        merger.add(str(path))
+    merger.close()
+    assert open(outputname, 'rb').read() == b''.join(b'%02d' % i for i in range(40))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['out.root']
+    # the partial result is only rewritten with at least as many new bytes, except when closing
+    partial = outputname.replace('.root', '_partial.root')
+    for inputs in popen.merges[:-1]:
+        sizes = dict(inputs)
+        assert sum(sizes.values()) - sizes.get(partial, 0) >= sizes.get(partial, 0)
+
+
+def test_incremental_merger_nothing(tmp_path, popen):
+    merger = processor.IncrementalMerger(str(tmp_path / 'out.root'))
+    with pytest.raises(RuntimeError):
+        merger.close()
+
+
+def test_stage_out_retries(tmp_path, monkeypatch, popen):
+    waits = []
+    monkeypatch.setattr(processor.time, 'sleep', waits.append)
+    output = tmp_path / 'job' / 'out.root'
+    output.parent.mkdir()
+    output.write_bytes(b'data')
+    md = {'outputdir': '/eos/uscms/store/user/x', 'joboutputdir': '/eos/uscms/store/user/x/pieces',
+          'tmpoutdir': str(tmp_path)}
+    popen.failures = 2
+    processor.stage_out(md, Namespace(max_retry=5, sleep=15), str(output))
+    assert waits == [15, 30]
+    assert len(popen.calls) == 3
+    assert '--cksum adler32:%08x' % zlib.adler32(b'data') in popen.calls[0]
+    assert not output.exists()
+
+    output.write_bytes(b'data')
+    popen.failures = 3
+    with pytest.raises(RuntimeError):
+        processor.stage_out(md, Namespace(max_retry=3, sleep=1), str(output))
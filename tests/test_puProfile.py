@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.modules.common.puProfile import PUProfileCache, datasetProfileName, logicalFileName, profileKey
+
+
+class _Axis(object):
+    def __init__(self, edges):
+        self.edges = edges
+
+    def GetNbins(self):
+        return len(self.edges) - 1
+
+    def GetBinLowEdge(self, i):
+        return self.edges[i - 1]
+
+
+class _Hist(object):
+    def __init__(self, edges):
+        self.axis = _Axis(edges)
+
+    def GetXaxis(self):
+        return self.axis
+
+
+def test_logical_file_name(tmp_path, monkeypatch):
+    lfn = '/store/mc/RunIISummer20UL18NanoAODv9/TT/NANOAODSIM/1.root'
+    assert logicalFileName('root://cmsxrootd.fnal.gov/' + lfn) == lfn
+    assert logicalFileName('root://eoscms.cern.ch//eos/cms' + lfn) == lfn
+    assert logicalFileName('root://host//eos/user/a/b.root') == 'root://host//eos/user/a/b.root'
+    monkeypatch.chdir(str(tmp_path))
+    assert logicalFileName('b.root') == os.path.join(str(tmp_path), 'b.root')
+
+
+def test_profile_key():
+    lfn = '/store/mc/TT/1.root'
+    template = _Hist([0., 1., 2., 3.])
+    key = profileKey('root://cmsxrootd.fnal.gov/' + lfn, 'Pileup_nTrueInt', template)
+    # the same file read through another site
+    assert profileKey('root://xrootd-cms.infn.it/' + lfn, 'Pileup_nTrueInt', template) == key
+    assert profileKey(lfn, 'Pileup_nPU', template) != key
+    assert profileKey(lfn, 'Pileup_nTrueInt', _Hist([0., 1., 2., 4.])) != key
+    assert profileKey('/store/mc/TT/2.root', 'Pileup_nTrueInt', template) != key
+
+
+def test_cache_path(tmp_path):
+    cacheDir = str(tmp_path / 'pu')
+    cache = PUProfileCache(cacheDir)
+    assert os.path.isdir(cacheDir)
+    template = _Hist([0., 1., 2.])
+    assert cache.path('/store/a.root', 'Pileup_nTrueInt', template) == \
+        os.path.join(cacheDir, profileKey('/store/a.root', 'Pileup_nTrueInt', template) + '.root')
+
+
+def test_dataset_profile_name():
+    template = _Hist([0., 1., 2.])
+    name = datasetProfileName('TTToSemiLeptonic', 'Pileup_nTrueInt', template)
+    # the dataset name is not a file name: the same on the submission host and in the jobs
+    assert name == datasetProfileName('TTToSemiLeptonic', 'Pileup_nTrueInt', template)
+    assert name.startswith('autoPU_')
+    assert datasetProfileName('TTTo2L2Nu', 'Pileup_nTrueInt', template) != name
+    assert datasetProfileName('TTToSemiLeptonic', 'Pileup_nTrueInt', _Hist([0., 1., 3.])) != name
+
+
+def test_cache_scans_source(tmp_path, monkeypatch):
+    from PhysicsTools.NanoAODTools.postprocessing.modules.common import puProfile
+    scanned = []
+    monkeypatch.setattr(puProfile, 'scanProfile', lambda fileName, nvtxVar, template: scanned.append(fileName) or _Hist([0., 1.]))
+    monkeypatch.setattr(_Hist, 'Write', lambda self, name: None, raising=False)
+    monkeypatch.setattr(puProfile.os, 'rename', lambda src, dst: scanned.append(os.path.basename(dst)))
+    cache = PUProfileCache(str(tmp_path))
+    template = _Hist([0., 1., 2.])
+    lfn = 'root://cmsxrootd.fnal.gov//store/mc/TT/1.root'
+    # a prefetched copy is scanned, and cached under the name of the input file
+    cache.get(lfn, 'Pileup_nTrueInt', template, source='/tmp/prefetch/a1b2.root')
+    assert scanned == ['/tmp/prefetch/a1b2.root', profileKey(lfn, 'Pileup_nTrueInt', template) + '.root']
@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+# the data files of the module definitions are found from CMSSW_BASE
+os.environ.setdefault('CMSSW_BASE', '/cmssw')
+
+from PhysicsTools.NanoAODTools.postprocessing.modules.common.puWeightProducer import puWeightProducer
+
+
+class _Hist(object):
+    def __init__(self, nbins):
+        self.nbins = nbins
+
+    def GetNbinsX(self):
+        return self.nbins
+
+
+class _Worker(object):
+    def __init__(self, scale):
+        self.scale = scale
+
+    def getWeight(self, nvtx):
+        return self.scale * (1. + 0.1 * nvtx)
+
+
+def _producer(nbins=5):
+    producer = puWeightProducer.__new__(puWeightProducer)
+    producer.name = 'puWeight'
+    producer.nvtxVar = 'Pileup_nTrueInt'
+    producer.chunks = None
+    producer.myh = _Hist(nbins)
+    producer.weights = {'puWeight': producer.weightTable(_Worker(1.)), 'puWeightUp': producer.weightTable(_Worker(2.))}
+    return producer
+
+
+def test_weight_table():
+    producer = _producer()
+    assert producer.weights['puWeight'].dtype == np.float32
+    # values beyond the histogram get a weight of 1
+    assert producer.weights['puWeight'] == pytest.approx([1., 1.1, 1.2, 1.3, 1.4, 1.])
+
+
+def test_weights_as_per_event(make_event, output):
+    producer = _producer()
+    nvtx = np.array([-1., 0., 2.7, 4.2, 5., 60.])
+    weights = producer.getWeights(nvtx)
+    producer.out = output
+    for i, n in enumerate(nvtx):
+        producer.analyze(make_event(Pileup_nTrueInt=n))
+        assert producer.out.values == dict((name, w[i]) for name, w in weights.items())
+    assert weights['puWeightUp'] == pytest.approx([2., 2., 2.4, 2.8, 1., 1.])
+    # events without the pileup branch (data)
+    producer.analyze(make_event())
+    assert producer.out.values == {'puWeight': 1, 'puWeightUp': 1}
@@ -0,0 +1,90 @@
+import json
+from argparse import Namespace
+
+import pytest
+
+pytest.importorskip('six')
+
+from runPostProcessing import check_job_status  # noqa: E402
+
+SUBMITTED = '000 (123.000.000) 10/19 12:00:00 Job submitted from host: <127.0.0.1:9618>\n'
+EXECUTING = '001 (123.000.000) 10/19 12:01:00 Job executing on host: <127.0.0.2:9618>\n'
+SUCCEEDED = '\t(1) Normal termination (return value 0)\n'
+FAILED = '\t(1) Normal termination (return value 1)\n'
+
+
+def test_check_job_status_packed(tmp_path, write_file):
+    jobdir = str(tmp_path)
+
+    write_file('metadata.json', json.dumps({'jobs': [{}] * 7}))
+    write_file('0.log', SUBMITTED, SUCCEEDED)
+    write_file('1.log', SUBMITTED, EXECUTING)
+    write_file('2.log', SUBMITTED, FAILED)
+    # jobs 3 and 4 run in one condor job, their status is in its output
+    write_file('3+4.log', SUBMITTED, SUCCEEDED)
+    write_file('3+4.out', 'Job 3 terminated: return value 0\n', 'Job 4 terminated: return value 2\n')
+    # the condor job ended but job 6 never reported
+    write_file('5+6.log', SUBMITTED, SUCCEEDED)
+    write_file('5+6.out', 'Job 5 terminated: return value 0\n')
+    all_completed, jobids = check_job_status(Namespace(jobdir=jobdir, metadata='metadata.json', scan_procs=2))
+    assert not all_completed
+    assert jobids == {'running': ['1'], 'failed': ['2', '4', '6'], 'completed': ['0', '3', '5']}
+
+
+class _Producer(object):
+    '''autoPU pileup weight producer'''
+
+    def __init__(self, autoPU=True):
+        self.autoPU = autoPU
+        self.nvtxVar = 'Pileup_nTrueInt'
+        self.myh = 'template'
+
+    def setDatasetProfile(self, profileFile, dataset):
+        pass
+
+
+def _unused():
+    raise AssertionError('modules without a pileup producer must not be instantiated')
+
+
+def test_fill_pu_profile_cache(tmp_path, monkeypatch):
+    import types
+    pytest.importorskip('ROOT')
+    import runPostProcessing
+    from PhysicsTools.NanoAODTools.postprocessing.modules.common import puProfile
+    pu = types.ModuleType('pu_modules')
+    pu.puWeightProducer = _Producer
+    pu.puAutoWeight = lambda: _Producer()
+    pu.puWeight = lambda: _Producer(autoPU=False)
+    other = types.ModuleType('other_modules')
+    other.jetmet = _unused
+    monkeypatch.setitem(__import__('sys').modules, 'pu_modules', pu)
+    monkeypatch.setitem(__import__('sys').modules, 'other_modules', other)
+    filled, written = [], {}
+    monkeypatch.setattr(puProfile, 'fillCache', lambda files, *args, **kwargs: filled.append(files))
+    monkeypatch.setattr(puProfile, 'datasetProfile', lambda files, *args: 'merged %d' % len(files))
+    monkeypatch.setattr(puProfile, 'writeDatasetProfiles', lambda path, profiles: written.update({path: profiles}))
+    monkeypatch.setattr(puProfile, 'datasetProfileName', lambda samp, nvtxVar, template: '%s|%s' % (samp, nvtxVar))
+    md = {'samples': ['TT', 'WJets'], 'inputfiles': {'TT': ['/store/tt_1.root', '/store/tt_2.root'],
+                                                     'WJets': ['/store/wj_1.root']}}
+    args = Namespace(jobdir=str(tmp_path), puProfileCache='/eos/cache', pu_prepass=4,
+                     imports=[('other_modules', 'jetmet'), ('pu_modules', 'puWeight,puAutoWeight')])
+    runPostProcessing.fill_pu_profile_cache(args, md)
+    assert len(filled) == 2
+    # the profiles of all the datasets are merged once, in one file
+    assert written == {str(tmp_path / 'pu_profiles.root'): {'TT|Pileup_nTrueInt': 'merged 2',
+                                                            'WJets|Pileup_nTrueInt': 'merged 1'}}
+    assert md['puProfileFile'] == 'pu_profiles.root'
+
+
+@pytest.mark.parametrize('jobs,cpus,memory,runtime', [
+    (1, 0, '2000', '24*60*60'),
+    (4, 0, '(2000)*4', '24*60*60'),
+    (4, 2, '(2000)*2', '(24*60*60)*2'),
+    (5, 2, '(2000)*2', '(24*60*60)*3'),
+    (2, 8, '(2000)*2', '24*60*60'),
+])
+def test_slot_resources(jobs, cpus, memory, runtime):
+    from runPostProcessing import slot_resources
+    args = Namespace(jobs_per_slot=jobs, cpus_per_slot=cpus, request_memory='2000', max_runtime='24*60*60')
+    assert slot_resources(args) == (memory, runtime)
@@ -0,0 +1,69 @@
+import random
+
+import numpy as np
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoAODTools.postprocessing.tools import HistArrays, counterGaus, counterUniform, philox4x32, \
+    rngStream, RNG_DOMAIN_JETSMEARER, RNG_DOMAIN_MUONSCALERES  # noqa: E402
+
+
+def test_find_bin_2d(make_hist):
+    rng = random.Random(7)
+    hist = make_hist([-3., -2.5, -2.25, 0., 2.25, 2.5, 3.], (8, 20., 500.))
+    arrays = HistArrays(hist)
+    x = np.array([rng.uniform(-4, 4) for _ in range(1000)] + [-3., -2.5, 0., 3.])
+    y = np.array([rng.uniform(0, 600) for _ in range(1000)] + [20., 500., 499.99, 80.])
+    bins = arrays.findBin(x, y)
+    assert bins.tolist() == [hist.FindBin(a, b) for a, b in zip(x, y)]
+    assert arrays.getBinContent(x, y).tolist() == [hist.GetBinContent(b) for b in bins]
+    assert arrays.getBinError(x, y).tolist() == [hist.GetBinError(b) for b in bins]
+
+
+@pytest.mark.parametrize('axis', [(12, 0., 12.), [0., 1., 10., 11., 12.]])
+def test_find_bin_1d(make_hist, axis):
+    hist = make_hist(axis)
+    arrays = HistArrays(hist)
+    x = np.array([-1., 0., 0.5, 1., 10., 11.99, 12., 50.])
+    assert arrays.findBin(x).tolist() == [hist.FindBin(v) for v in x]
+
+
+# known-answer vectors of philox4x32_10 from Random123
+@pytest.mark.parametrize('counter,key,expected', [
+    ([0, 0, 0, 0], [0, 0], [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8]),
+    ([0xffffffff] * 4, [0xffffffff] * 2, [0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd]),
+    ([0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344], [0xa4093822, 0x299f31d0],
+     [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1]),
+])
+def test_philox_known_answers(counter, key, expected):
+    words = philox4x32([np.array([c]) for c in counter], [np.array([k]) for k in key])
+    assert [int(w[0]) for w in words] == expected
+
+
+def test_counter_random_numbers_do_not_depend_on_batching():
+    rng = random.Random(5)
+    keys = [(rng.randint(1, 400000), rng.randint(1, 3000), rng.randint(1, 2**40), rng.randint(0, 9))
+            for _ in range(200)]
+    run, lumi, event, index = (np.array(col, dtype=np.uint64) for col in zip(*keys))
+    batch = counterUniform(run, lumi, event, index, 7)
+    assert batch.tolist() == [counterUniform(*(key + (7,))) for key in keys]
+    assert ((batch > 0.) & (batch < 1.)).all()
+    assert (batch != counterUniform(run, lumi, event, index, 8)).all()
+
+
+def test_counter_gaus():
+    n = 20000
+    gaus = counterGaus(np.full(n, 1), np.full(n, 2), np.arange(n), np.zeros(n), sigma=2.)
+    assert abs(gaus.mean()) < 0.05
+    assert abs(gaus.std() - 2.) < 0.05
+
+
+def test_rng_streams_of_modules_are_disjoint():
+    # the jet smearing streams are those used before the domains were introduced
+    jets = set(rngStream(RNG_DOMAIN_JETSMEARER, i) for i in range(1, 5))
+    assert jets == {1, 2, 3, 4}
+    muons = set(rngStream(RNG_DOMAIN_MUONSCALERES, seed) for seed in range(1 << 16))
+    assert not jets & muons
+    with pytest.raises(ValueError):
+        rngStream(RNG_DOMAIN_MUONSCALERES, 1 << 16)